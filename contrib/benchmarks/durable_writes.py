@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+#
+#   durable_writes.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark the cost of making installed files durable
+
+Installs files the way synctool-client does (temp file, rename into
+place) and compares:
+  none      no syncing at all, as without durable_writes
+  fsync     fsync() every file before renaming it, and its directory
+  batched   durable_writes: fdatasync() all files and dirs at the end
+  sync      a single os.sync() at the end
+
+The files are written in a temp directory; use -d to test on
+a specific filesystem. The numbers depend very much on the disk.
+
+usage: durable_writes.py [-n files] [-s size_kB] [-d dir] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import tempfile
+
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.durable
+
+
+def install(path: str, data: bytes, sync_file: bool) -> int:
+    '''write data to temp file and rename into place
+    Returns the (still open) file descriptor
+    '''
+
+    tmp_path = path + '.tmp'
+    fdesc = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.write(fdesc, data)
+    if sync_file:
+        os.fsync(fdesc)
+    os.rename(tmp_path, path)
+    return fdesc
+
+
+def run_none(paths: List[str], data: bytes) -> None:
+    '''no syncing'''
+
+    for path in paths:
+        os.close(install(path, data, False))
+
+
+def run_fsync(paths: List[str], data: bytes) -> None:
+    '''fsync every file and its directory'''
+
+    for path in paths:
+        os.close(install(path, data, True))
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+        os.fsync(dir_fd)
+        os.close(dir_fd)
+
+
+def run_batched(paths: List[str], data: bytes) -> None:
+    '''synctool.durable'''
+
+    synctool.param.DURABLE_WRITES = True
+    for path in paths:
+        fdesc = install(path, data, False)
+        synctool.durable.add_file(fdesc, path)
+        synctool.durable.add_dir(os.path.dirname(path))
+        os.close(fdesc)
+    synctool.durable.flush()
+
+
+def run_sync(paths: List[str], data: bytes) -> None:
+    '''one global sync'''
+
+    run_none(paths, data)
+    os.sync()
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_files = 1000
+    size_kb = 4
+    topdir = None
+    repeat = 3
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:s:d:r:')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_files = int(arg)
+        elif opt == '-s':
+            size_kb = int(arg)
+        elif opt == '-d':
+            topdir = arg
+        elif opt == '-r':
+            repeat = int(arg)
+
+    testdir = tempfile.mkdtemp(prefix='synctool-bench-', dir=topdir)
+    try:
+        # spread the files over some directories, like a config tree
+        paths = []
+        for num in range(num_files):
+            subdir = os.path.join(testdir, 'd%02d' % (num % 20))
+            os.makedirs(subdir, exist_ok=True)
+            paths.append(os.path.join(subdir, 'f%05d' % num))
+        data = b'x' * (size_kb * 1024)
+
+        print('%d files of %d kB in %s' % (num_files, size_kb, testdir))
+        runs: List[Tuple[str, Callable[[List[str], bytes], None]]] = [
+            ('none', run_none),
+            ('fsync', run_fsync),
+            ('batched', run_batched),
+            ('sync', run_sync),
+        ]
+        for label, func in runs:
+            best = -1.0
+            for _ in range(repeat):
+                # start from a clean page cache state for this dir
+                os.sync()
+                t_start = time.monotonic()
+                func(paths, data)
+                t_spent = time.monotonic() - t_start
+                if best < 0 or t_spent < best:
+                    best = t_spent
+            print('%-10s %8.3fs' % (label, best))
+    finally:
+        shutil.rmtree(testdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+#
+#   file_compare.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark comparing file contents: the old double MD5 loop against
+the direct byte compare, and against a cached digest of the source
+(where only the destination is read) for each digest algorithm
+
+Cases are many small config files, and one large file. Files that are
+the same are read entirely; files that differ in the first chunk
+show the early exit. The files are in the page cache after the first
+round, so this measures CPU and memory bandwidth rather than the disk.
+
+usage: file_compare.py [-n small_files] [-s large_file_MB] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import contextlib
+import hashlib
+import tempfile
+
+from typing import Dict, List, Tuple, Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+from synctool.compare import compare_contents, _compare_digest, IO_SIZE
+
+# pylint: disable=protected-access
+
+OLD_IO_SIZE = 16 * 1024
+
+FilePair = Tuple[str, str]
+
+
+def old_compare(src_path: str, dest_path: str) -> bool:
+    '''the old compare: read both files, compare running MD5 digests'''
+
+    sum1 = hashlib.md5()
+    sum2 = hashlib.md5()
+
+    with open(src_path, 'rb') as ffile1, open(dest_path, 'rb') as ffile2:
+        ended = False
+        while not ended and (sum1.digest() == sum2.digest()):
+            data1 = ffile1.read(OLD_IO_SIZE)
+            if not data1:
+                ended = True
+            else:
+                sum1.update(data1)
+
+            data2 = ffile2.read(OLD_IO_SIZE)
+            if not data2:
+                ended = True
+            else:
+                sum2.update(data2)
+
+    return sum1.digest() == sum2.digest()
+
+
+def new_compare(src_path: str, dest_path: str) -> bool:
+    '''the direct byte compare'''
+
+    return compare_contents(src_path, dest_path)[0]
+
+
+def digest_compare(algorithm: str) -> Callable[[str, str], bool]:
+    '''Returns compare function that only reads the destination,
+    as with a cached digest of the source
+    '''
+
+    def compare(src_path: str, dest_path: str) -> bool:
+        '''compare against digest of src_path'''
+
+        synctool.param.DIGEST_ALGORITHM = algorithm
+        return _compare_digest(dest_path, DIGESTS[algorithm][src_path])[0]
+
+    return compare
+
+
+# precomputed digests per algorithm, per source path
+DIGESTS: Dict[str, Dict[str, bytes]] = {}
+
+
+def file_digest(algorithm: str, path: str) -> bytes:
+    '''Returns digest of file'''
+
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as fio:
+        while True:
+            data = fio.read(IO_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.digest()
+
+
+def write_file(path: str, size: int, fill: bytes) -> None:
+    '''write file of size bytes'''
+
+    block = (fill * (IO_SIZE // len(fill) + 1))[:IO_SIZE]
+    with open(path, 'wb') as fio:
+        while size > 0:
+            fio.write(block[:min(size, IO_SIZE)])
+            size -= IO_SIZE
+
+
+def make_pair(topdir: str, name: str, size: int, differ: bool) -> FilePair:
+    '''make a source and destination file
+    If differ is True, they differ in the first byte
+    '''
+
+    src_path = os.path.join(topdir, name + '.src')
+    dest_path = os.path.join(topdir, name + '.dest')
+    write_file(src_path, size, b'synctool\n')
+    write_file(dest_path, size, b'synctool\n')
+    if differ:
+        with open(dest_path, 'r+b') as fio:
+            fio.write(b'S')
+    return src_path, dest_path
+
+
+def run_case(pairs: List[FilePair], compare: Callable[[str, str], bool],
+             repeat: int) -> float:
+    '''Returns best wall time of comparing all pairs'''
+
+    best = -1.0
+    for _ in range(repeat):
+        t_start = time.monotonic()
+        for src_path, dest_path in pairs:
+            compare(src_path, dest_path)
+        t_spent = time.monotonic() - t_start
+        if best < 0 or t_spent < best:
+            best = t_spent
+    return best
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_small = 2000
+    large_mb = 1024
+    repeat = 3
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:s:r:')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_small = int(arg)
+        elif opt == '-s':
+            large_mb = int(arg)
+        elif opt == '-r':
+            repeat = int(arg)
+
+    # no digest cache
+    synctool.param.OVERLAY_DIR = ''
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making test files in %s ...' % topdir)
+        cases = [
+            ('%d x 2 kB same' % num_small,
+             [make_pair(topdir, 'small%d' % i, 2048, False) for i in range(num_small)]),
+            ('%d x 2 kB differ' % num_small,
+             [make_pair(topdir, 'diff%d' % i, 2048, True) for i in range(num_small)]),
+            ('%d MB same' % large_mb,
+             [make_pair(topdir, 'large', large_mb * 1024 * 1024, False)]),
+            ('%d MB differ' % large_mb,
+             [make_pair(topdir, 'largediff', large_mb * 1024 * 1024, True)]),
+        ]
+
+        compares: List[Tuple[str, Callable[[str, str], bool]]] = [
+            ('md5 loop', old_compare),
+            ('byte cmp', new_compare),
+        ]
+        for algorithm in synctool.param.KNOWN_DIGEST_ALGORITHMS:
+            DIGESTS[algorithm] = {}
+            for _, pairs in cases:
+                for src_path, _ in pairs:
+                    DIGESTS[algorithm][src_path] = file_digest(algorithm, src_path)
+            compares.append(('%s dest' % algorithm, digest_compare(algorithm)))
+
+        print('%-20s' % 'case' + ''.join('%13s' % label for label, _ in compares))
+        for case_label, pairs in cases:
+            line = '%-20s' % case_label
+            for _, compare in compares:
+                # no output about mismatches
+                with open(os.devnull, 'w', encoding='utf-8') as devnull:
+                    with contextlib.redirect_stdout(devnull):
+                        secs = run_case(pairs, compare, repeat)
+                line += '%12.3fs' % secs
+            print(line)
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
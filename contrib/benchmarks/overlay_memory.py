@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+#
+#   overlay_memory.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark the memory used per overlay entry
+
+A synthetic overlay tree is walked in a fresh process, once with
+a set of full paths for the destinations that were visited, and once
+with the DestSet, that has per-directory sets of interned names.
+The growth of the peak RSS is reported per 100k entries. The callback
+looks at the destination stat of every entry, like a check does.
+The walks go first; a child process starts out with the peak RSS
+of its parent.
+
+Then tracemalloc measures 100k SyncObjects with their SyncStats, made
+like the overlay walk makes them, against the same objects as they
+were before (attributes in a __dict__, the destination stat'ed up front),
+and the same for the set of full paths against the DestSet.
+
+usage: overlay_memory.py [-n entries] [-f files_per_dir]
+'''
+
+import os
+import sys
+import shutil
+import getopt
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.overlay
+from synctool.object import SyncObject
+from synctool.syncstat import SyncStat
+
+# pylint: disable=protected-access,too-few-public-methods
+
+PER = 100000
+
+
+class DictStat:
+    '''SyncStat as it was: attributes in a __dict__'''
+
+    def __init__(self) -> None:
+        '''initialize instance'''
+
+        self.entry_exists = True
+        self.mode = 0o100644
+        self.uid = self.gid = 0
+        self.size = 1024
+        self.atime = self.mtime = 1700000000
+
+
+class DictObject:
+    '''SyncObject as it was: attributes in a __dict__,
+    and both stats made up front
+    '''
+
+    def __init__(self, src_path: str, dest_path: str) -> None:
+        '''initialize instance'''
+
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.ov_type = 0
+        self.src_stat = DictStat()
+        self.dest_stat = DictStat()
+        self.fix_action = 0
+        self.prefetched = None
+
+
+def make_dict_object(src_path: str, dest_path: str) -> Any:
+    '''Returns object like the old SyncObject'''
+
+    return DictObject(src_path, dest_path)
+
+
+def make_slots_object(src_path: str, dest_path: str) -> Any:
+    '''Returns SyncObject like the walk makes it; the destination
+    is not stat'ed until it is needed
+    '''
+
+    obj = SyncObject(src_path, dest_path)
+    obj.src_stat = SyncStat()
+    obj._dest_stat = None
+    return obj
+
+
+def paths(num: int, files_per_dir: int) -> List[Tuple[str, str]]:
+    '''Returns list of (src_path, dest_path)'''
+
+    arr = []
+    for idx in range(num):
+        dest_dir = '/etc/d%05d' % (idx // files_per_dir)
+        filename = 'f%04d' % (idx % files_per_dir)
+        arr.append(('/var/lib/synctool/overlay/all' + dest_dir + '/' +
+                    filename + '._all', dest_dir + '/' + filename))
+    return arr
+
+
+def traced(func: Callable[[], Any]) -> int:
+    '''Returns number of bytes allocated by func, that are still in use'''
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = func()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del keep
+    return used
+
+
+def measure_objects(files_per_dir: int) -> None:
+    '''print bytes per 100k objects and visited destinations'''
+
+    pairs = paths(PER, files_per_dir)
+
+    print('per %dk entries:' % (PER // 1000))
+    for label, make in (('dict objects', make_dict_object),
+                        ('slots objects', make_slots_object)):
+        used = traced(lambda make=make: [make(src, dest) for src, dest in pairs])
+        print('  %-22s %8.1f MB' % (label, used / 1e6))
+
+    def path_set() -> Any:
+        # the strings are made fresh, like os.path.join() in the walk
+        return set(''.join((dest, '')) for _, dest in pairs)
+
+    def dest_set() -> Any:
+        visited = synctool.overlay.DestSet()
+        for _, dest in pairs:
+            visited.add(''.join((dest, '')))
+        return visited
+
+    for label, func in (('set of full paths', path_set),
+                        ('DestSet', dest_set)):
+        print('  %-22s %8.1f MB' % (label, traced(func) / 1e6))
+
+
+def walk(overlay: str, use_destset: bool) -> None:
+    '''walk the overlay tree in this process, and print
+    the growth of the peak RSS in kB and the number of entries
+    '''
+
+    count = [0]
+
+    def callback(obj: SyncObject, _pre_dict: Dict[str, str],
+                 _post_dict: Dict[str, str]) -> Tuple[bool, bool]:
+        '''look at the destination, like a check does'''
+
+        obj.dest_stat.exists()
+        count[0] += 1
+        return True, False
+
+    if not use_destset:
+        synctool.overlay.DestSet = set             # type: ignore
+
+    synctool.param.OVERLAY_DIR = overlay
+    synctool.param.OVERLAY_LEN = len(overlay) + 1
+    synctool.param.MY_GROUPS = ['all']
+    synctool.param.ALL_GROUPS = set(synctool.param.MY_GROUPS)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    synctool.overlay.visit(overlay, callback)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%d %d' % (after - before, count[0]))
+
+
+def make_tree(topdir: str, num_entries: int, files_per_dir: int) -> str:
+    '''make synthetic overlay tree, of which no destination exists
+    Returns the overlay dir
+    '''
+
+    overlay = os.path.join(topdir, 'overlay')
+    dest = os.path.join(topdir, 'dest')
+    num_dirs = max(num_entries // files_per_dir, 1)
+
+    for dirnum in range(num_dirs):
+        dest_dir = os.path.join(dest, 'd%05d' % dirnum)
+        dir_all = os.path.join(overlay, 'all') + dest_dir
+        os.makedirs(dir_all)
+        for filenum in range(files_per_dir):
+            path = os.path.join(dir_all, 'f%04d._all' % filenum)
+            with open(path, 'w', encoding='utf-8'):
+                pass
+
+    return overlay
+
+
+def measure_walk(num_entries: int, files_per_dir: int) -> None:
+    '''print peak RSS growth of the walk per 100k entries'''
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making overlay tree of %d entries in %s ...' % (num_entries,
+                                                              topdir))
+        overlay = make_tree(topdir, num_entries, files_per_dir)
+
+        for label, flag in (('set of full paths', 'set'),
+                            ('DestSet', 'destset')):
+            out = subprocess.check_output([sys.executable, __file__,
+                                           '-w', flag, overlay],
+                                          universal_newlines=True)
+            rss_kb, count = [int(x) for x in out.split()]
+            print('  walk, %-16s %8.1f MB peak RSS per %dk entries' %
+                  (label, rss_kb * PER / count / 1024, PER // 1000))
+    finally:
+        shutil.rmtree(topdir)
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_entries = 200000
+    files_per_dir = 50
+
+    opts, args = getopt.getopt(sys.argv[1:], 'n:f:w:')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_entries = int(arg)
+        elif opt == '-f':
+            files_per_dir = int(arg)
+        elif opt == '-w':
+            # run the walk in this (fresh) process
+            walk(args[0], arg == 'destset')
+            return
+
+    measure_walk(num_entries, files_per_dir)
+    measure_objects(files_per_dir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+#
+#   overlay_resolve.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark resolving the names in overlay directories: the old
+per-entry code (fnmatch loop over the ignore patterns, MY_GROUPS.index(),
+sort with cmp_to_key) against the precompiled Resolver (one regex,
+a dict of group importances, a tuple sort key and a memo of names)
+
+Directories with thousands of entries are made in a temp directory,
+with group extensions out of hundreds of groups, of which the node
+is in a part. Each directory is resolved twice, like synctool does
+for overlay/ and delete/; the second time, the Resolver has all names
+in its memo. The directory reads are the same for both, so the
+difference is all CPU.
+
+usage: overlay_resolve.py [-d dirs] [-n entries_per_dir] [-g groups]
+                          [-i ignore_patterns] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import fnmatch
+import tempfile
+from functools import cmp_to_key
+
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.overlay
+from synctool.overlay import OV_REG, OV_PRE, OV_POST, OV_TEMPLATE
+from synctool.overlay import OV_TEMPLATE_POST, OV_NO_EXT
+from synctool.object import SyncObject
+
+# pylint: disable=protected-access
+
+Resolved = List[Tuple[SyncObject, int]]
+
+
+def old_split_extension(filename: str) -> Tuple[Optional[SyncObject], int]:
+    '''the old _split_extension(), without the messages'''
+
+    # pylint: disable=too-many-return-statements
+
+    group_all = len(synctool.param.MY_GROUPS) - 1
+
+    (name, ext) = os.path.splitext(filename)
+    if not ext:
+        return SyncObject(filename, name, OV_NO_EXT), group_all
+
+    if ext == '.pre':
+        return SyncObject(filename, name, OV_PRE), group_all
+
+    if ext == '.post':
+        (name2, ext) = os.path.splitext(name)
+        if ext == '._template':
+            return SyncObject(filename, name, OV_TEMPLATE_POST), group_all
+        return SyncObject(filename, name, OV_POST), group_all
+
+    if ext[:2] != '._':
+        return SyncObject(filename, filename, OV_NO_EXT), group_all
+
+    ext = ext[2:]
+    if not ext:
+        return SyncObject(filename, filename, OV_NO_EXT), group_all
+
+    if ext == 'template':
+        return SyncObject(filename, name, OV_TEMPLATE), group_all
+
+    try:
+        importance = synctool.param.MY_GROUPS.index(ext)
+    except ValueError:
+        return None, -1
+
+    (name2, ext) = os.path.splitext(name)
+
+    if ext == '.pre':
+        return SyncObject(filename, name2, OV_PRE), importance
+
+    if ext == '.post':
+        _, ext = os.path.splitext(name2)
+        if ext == '._template':
+            return (SyncObject(filename, name2, OV_TEMPLATE_POST), importance)
+        return SyncObject(filename, name2, OV_POST), importance
+
+    if ext == '._template':
+        return SyncObject(filename, name2, OV_TEMPLATE), importance
+
+    return SyncObject(filename, name), importance
+
+
+def old_sort(item1: Tuple[SyncObject, int], item2: Tuple[SyncObject, int]) -> int:
+    '''the old _sort_by_importance_post_first()'''
+
+    # pylint: disable=too-many-return-statements
+
+    obj1, importance1 = item1
+    obj2, importance2 = item2
+
+    if obj1.ov_type == obj2.ov_type:
+        if importance1 < importance2:
+            return -1
+        return int(importance1 == importance2)
+
+    for ov_type in (OV_PRE, OV_POST, OV_TEMPLATE_POST, OV_TEMPLATE):
+        if obj1.ov_type == ov_type:
+            return -1
+        if obj2.ov_type == ov_type:
+            return 1
+
+    return 0
+
+
+def old_scan_dir(src_dir: str) -> Resolved:
+    '''the old way of reading and resolving an overlay directory'''
+
+    arr = []
+    with os.scandir(src_dir) as it_entries:
+        for entry in it_entries:
+            name = entry.name
+            if name in synctool.param.IGNORE_FILES:
+                continue
+
+            wildcard_match = False
+            for wildcard_entry in synctool.param.IGNORE_FILES_WITH_WILDCARDS:
+                if fnmatch.fnmatchcase(name, wildcard_entry):
+                    wildcard_match = True
+                    break
+
+            if wildcard_match:
+                continue
+
+            obj, importance = old_split_extension(name)
+            if obj is None:
+                continue
+
+            arr.append((obj, importance))
+
+    arr.sort(key=cmp_to_key(old_sort))
+    return arr
+
+
+def new_scan_dir(src_dir: str) -> Resolved:
+    '''the Resolver'''
+
+    arr, _ = synctool.overlay._scan_dir(src_dir)
+    return arr
+
+
+def make_dirs(topdir: str, num_dirs: int, num_entries: int,
+              num_groups: int) -> List[str]:
+    '''make directories full of overlay entries
+    Returns list of directories
+    '''
+
+    groups = ['g%03d' % num for num in range(num_groups)] + ['all']
+    dirs = []
+    for dirnum in range(num_dirs):
+        path = os.path.join(topdir, 'd%03d' % dirnum)
+        os.mkdir(path)
+        dirs.append(path)
+        for num in range(num_entries):
+            # a few scripts, templates and names without extension
+            # among the files for all kinds of groups
+            kind = num % 50
+            base = 'f%05d' % (num // 3)
+            group = groups[(num * 7) % len(groups)]
+            if kind == 0:
+                name = '%s.post' % base
+            elif kind == 1:
+                name = '%s._%s.pre' % (base, group)
+            elif kind == 2:
+                name = '%s._template' % base
+            elif kind == 3:
+                name = base
+            elif kind == 4:
+                name = '%s._%s.swp' % (base, group)
+            else:
+                name = '%s._%s' % (base, group)
+            with open(os.path.join(path, name), 'w', encoding='utf-8'):
+                pass
+    return dirs
+
+
+def winners(arr: Resolved) -> Dict[str, int]:
+    '''Returns the importance of the source that is picked
+    for each destination
+    '''
+
+    picked: Dict[str, int] = {}
+    for obj, importance in arr:
+        if obj.ov_type in (OV_REG, OV_NO_EXT):
+            picked.setdefault(obj.dest_path, importance)
+    return picked
+
+
+def most_important(arr: Resolved) -> Dict[str, int]:
+    '''Returns the importance of the most important source
+    for each destination
+    '''
+
+    found: Dict[str, int] = {}
+    for obj, importance in arr:
+        if obj.ov_type in (OV_REG, OV_NO_EXT):
+            found[obj.dest_path] = min(importance,
+                                       found.get(obj.dest_path, importance))
+    return found
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    # pylint: disable=too-many-locals
+
+    num_dirs = 20
+    num_entries = 5000
+    num_groups = 300
+    num_patterns = 20
+    repeat = 3
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'd:n:g:i:r:')
+    for opt, arg in opts:
+        if opt == '-d':
+            num_dirs = int(arg)
+        elif opt == '-n':
+            num_entries = int(arg)
+        elif opt == '-g':
+            num_groups = int(arg)
+        elif opt == '-i':
+            num_patterns = int(arg)
+        elif opt == '-r':
+            repeat = int(arg)
+
+    # the node is in every third group; the most important group first
+    all_groups = ['g%03d' % num for num in range(num_groups)]
+    synctool.param.MY_GROUPS = all_groups[::3] + ['all']
+    synctool.param.ALL_GROUPS = set(all_groups + ['all'])
+    synctool.param.IGNORE_FILES = set(['.git', 'CVS', 'RCS'])
+    patterns = ['*.swp', '*~', '.#*', '*.bak', '*.orig', '*.rej', '*.dpkg-*',
+                '*.rpmnew', '*.rpmsave', '#*#']
+    while len(patterns) < num_patterns:
+        patterns.append('*.tmp%d' % len(patterns))
+    synctool.param.IGNORE_FILES_WITH_WILDCARDS = patterns[:num_patterns]
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making %d dirs of %d entries in %s ...' % (num_dirs,
+                                                           num_entries,
+                                                           topdir))
+        dirs = make_dirs(topdir, num_dirs, num_entries, num_groups)
+        print('%d groups, node is in %d, %d ignore patterns' %
+              (num_groups + 1, len(synctool.param.MY_GROUPS),
+               len(synctool.param.IGNORE_FILES_WITH_WILDCARDS)))
+
+        # the resolver must pick the most important source for every
+        # destination. The old sort did not always do so: it had no order
+        # between regular files and names without extension, which
+        # confused the sort
+        wrong = 0
+        for path in dirs:
+            old_arr = old_scan_dir(path)
+            new_arr = new_scan_dir(path)
+            if winners(new_arr) != most_important(new_arr):
+                print('error: resolver picks the wrong source in %s' % path)
+                sys.exit(1)
+            old_picked = winners(old_arr)
+            for dest, importance in most_important(old_arr).items():
+                if old_picked[dest] != importance:
+                    wrong += 1
+        if wrong:
+            print('the old sort picks a less important source '
+                  'for %d destinations' % wrong)
+
+        for label, scan in (('old', old_scan_dir), ('resolver', new_scan_dir)):
+            best = -1.0
+            for _ in range(repeat):
+                # start with an empty memo
+                synctool.overlay._RESOLVER = None
+                t_start = time.monotonic()
+                # overlay/ and delete/
+                for _ in range(2):
+                    for path in dirs:
+                        scan(path)
+                t_spent = time.monotonic() - t_start
+                if best < 0 or t_spent < best:
+                    best = t_spent
+            print('%-10s %8.3fs' % (label, best))
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
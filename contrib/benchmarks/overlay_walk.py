@@ -0,0 +1,281 @@
+#! /usr/bin/env python3
+#
+#   overlay_walk.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark the scandir() based overlay walk against the old
+listdir() walk that stat'ed both source and destination of every entry
+
+A synthetic overlay tree is made in a temp directory. Group 'web'
+overrides a part of the files of group 'all', and every directory
+has a .post script. Half of the destination directories exist.
+The callback does nothing, so this measures only the walk itself.
+
+System calls are counted by wrapping os.listdir(), os.scandir(),
+os.lstat() and DirEntry.stat(); a DirEntry knows the file type from
+the directory read, and caches the stat once it is done.
+The scandir walk also reads destination directories at once, so that
+destination entries that do not exist are not lstat'ed one by one.
+
+usage: overlay_walk.py [-n entries] [-f files_per_dir] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import tempfile
+
+from typing import Dict, Set, Tuple, Callable, Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.overlay
+from synctool.object import SyncObject
+
+# pylint: disable=protected-access
+
+COUNTS: Dict[str, int] = {}
+
+
+def make_tree(topdir: str, num_entries: int, files_per_dir: int) -> str:
+    '''make synthetic overlay and destination trees
+    Returns the overlay dir
+    '''
+
+    overlay = os.path.join(topdir, 'overlay')
+    dest = os.path.join(topdir, 'dest')
+    num_dirs = max(num_entries // (files_per_dir + 1), 1)
+
+    for dirnum in range(num_dirs):
+        dirname = 'd%05d' % dirnum
+        dest_dir = os.path.join(dest, dirname)
+        dir_all = os.path.join(overlay, 'all') + dest_dir
+        dir_web = os.path.join(overlay, 'web') + dest_dir
+        os.makedirs(dir_all)
+        os.makedirs(dir_web)
+        if dirnum % 2 == 0:
+            os.makedirs(dest_dir)
+
+        for filenum in range(files_per_dir):
+            filename = 'f%04d' % filenum
+            # one in five files is overridden by group web
+            if filenum % 5 == 0:
+                path = os.path.join(dir_web, filename + '._web')
+            else:
+                path = os.path.join(dir_all, filename + '._all')
+            with open(path, 'w', encoding='utf-8') as fio:
+                fio.write('x\n')
+
+            if dirnum % 2 == 0:
+                with open(os.path.join(dest_dir, filename), 'w',
+                          encoding='utf-8') as fio:
+                    fio.write('x\n')
+
+        # a duplicate that is never used, and a .post script
+        with open(os.path.join(dir_all, 'f0000._all'), 'w',
+                  encoding='utf-8') as fio:
+            fio.write('x\n')
+        with open(os.path.join(dir_all, 'f0001.post'), 'w',
+                  encoding='utf-8') as fio:
+            fio.write('#! /bin/sh\n')
+
+    return overlay
+
+
+def nop_callback(_obj: SyncObject, _pre_dict: Dict[str, str],
+                 _post_dict: Dict[str, str]) -> Tuple[bool, bool]:
+    '''do nothing'''
+
+    return True, False
+
+
+def listdir_walk(src_dir: str, dest_dir: str, duplicates: Set[str],
+                 callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> None:
+    '''the old overlay walk, as far as system calls are concerned'''
+
+    arr = []
+    for entry in os.listdir(src_dir):
+        obj, importance = synctool.overlay._split_extension(entry, src_dir)
+        if obj is None:
+            continue
+        arr.append((obj, importance))
+
+    arr.sort(key=synctool.overlay._sort_key)
+
+    post_dict: Dict[str, str] = {}
+    for obj, _ in arr:
+        obj.make(src_dir, dest_dir)
+
+        if obj.ov_type == synctool.overlay.OV_POST:
+            post_dict[obj.dest_path] = obj.src_path
+            continue
+
+        if obj.src_stat.is_dir():
+            if obj.dest_path not in duplicates:
+                duplicates.add(obj.dest_path)
+                callback(obj, {}, {})
+            listdir_walk(obj.src_path, obj.dest_path, duplicates, callback)
+            continue
+
+        if obj.dest_path in duplicates:
+            continue
+        duplicates.add(obj.dest_path)
+        callback(obj, {}, post_dict)
+
+
+def listdir_visit(overlay: str,
+                  callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> None:
+    '''old visit()'''
+
+    duplicates: Set[str] = set()
+    for direct in synctool.overlay._toplevel(overlay):
+        listdir_walk(direct, os.sep, duplicates, callback)
+
+
+class CountingEntry:
+    '''wraps a DirEntry to count its stat() calls'''
+
+    def __init__(self, entry: 'os.DirEntry[str]') -> None:
+        '''initialize instance'''
+
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.stat_done = False
+
+    def is_dir(self, follow_symlinks: bool = True) -> bool:
+        '''file type comes from the directory read'''
+
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks: bool = True) -> os.stat_result:
+        '''count only the first stat; DirEntry caches it'''
+
+        if not self.stat_done:
+            self.stat_done = True
+            COUNTS['stat'] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+class CountingScandir:
+    '''wraps os.scandir() to count the call and its DirEntry stats'''
+
+    def __init__(self, path: str) -> None:
+        '''initialize instance'''
+
+        COUNTS['readdir'] += 1
+        self.it_entries = ORIG_SCANDIR(path)
+
+    def __enter__(self) -> 'CountingScandir':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.it_entries.close()
+
+    def __iter__(self) -> Any:
+        return (CountingEntry(entry) for entry in self.it_entries)
+
+
+ORIG_SCANDIR = os.scandir
+ORIG_LISTDIR = os.listdir
+ORIG_LSTAT = os.lstat
+
+
+def counting_listdir(path: str) -> Any:
+    '''count os.listdir()'''
+
+    COUNTS['readdir'] += 1
+    return ORIG_LISTDIR(path)
+
+
+def counting_lstat(path: str) -> os.stat_result:
+    '''count os.lstat()'''
+
+    COUNTS['stat'] += 1
+    return ORIG_LSTAT(path)
+
+
+def count_syscalls(visit_func: Callable[..., None], overlay: str) -> Dict[str, int]:
+    '''Returns counts of directory reads and stats made by visit_func'''
+
+    COUNTS['readdir'] = COUNTS['stat'] = 0
+    os.listdir = counting_listdir                           # type: ignore
+    os.scandir = CountingScandir                            # type: ignore
+    os.lstat = counting_lstat                               # type: ignore
+    try:
+        visit_func(overlay, nop_callback)
+    finally:
+        os.listdir = ORIG_LISTDIR
+        os.scandir = ORIG_SCANDIR
+        os.lstat = ORIG_LSTAT
+    return dict(COUNTS)
+
+
+def wall_time(visit_func: Callable[..., None], overlay: str, repeat: int) -> float:
+    '''Returns best wall time of visit_func'''
+
+    best = -1.0
+    for _ in range(repeat):
+        t_start = time.monotonic()
+        visit_func(overlay, nop_callback)
+        t_spent = time.monotonic() - t_start
+        if best < 0 or t_spent < best:
+            best = t_spent
+    return best
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_entries = 200000
+    files_per_dir = 100
+    repeat = 3
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'n:f:r:')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_entries = int(arg)
+        elif opt == '-f':
+            files_per_dir = int(arg)
+        elif opt == '-r':
+            repeat = int(arg)
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making overlay tree of %d entries in %s ...' % (num_entries, topdir))
+        overlay = make_tree(topdir, num_entries, files_per_dir)
+
+        synctool.param.OVERLAY_DIR = overlay
+        synctool.param.OVERLAY_LEN = len(overlay) + 1
+        synctool.param.MY_GROUPS = ['web', 'all']
+        synctool.param.ALL_GROUPS = set(synctool.param.MY_GROUPS)
+
+        print('%-10s %10s %10s %10s %9s' % ('walk', 'readdir', 'stat',
+                                            'total', 'time'))
+        for label, visit_func in (('listdir', listdir_visit),
+                                  ('scandir', synctool.overlay.visit)):
+            counts = count_syscalls(visit_func, overlay)
+            secs = wall_time(visit_func, overlay, repeat)
+            print('%-10s %10d %10d %10d %8.2fs' % (label, counts['readdir'],
+                                                   counts['stat'],
+                                                   counts['readdir'] + counts['stat'],
+                                                   secs))
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
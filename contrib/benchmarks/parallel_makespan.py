@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+#
+#   parallel_makespan.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark synctool.parallel.do() against the old static chunking
+
+Every work item is a fake node that simply sleeps; most nodes are fast,
+a few are slow. The makespan is the wall time until the last node is done.
+
+usage: parallel_makespan.py [-N numproc] [-n nodes] [-s slow] [-d secs]
+'''
+
+import os
+import sys
+import time
+import random
+import getopt
+
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.parallel
+
+FAST_TIME = 0.01
+
+
+def fake_node(duration: float) -> None:
+    '''pretend to be running synctool on a node'''
+
+    time.sleep(duration)
+
+
+def static_do(func, work: List[float]) -> None:
+    '''the old synctool.parallel.do(): every rank does a fixed chunk'''
+
+    len_work = len(work)
+    if len_work <= synctool.param.NUM_PROC:
+        num_proc = len_work
+        part = 1
+    else:
+        num_proc = synctool.param.NUM_PROC
+        part = len_work // num_proc
+        if len_work % num_proc != 0:
+            part += 1
+
+    pids = []
+    for rank in range(num_proc):
+        pid = os.fork()
+        if pid == 0:
+            for item in work[part * rank:min(part * (rank + 1), len_work)]:
+                func(item)
+            os._exit(0)                         # pylint: disable=protected-access
+
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def makespan(do_func, work: List[float]) -> float:
+    '''Returns wall time for running all work'''
+
+    t_start = time.monotonic()
+    do_func(fake_node, work)
+    return time.monotonic() - t_start
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_proc = 8
+    num_nodes = 200
+    num_slow = 6
+    slow_time = 2.0
+
+    opts, _ = getopt.getopt(sys.argv[1:], 'N:n:s:d:')
+    for opt, arg in opts:
+        if opt == '-N':
+            num_proc = int(arg)
+        elif opt == '-n':
+            num_nodes = int(arg)
+        elif opt == '-s':
+            num_slow = int(arg)
+        elif opt == '-d':
+            slow_time = float(arg)
+
+    synctool.param.NUM_PROC = num_proc
+
+    # the slow nodes are a rack that is listed next to each other,
+    # and a couple of stragglers spread out over the range
+    work = [FAST_TIME] * num_nodes
+    rack = num_slow // 2
+    for idx in range(rack):
+        work[idx] = slow_time
+    rng = random.Random(1)
+    for idx in rng.sample(range(rack, num_nodes), num_slow - rack):
+        work[idx] = slow_time
+
+    ideal = max(max(work), sum(work) / num_proc)
+
+    print('%d nodes, %d slow nodes of %.1fs, numproc %d' %
+          (num_nodes, num_slow, slow_time, num_proc))
+    print('lower bound     : %6.2fs' % ideal)
+    print('static chunking : %6.2fs' % makespan(static_do, work))
+    print('work queue      : %6.2fs' % makespan(synctool.parallel.do, work))
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
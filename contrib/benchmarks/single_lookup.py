@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+#
+#   single_lookup.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark finding the source of a single destination path, like
+synctool-client --ref, --diff and --single do: a walk of the entire
+overlay tree against a walk that only goes where the destination
+index points to
+
+The index is timed when there is none yet, when it is up to date,
+and after a file was added to the directory of the destination.
+A lookup only checks the directories on the way to the destination.
+Each run is in a fresh process, like synctool-client, and the times
+include starting Python. The overlay tree is in the page cache.
+
+usage: single_lookup.py [-n entries] [-f files_per_dir] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import subprocess
+import tempfile
+
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.param
+import synctool.destindex
+import synctool.overlay
+
+
+def make_tree(topdir: str, num_entries: int, files_per_dir: int) -> str:
+    '''make synthetic var/overlay tree, with groups all and web
+    Returns the var dir
+    '''
+
+    var_dir = os.path.join(topdir, 'var')
+    num_dirs = max(num_entries // files_per_dir, 1)
+    for dirnum in range(num_dirs):
+        dest_dir = '/etc/d%03d/d%05d' % (dirnum // 100, dirnum)
+        dir_all = os.path.join(var_dir, 'overlay', 'all') + dest_dir
+        dir_web = os.path.join(var_dir, 'overlay', 'web') + dest_dir
+        os.makedirs(dir_all)
+        os.makedirs(dir_web)
+        for filenum in range(files_per_dir):
+            # one in five files is overridden by group web
+            if filenum % 5 == 0:
+                path = os.path.join(dir_web, 'f%04d._web' % filenum)
+            else:
+                path = os.path.join(dir_all, 'f%04d._all' % filenum)
+            with open(path, 'w', encoding='utf-8'):
+                pass
+    os.makedirs(os.path.join(var_dir, 'delete'))
+    os.makedirs(os.path.join(var_dir, 'purge'))
+    return var_dir
+
+
+def lookup(topdir: str, dest: str, use_index: bool) -> None:
+    '''find the source of dest, and print it'''
+
+    synctool.param.ROOTDIR = topdir
+    synctool.param.VAR_DIR = os.path.join(topdir, 'var')
+    synctool.param.OVERLAY_DIR = os.path.join(synctool.param.VAR_DIR,
+                                              'overlay')
+    synctool.param.OVERLAY_LEN = len(synctool.param.OVERLAY_DIR) + 1
+    synctool.param.MY_GROUPS = ['web', 'all']
+    synctool.param.ALL_GROUPS = set(synctool.param.MY_GROUPS)
+
+    only = None
+    if use_index:
+        only = synctool.destindex.sources(synctool.param.OVERLAY_DIR, [dest])
+
+    for obj, _, _ in synctool.overlay.walk(synctool.param.OVERLAY_DIR,
+                                           only=only):
+        if obj.dest_path == dest:
+            print(obj.src_path)
+            break
+
+    synctool.destindex.save()
+
+
+def run(topdir: str, dest: str, use_index: bool) -> float:
+    '''Returns wall time of a lookup in a fresh process'''
+
+    cmd = [sys.executable, __file__, '-l', topdir, dest]
+    if use_index:
+        cmd.append('index')
+    t_start = time.monotonic()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    return time.monotonic() - t_start
+
+
+def best_of(repeat: int, times: List[float]) -> str:
+    '''Returns best time, formatted'''
+
+    return '%8.3fs' % min(times[:repeat])
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_entries = 200000
+    files_per_dir = 50
+    repeat = 3
+
+    opts, args = getopt.getopt(sys.argv[1:], 'n:f:r:l')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_entries = int(arg)
+        elif opt == '-f':
+            files_per_dir = int(arg)
+        elif opt == '-r':
+            repeat = int(arg)
+        elif opt == '-l':
+            # do the lookup in this (fresh) process
+            lookup(args[0], args[1], args[2:] == ['index'])
+            return
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making overlay tree of %d entries in %s ...' % (num_entries,
+                                                              topdir))
+        make_tree(topdir, num_entries, files_per_dir)
+        num_dirs = max(num_entries // files_per_dir, 1)
+        last_dir = num_dirs - 1
+        dest = '/etc/d%03d/d%05d/f0001' % (last_dir // 100, last_dir)
+        index = os.path.join(topdir, synctool.param.DESTINDEX_FILE)
+
+        # the directories must be older than the racy window
+        time.sleep(synctool.destindex.RACY_NS / 1e9)
+
+        print('%-24s %9s' % ('lookup', 'time'))
+        times = [run(topdir, dest, False) for _ in range(repeat)]
+        print('%-24s %s' % ('full walk', best_of(repeat, times)))
+
+        times = []
+        for _ in range(repeat):
+            if os.path.exists(index):
+                os.unlink(index)
+            times.append(run(topdir, dest, True))
+        print('%-24s %s' % ('index, none yet', best_of(repeat, times)))
+
+        times = [run(topdir, dest, True) for _ in range(repeat)]
+        print('%-24s %s' % ('index, up to date', best_of(repeat, times)))
+
+        times = []
+        dir_all = os.path.join(topdir, 'var', 'overlay', 'all') + os.path.dirname(dest)
+        for num in range(repeat):
+            with open(os.path.join(dir_all, 'new%d._all' % num), 'w',
+                      encoding='utf-8'):
+                pass
+            times.append(run(topdir, dest, True))
+        print('%-24s %s' % ('index, one dir changed', best_of(repeat, times)))
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+#
+#   skip_unchanged.py
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark a run of synctool-client --fix on an up to date node,
+walking and checking the entire overlay tree against skip_unchanged,
+that skips the subtrees that did not change since the last run
+
+A synthetic overlay tree is installed in a temp directory. Each run
+is in a fresh process, like synctool-client, checks every entry it
+selects, and fixes what is out of date. With skip_unchanged, the runs
+are timed when nothing changed, and after a destination file was changed
+(only the directories on the way to it are checked again). The times
+include starting Python, and for skip_unchanged, the fingerprint of
+the overlay tree and saving the state. The trees are in the page cache.
+
+usage: skip_unchanged.py [-n entries] [-f files_per_dir] [-r repeat]
+'''
+
+import os
+import sys
+import time
+import shutil
+import getopt
+import subprocess
+import tempfile
+
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+# pylint: disable=wrong-import-position
+import synctool.lib
+import synctool.param
+import synctool.overlay
+import synctool.statedb
+from synctool.object import SyncObject
+
+
+def make_tree(topdir: str, num_entries: int, files_per_dir: int) -> None:
+    '''make synthetic var/overlay tree, with groups all and web,
+    for destinations under topdir/dest
+    '''
+
+    dest = os.path.join(topdir, 'dest')
+    num_dirs = max(num_entries // files_per_dir, 1)
+    for dirnum in range(num_dirs):
+        dest_dir = os.path.join(dest, 'd%03d' % (dirnum // 100), 'd%05d' % dirnum)
+        dir_all = os.path.join(topdir, 'var', 'overlay', 'all') + dest_dir
+        dir_web = os.path.join(topdir, 'var', 'overlay', 'web') + dest_dir
+        os.makedirs(dir_all)
+        os.makedirs(dir_web)
+        for filenum in range(files_per_dir):
+            # one in five files is overridden by group web
+            if filenum % 5 == 0:
+                path = os.path.join(dir_web, 'f%04d._web' % filenum)
+            else:
+                path = os.path.join(dir_all, 'f%04d._all' % filenum)
+            with open(path, 'w', encoding='utf-8') as fout:
+                fout.write('%s\n' % path * 4)
+    os.makedirs(os.path.join(topdir, 'var', 'delete'))
+    os.makedirs(os.path.join(topdir, 'var', 'purge'))
+
+
+def fix_run(topdir: str, skip_unchanged: bool) -> None:
+    '''check and fix all entries, like synctool-client --fix'''
+
+    synctool.param.ROOTDIR = topdir
+    synctool.param.VAR_DIR = os.path.join(topdir, 'var')
+    synctool.param.OVERLAY_DIR = os.path.join(synctool.param.VAR_DIR,
+                                              'overlay')
+    synctool.param.OVERLAY_LEN = len(synctool.param.OVERLAY_DIR) + 1
+    synctool.param.MY_GROUPS = ['web', 'all']
+    synctool.param.ALL_GROUPS = set(synctool.param.MY_GROUPS)
+    synctool.param.BACKUP_COPIES = False
+    synctool.param.SKIP_UNCHANGED = skip_unchanged
+    synctool.lib.DRY_RUN = False
+    synctool.lib.QUIET = True
+
+    def callback(obj: SyncObject, pre_dict: Dict[str, str],
+                 post_dict: Dict[str, str]) -> Tuple[bool, bool]:
+        '''check and fix entry'''
+
+        fixup = obj.check()
+        return True, obj.fix(fixup, pre_dict, post_dict)
+
+    synctool.overlay.visit(synctool.param.OVERLAY_DIR, callback,
+                           incremental=True)
+    synctool.statedb.save()
+
+
+def run(topdir: str, skip_unchanged: bool) -> float:
+    '''Returns wall time of a run in a fresh process'''
+
+    cmd = [sys.executable, __file__, '-l', topdir]
+    if skip_unchanged:
+        cmd.append('skip')
+    t_start = time.monotonic()
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    return time.monotonic() - t_start
+
+
+def best_of(times: List[float]) -> str:
+    '''Returns best time, formatted'''
+
+    return '%8.3fs' % min(times)
+
+
+def main() -> None:
+    '''run the benchmark'''
+
+    num_entries = 200000
+    files_per_dir = 50
+    repeat = 3
+
+    opts, args = getopt.getopt(sys.argv[1:], 'n:f:r:l')
+    for opt, arg in opts:
+        if opt == '-n':
+            num_entries = int(arg)
+        elif opt == '-f':
+            files_per_dir = int(arg)
+        elif opt == '-r':
+            repeat = int(arg)
+        elif opt == '-l':
+            # do the run in this (fresh) process
+            fix_run(args[0], args[1:] == ['skip'])
+            return
+
+    topdir = tempfile.mkdtemp(prefix='synctool-bench-')
+    try:
+        print('making overlay tree of %d entries in %s ...' % (num_entries,
+                                                              topdir))
+        make_tree(topdir, num_entries, files_per_dir)
+
+        print('installing ...')
+        run(topdir, False)
+        # the files must be older than the racy window
+        time.sleep(synctool.statedb.RACY_NS / 1e9)
+        # this run saves the state
+        run(topdir, True)
+
+        print('%-32s %9s' % ('run', 'time'))
+        times = [run(topdir, False) for _ in range(repeat)]
+        print('%-32s %s' % ('full walk', best_of(times)))
+
+        times = [run(topdir, True) for _ in range(repeat)]
+        print('%-32s %s' % ('skip_unchanged, up to date', best_of(times)))
+
+        times = []
+        dest = os.path.join(topdir, 'dest', 'd000', 'd00000', 'f0001')
+        for _ in range(repeat):
+            with open(dest, 'a', encoding='utf-8') as fout:
+                fout.write('changed\n')
+            times.append(run(topdir, True))
+            # next time, it is changed again
+            time.sleep(synctool.statedb.RACY_NS / 1e9)
+            run(topdir, True)
+        print('%-32s %s' % ('skip_unchanged, one file changed',
+                            best_of(times)))
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -23,9 +23,11 @@ synctool_template.py synctool_list.py"
 
 LAUNCHER="synctool_launch.py"
 
-LIBS="__init__.py aggr.py config.py configparser.py lib.py multiplex.py
-nodeset.py object.py overlay.py parallel.py param.py pkgclass.py pwdgrp.py
-range.py syncstat.py unbuffered.py update.py upload.py"
+LIBS="__init__.py aggr.py batch.py changed.py compare.py config.py
+configparser.py deferred.py destindex.py digestcache.py durable.py
+fingerprint.py lib.py multiplex.py nodeset.py object.py overlay.py
+parallel.py param.py pkgclass.py plan.py prefetch.py pwdgrp.py range.py
+statedb.py syncstat.py unbuffered.py update.py upload.py verify.py"
 
 MAIN_LIBS="__init__.py aggr.py client.py config.py master.py dsh_pkg.py
 client_pkg.py dsh_ping.py dsh_cp.py dsh.py template.py wrapper.py"
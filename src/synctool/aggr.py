@@ -10,83 +10,167 @@
 
 '''aggregate: group together output that is the same'''
 
+import os
+import sys
+import time
+import hashlib
 import subprocess
 
-from typing import List, Dict
+from typing import List, Dict, Iterable
 
+from synctool import param
 from synctool.lib import stderr
 import synctool.range
 
+# when this is set in the environment, the parallel engine
+# tells the aggregator when a node is done
+ENV_STREAM = 'SYNCTOOL_AGGREGATE'
+DONE_MARKER = '%synctool-done% '
 
-def aggregate(lines: List[str]) -> None:
-    '''group together input lines that are the same'''
 
-    lines = [x.strip() for x in lines]
-    if not lines:
-        return
+class Aggregator:
+    '''groups nodes by their output
+    Lines are fed as they come in; a node's output is put into
+    a group when the node is done, or at the end
+    '''
 
-    output_per_node: Dict[str, List[str]] = {}
+    def __init__(self, interval: float = 0) -> None:
+        '''initialize instance
+        If interval is given, the groups of the nodes that are done
+        are printed every interval seconds, rather than only at the end
+        '''
+
+        self.interval = interval
+        self.last_print = time.monotonic()
+        # output of nodes that are not done yet
+        self.output_per_node: Dict[str, List[str]] = {}
+        # groups of nodes by digest of their output
+        self.groups: Dict[bytes, List[str]] = {}
+        self.group_output: Dict[bytes, List[str]] = {}
+
+    def feed(self, line: str) -> None:
+        '''process a line of input'''
+
+        line = line.strip()
+        if line.startswith(DONE_MARKER):
+            self.node_done(line[len(DONE_MARKER):])
+            return
 
-    for line in lines:
         arr = line.split(':', 1)
         if len(arr) <= 1:
             print(line)
-            continue
+            return
 
         node = arr[0]
         output = arr[1]
 
-        if node not in output_per_node:
-            output_per_node[node] = [output, ]
+        if node not in self.output_per_node:
+            self.output_per_node[node] = [output, ]
         else:
-            output_per_node[node].append(output)
+            self.output_per_node[node].append(output)
 
-    nodes = sorted(list(output_per_node.keys()))
-    while nodes:
-        node = nodes.pop(0)
+    def node_done(self, node: str) -> None:
+        '''put the node's output into a group'''
 
-        out = output_per_node[node]
+        if node not in self.output_per_node:
+            # no output at all
+            return
 
-        nodelist = [node, ]
+        out = self.output_per_node.pop(node)
 
-        for node2 in nodes[:]:
-            if out == output_per_node[node2]:
-                nodelist.append(node2)
-                del output_per_node[node2]
-                nodes.remove(node2)
-
-        print(synctool.range.compress(nodelist) + ':')
+        hasher = hashlib.sha1()
         for line in out:
-            print(line)
+            hasher.update(line.encode('utf-8', 'surrogateescape'))
+            hasher.update(b'\n')
+        key = hasher.digest()
+
+        if key not in self.groups:
+            self.groups[key] = [node, ]
+            self.group_output[key] = out
+        else:
+            self.groups[key].append(node)
+
+        if 0 < self.interval <= time.monotonic() - self.last_print:
+            self.print_groups()
+
+    def finish(self) -> None:
+        '''the remaining nodes are done; print all groups'''
+
+        for node in list(self.output_per_node):
+            self.node_done(node)
+
+        self.print_groups()
+
+    def print_groups(self) -> None:
+        '''print the groups, and forget them'''
+
+        # sort groups by their first node, like before
+        groups = sorted((sorted(nodes), key) for key, nodes in self.groups.items())
+        for nodelist, key in groups:
+            print(synctool.range.compress(nodelist) + ':')
+            for line in self.group_output[key]:
+                print(line)
+
+        sys.stdout.flush()
+
+        self.groups = {}
+        self.group_output = {}
+        self.last_print = time.monotonic()
+
+
+def aggregate(lines: Iterable[str]) -> None:
+    '''group together input lines that are the same'''
+
+    aggr = Aggregator()
+    for line in lines:
+        aggr.feed(line)
+    aggr.finish()
+
+
+def nodes_done(nodenames: Iterable[str]) -> None:
+    '''tell the aggregator (if any) that these nodes are done'''
+
+    if ENV_STREAM not in os.environ:
+        return
+
+    sys.stdout.flush()
+    for nodename in nodenames:
+        print(DONE_MARKER + nodename)
+    sys.stdout.flush()
 
 
 def run(cmd_arr: List[str]) -> bool:
     '''pipe the output through the aggregator
+    Like before, the command is run again without --aggregate, in a
+    child process with its output on a pipe. Rather than collecting all
+    of it first, the output is consumed as it streams in: the child
+    marks the nodes that are done (see nodes_done()), so that their
+    groups can be printed every aggregate_interval seconds
     Returns False on error, else True
     '''
 
-    # simply re-run this command, but with a pipe
-
     if '-a' in cmd_arr:
         cmd_arr.remove('-a')
 
     if '--aggregate' in cmd_arr:
         cmd_arr.remove('--aggregate')
 
+    env = os.environ.copy()
+    env[ENV_STREAM] = '1'
+
+    aggr = Aggregator(param.AGGREGATE_INTERVAL)
     try:
-        completed = subprocess.run(cmd_arr, stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True, check=False)
+        with subprocess.Popen(cmd_arr, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              universal_newlines=True, env=env) as proc:
+            assert proc.stdout is not None                          # this helps mypy
+            for line in proc.stdout:
+                aggr.feed(line)
     except OSError as err:
         stderr("failed to run command {}: {}".format(cmd_arr[0], err.strerror))
         return False
 
-    if not completed.stdout:
-        return True
-
-    lines = completed.stdout.rstrip().split('\n')
-    aggregate(lines)
-
+    aggr.finish()
     return True
 
 # EOB
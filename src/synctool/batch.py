@@ -0,0 +1,260 @@
+#
+#   synctool.batch.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''rsync batch mode for synctool-master
+
+The master keeps a mirror of the repository for every group profile,
+as it was last sent to the nodes. rsync --write-batch updates the mirror
+and records the changes in a batch file, only once per profile.
+Nodes that are known to be at the previous state of the mirror get
+the batch replayed with rsync --read-batch, rather than a full rsync
+that walks and checksums the same changes all over again
+'''
+
+import os
+import shlex
+import shutil
+import hashlib
+
+from typing import Iterable, List, Optional, Sequence
+
+from synctool import param
+import synctool.lib
+from synctool.lib import verbose, error
+
+
+class Batch:
+    '''represents an rsync batch for a group profile'''
+
+    def __init__(self, key: str) -> None:
+        '''initialize instance'''
+
+        self.key = key
+        self.dirname = os.path.join(batch_dir(), key)
+        self.mirror = os.path.join(self.dirname, 'tree')
+        self.filename = os.path.join(self.dirname, 'batch')
+        # state of the mirror before and after the batch;
+        # a node can only replay the batch if it is at prev_revision
+        # The revision is the fingerprint of the repository, so it only
+        # changes when the repository changes
+        self.prev_revision = ''
+        self.revision = ''
+        # the filter rules that the batch was written with;
+        # replaying the batch needs the same rules on the node
+        self.filter_rules: List[str] = []
+
+    def write(self, filter_file: str, revision: str) -> bool:
+        '''update the mirror to revision and write the batch file
+        Returns False on error
+        '''
+
+        try:
+            os.makedirs(self.mirror, 0o750, exist_ok=True)
+        except OSError as err:
+            error('failed to create directory %s: %s' % (self.mirror,
+                                                         err.strerror))
+            return False
+
+        try:
+            with open(filter_file, 'r', encoding='utf-8') as ffilter:
+                self.filter_rules = [line.strip() for line in ffilter
+                                     if line.strip() and line[0] != '#']
+        except OSError as err:
+            error('failed to read %s: %s' % (filter_file, err.strerror))
+            return False
+
+        self.prev_revision = self._read_revision()
+        # the mirror is in an unknown state until the batch is written
+        self._write_revision('')
+
+        cmd_arr = shlex.split(param.RSYNC_CMD)
+        cmd_arr.append('--filter=. %s' % filter_file)
+        cmd_arr.append('--write-batch=%s' % self.filename)
+        cmd_arr.append('--')
+        cmd_arr.append('%s/' % param.ROOTDIR)
+        cmd_arr.append('%s/' % self.mirror)
+
+        verbose('writing rsync batch %s' % self.key)
+        exitcode = synctool.lib.exec_command(cmd_arr)
+
+        # rsync also writes a shell script for replaying the batch
+        # we don't need it; read_cmd() passes the filter rules itself
+        try:
+            os.unlink(self.filename + '.sh')
+        except OSError:
+            pass
+
+        if exitcode != 0:
+            error('failed to write rsync batch for %s' % self.key)
+            self.prev_revision = ''
+            return False
+
+        self.revision = revision
+        return self._write_revision(self.revision)
+
+    def read_cmd(self, ssh_cmd_arr: List[str], addr: str) -> List[str]:
+        '''Returns command that replays the batch on the node
+        The batch file is read from stdin
+        The filter rules go along, or else --delete in the batch would
+        delete what the filter excludes or protects, like the state files
+        on the node
+        rsync_cmd is resolved to a full path on the master, which may not
+        be where it is on the node; like the receiving side of a normal
+        rsync run, rsync is found in the PATH of the node
+        '''
+
+        rsync_cmd_arr = shlex.split(param.RSYNC_CMD)
+        rsync_cmd_arr[0] = os.path.basename(rsync_cmd_arr[0])
+        rsync_cmd_arr.extend(['--filter=%s' % rule for rule in self.filter_rules])
+
+        cmd_arr = ssh_cmd_arr[:]
+        cmd_arr.append('--')
+        cmd_arr.append(addr)
+        # the remote shell splits the command line again
+        cmd_arr.extend([shlex.quote(arg) for arg in rsync_cmd_arr])
+        cmd_arr.append('--read-batch=-')
+        cmd_arr.append('%s/' % param.ROOTDIR)
+        return cmd_arr
+
+    def matches(self, nodename: str) -> bool:
+        '''Returns True if the node is at the state that
+        the batch was made against
+        '''
+
+        if not self.prev_revision:
+            return False
+
+        state = '%s %s' % (self.key, self.prev_revision)
+        return _read_node_state(nodename) == state
+
+    def record(self, nodename: str) -> None:
+        '''record that the node is now at the state of the mirror'''
+
+        if self.revision:
+            _write_node_state(nodename, '%s %s' % (self.key, self.revision))
+        else:
+            forget(nodename)
+
+    def _read_revision(self) -> str:
+        '''Returns revision of the mirror, or empty string if unknown'''
+
+        try:
+            with open(os.path.join(self.dirname, 'revision'), 'r',
+                      encoding='utf-8') as frev:
+                return frev.readline().strip()
+        except OSError:
+            return ''
+
+    def _write_revision(self, revision: str) -> bool:
+        '''write revision of the mirror
+        Returns False on error
+        '''
+
+        filename = os.path.join(self.dirname, 'revision')
+        try:
+            with open(filename, 'w', encoding='utf-8') as frev:
+                frev.write(revision + '\n')
+        except OSError as err:
+            error('failed to write %s: %s' % (filename, err.strerror))
+            return False
+
+        return True
+
+
+def batch_dir() -> str:
+    '''Returns directory where the batches and mirrors are kept'''
+
+    return os.path.join(param.TEMP_DIR, 'batch')
+
+
+def profile_key(groups: Optional[Sequence[str]]) -> str:
+    '''Returns name for a group profile, that is safe to use as filename
+    A profile of None means the full repository (for slave nodes)
+    '''
+
+    if groups is None:
+        return 'slave'
+
+    digest = hashlib.sha1(' '.join(groups).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def prune(keys: Iterable[str]) -> None:
+    '''delete the batches and mirrors of profiles other than keys;
+    no node has those profiles anymore
+    '''
+
+    keep = set(keys)
+    keep.add('nodes')
+
+    try:
+        names = os.listdir(batch_dir())
+    except OSError:
+        return
+
+    for name in names:
+        if name in keep:
+            continue
+
+        path = os.path.join(batch_dir(), name)
+        if not os.path.isdir(path):
+            continue
+
+        verbose('deleting rsync batch %s' % name)
+        try:
+            shutil.rmtree(path)
+        except OSError as err:
+            error('failed to delete %s: %s' % (path, err.strerror))
+
+
+def forget(nodename: str) -> None:
+    '''forget the state of the node
+    It will have to do a full rsync next time
+    '''
+
+    try:
+        os.unlink(_node_state_file(nodename))
+    except OSError:
+        pass
+
+
+def _node_state_file(nodename: str) -> str:
+    '''Returns path of the file that holds the state of the node'''
+
+    return os.path.join(batch_dir(), 'nodes', nodename)
+
+
+def _read_node_state(nodename: str) -> str:
+    '''Returns state of the node as "key revision",
+    or empty string if unknown
+    '''
+
+    try:
+        with open(_node_state_file(nodename), 'r', encoding='utf-8') as fstate:
+            return fstate.readline().strip()
+    except OSError:
+        return ''
+
+
+def _write_node_state(nodename: str, state: str) -> None:
+    '''record state of the node'''
+
+    filename = _node_state_file(nodename)
+    try:
+        os.makedirs(os.path.dirname(filename), 0o750, exist_ok=True)
+        # write it atomically; the node may be checked from another process
+        tmp_filename = '%s.%d' % (filename, os.getpid())
+        with open(tmp_filename, 'w', encoding='utf-8') as fstate:
+            fstate.write(state + '\n')
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        error('failed to write %s: %s' % (filename, err.strerror))
+
+# EOB
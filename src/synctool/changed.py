@@ -0,0 +1,164 @@
+#
+#   synctool.changed.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''affected-nodes mode for synctool-master
+
+The baseline holds the fingerprints of the overlay/, delete/ and purge/
+dirs of every group, as they were at the last --changed or --baseline run.
+synctool-master --changed only contacts the nodes that are in a group
+that changed since the baseline. If anything else in the repository
+changed, all nodes are affected. Slave nodes get a copy of the entire
+repository, so they are affected by any change.
+Nodes that failed are pending; they are contacted again by the next
+--changed run. The baseline and the pending nodes are kept in
+$SYNCTOOL/var/changed, so that they survive a reboot
+'''
+
+import os
+
+from typing import Dict, Optional, Set
+
+from synctool import config, param
+import synctool.fingerprint
+from synctool.lib import verbose, error
+
+# key in the fingerprints dict for everything outside the group dirs
+BASE = ''
+
+
+def state_dir() -> str:
+    '''Returns directory where the baseline is kept'''
+
+    return os.path.join(param.ROOTDIR, param.CHANGED_DIR)
+
+
+def fingerprints() -> Dict[str, str]:
+    '''Returns dict of current fingerprints by group
+    The BASE key holds the fingerprint of the rest of the repository
+    '''
+
+    groups = param.ALL_GROUPS | set(synctool.fingerprint.repo_groups())
+
+    current = {BASE: synctool.fingerprint.base_fingerprint()}
+    for group in groups:
+        current[group] = synctool.fingerprint.group_fingerprint(group)
+
+    return current
+
+
+def affected_nodes(current: Dict[str, str]) -> Optional[Set[str]]:
+    '''Returns set of nodes that are affected by changes since
+    the baseline, including pending nodes
+    Returns None if all nodes are affected
+    '''
+
+    baseline = _load_baseline()
+    if baseline is None:
+        verbose('no baseline; all nodes are affected')
+        return None
+
+    if baseline.get(BASE) != current[BASE]:
+        verbose('repository changed outside the group dirs; '
+                'all nodes are affected')
+        return None
+
+    changed = set()
+    for group in set(baseline) | set(current):
+        if baseline.get(group) != current.get(group):
+            verbose('group %s changed' % group)
+            changed.add(group)
+
+    changed.discard(BASE)
+
+    nodes = config.get_nodes_in_groups(changed)
+    # a node is a group, too
+    nodes |= changed & set(param.NODES)
+    if changed:
+        # slave nodes have all groups
+        nodes |= param.SLAVES
+    return nodes | pending_nodes()
+
+
+def save_baseline(current: Dict[str, str]) -> None:
+    '''write the fingerprints as the new baseline'''
+
+    filename = os.path.join(state_dir(), 'baseline')
+    try:
+        os.makedirs(state_dir(), 0o750, exist_ok=True)
+        # write it atomically; a broken baseline would affect too few nodes
+        tmp_filename = '%s.%d' % (filename, os.getpid())
+        with open(tmp_filename, 'w', encoding='utf-8') as fbase:
+            fbase.write('base %s\n' % current[BASE])
+            for group in sorted(current):
+                if group != BASE:
+                    fbase.write('group %s %s\n' % (group, current[group]))
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        error('failed to write %s: %s' % (filename, err.strerror))
+        return
+
+    verbose('saved baseline for %d groups' % (len(current) - 1))
+
+
+def _load_baseline() -> Optional[Dict[str, str]]:
+    '''Returns dict of fingerprints by group, as saved in the baseline
+    or None if there is no (valid) baseline
+    '''
+
+    filename = os.path.join(state_dir(), 'baseline')
+    baseline = {}
+    try:
+        with open(filename, 'r', encoding='utf-8') as fbase:
+            for line in fbase:
+                arr = line.split()
+                if len(arr) == 2 and arr[0] == 'base':
+                    baseline[BASE] = arr[1]
+                elif len(arr) == 3 and arr[0] == 'group':
+                    baseline[arr[1]] = arr[2]
+                else:
+                    error('%s: invalid line, ignoring baseline' % filename)
+                    return None
+    except OSError:
+        return None
+
+    if BASE not in baseline:
+        return None
+
+    return baseline
+
+
+def pending_nodes() -> Set[str]:
+    '''Returns set of nodes that failed since the baseline'''
+
+    try:
+        return set(os.listdir(os.path.join(state_dir(), 'pending')))
+    except OSError:
+        return set()
+
+
+def mark_pending(nodename: str, pending: bool) -> None:
+    '''mark node as pending (or not)'''
+
+    filename = os.path.join(state_dir(), 'pending', nodename)
+    if not pending:
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+        return
+
+    try:
+        os.makedirs(os.path.dirname(filename), 0o750, exist_ok=True)
+        with open(filename, 'w', encoding='utf-8'):
+            pass
+    except OSError as err:
+        error('failed to write %s: %s' % (filename, err.strerror))
+
+# EOB
@@ -0,0 +1,167 @@
+#
+#   synctool.compare.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''compare the contents of files
+
+This prints nothing, so it may run in a thread; see synctool.prefetch
+'''
+
+import io
+import hashlib
+import threading
+
+from typing import Optional, Tuple
+
+import synctool.digestcache
+import synctool.param
+
+# size for doing I/O while comparing files
+IO_SIZE = 128 * 1024
+
+# reusable buffers for comparing files, per thread
+_IO_BUFFERS = threading.local()
+
+
+def _io_buffers() -> Tuple[bytearray, bytearray]:
+    '''Returns pair of buffers for comparing files
+    Every thread has its own buffers
+    '''
+
+    try:
+        return _IO_BUFFERS.pair
+    except AttributeError:
+        _IO_BUFFERS.pair = (bytearray(IO_SIZE), bytearray(IO_SIZE))
+        return _IO_BUFFERS.pair
+
+
+def _read_chunk(fio: io.RawIOBase, buf: bytearray) -> int:
+    '''read into buf until it is full, or the end of file is reached
+    Returns number of bytes read
+    May raise OSError
+    '''
+
+    view = memoryview(buf)
+    total = 0
+    while total < IO_SIZE:
+        num = fio.readinto(view[total:])
+        if not num:
+            break
+        total += num
+
+    return total
+
+
+def compare_contents(src_path: str, dest_path: str) -> Tuple[bool, str]:
+    '''compare the contents of two files of the same size
+    Returns pair: True if the same, error message (if any)
+    This prints nothing, so it may run in a thread
+    '''
+
+    # the digest of a file in the overlay tree may be cached,
+    # so that only the destination file needs to be read
+    cache_key = None
+    if synctool.digestcache.is_cached_path(src_path):
+        cache_key = synctool.digestcache.file_key(src_path)
+        if cache_key is not None:
+            cached_digest = synctool.digestcache.lookup(cache_key)
+            if cached_digest is not None:
+                return _compare_digest(dest_path, cached_digest)
+
+    # the files are compared directly, chunk by chunk
+    # The source is only hashed when its digest is going to be cached
+    hasher = None
+    if cache_key is not None:
+        hasher = hashlib.new(synctool.param.DIGEST_ALGORITHM)
+
+    try:
+        ffile1 = open(src_path, 'rb', buffering=0)
+    except OSError as err:
+        # return True because we can't fix an error in src_path
+        return True, 'failed to open %s : %s' % (src_path, err.strerror)
+
+    with ffile1:
+        try:
+            ffile2 = open(dest_path, 'rb', buffering=0)
+        except OSError as err:
+            return False, 'failed to open %s : %s' % (dest_path, err.strerror)
+
+        with ffile2:
+            same, errmsg = _compare_chunks(ffile1, src_path, ffile2, dest_path, hasher)
+
+    if same and not errmsg and hasher is not None and cache_key is not None:
+        # the source file was read entirely
+        synctool.digestcache.store(cache_key, hasher.digest())
+    return same, errmsg
+
+
+def _compare_chunks(ffile1: io.RawIOBase, src_path: str,
+                    ffile2: io.RawIOBase, dest_path: str,
+                    hasher: Optional['hashlib._Hash']) -> Tuple[bool, str]:
+    '''compare the open files chunk by chunk, until they differ
+    If hasher is given, the source is hashed along the way
+    Returns pair: True if the same, error message (if any)
+    '''
+
+    buf1, buf2 = _io_buffers()
+
+    while True:
+        try:
+            len1 = _read_chunk(ffile1, buf1)
+        except OSError as err:
+            return False, 'failed to read file %s: %s' % (src_path, err.strerror)
+
+        try:
+            len2 = _read_chunk(ffile2, buf2)
+        except OSError as err:
+            return False, 'failed to read file %s: %s' % (dest_path, err.strerror)
+
+        if len1 != len2:
+            # the size changed while we were reading
+            return False, ''
+
+        if len1 == IO_SIZE:
+            # comparing the whole buffers avoids a copy
+            same = buf1 == buf2
+        else:
+            same = buf1[:len1] == buf2[:len2]
+
+        if not same:
+            # no need to read any further
+            return False, ''
+
+        if hasher is not None:
+            hasher.update(memoryview(buf1)[:len1])
+
+        if len1 < IO_SIZE:
+            return True, ''
+
+
+def _compare_digest(dest_path: str, digest: bytes) -> Tuple[bool, str]:
+    '''compare digest of dest_path against digest
+    Returns pair: True if the same, error message (if any)
+    '''
+
+    hasher = hashlib.new(synctool.param.DIGEST_ALGORITHM)
+    buf, _ = _io_buffers()
+    view = memoryview(buf)
+
+    try:
+        with open(dest_path, 'rb', buffering=0) as ffile2:
+            while True:
+                len2 = _read_chunk(ffile2, buf)
+                hasher.update(view[:len2])
+                if len2 < IO_SIZE:
+                    break
+    except OSError as err:
+        return False, 'failed to read file %s: %s' % (dest_path, err.strerror)
+
+    return hasher.digest() == digest, ''
+
+# EOB
@@ -64,6 +64,10 @@ def read_config() -> None:
         synctool.param.PKG_CMD = os.path.join(synctool.param.ROOTDIR,
                                               'bin', 'synctool-client-pkg')
 
+    if not synctool.param.RELAY_CMD:
+        synctool.param.RELAY_CMD = os.path.join(synctool.param.ROOTDIR,
+                                                'bin', 'synctool')
+
     # check master node
     if not synctool.param.MASTER:
         error("'master' is not configured")
@@ -93,6 +97,12 @@ def read_config() -> None:
     # initialize ALL_GROUPS
     synctool.param.ALL_GROUPS = make_all_groups()
 
+    for relay, groups in synctool.param.RELAYS.items():
+        for group in groups:
+            if group not in synctool.param.ALL_GROUPS:
+                error("relay '%s': no such group or node '%s'" % (relay, group))
+                errors += 1
+
     if errors > 0:
         sys.exit(-1)
 
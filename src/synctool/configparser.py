@@ -373,6 +373,89 @@ def config_sync_times(arr: List[str], configfile: str, lineno: int) -> int:
     return err
 
 
+def config_check_threads(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: check_threads'''
+
+    err, param.CHECK_THREADS = _config_non_negative('check_threads', arr[1],
+                                                    configfile, lineno)
+    return err
+
+
+def config_post_num_proc(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: post_num_proc'''
+
+    err, param.POST_NUM_PROC = _config_non_negative('post_num_proc', arr[1],
+                                                    configfile, lineno)
+    return err
+
+
+def config_durable_writes(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: durable_writes'''
+
+    err, param.DURABLE_WRITES = _config_boolean('durable_writes', arr[1],
+                                                configfile, lineno)
+    return err
+
+
+def config_trust_mtime(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: trust_mtime'''
+
+    err, param.TRUST_MTIME = _config_boolean('trust_mtime', arr[1], configfile,
+                                             lineno)
+    return err
+
+
+def config_deep_verify_interval(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: deep_verify_interval'''
+
+    err, param.DEEP_VERIFY_INTERVAL = _config_non_negative('deep_verify_interval',
+                                                           arr[1], configfile,
+                                                           lineno)
+    return err
+
+
+def config_deep_verify_sample(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: deep_verify_sample'''
+
+    err, param.DEEP_VERIFY_SAMPLE = _config_non_negative('deep_verify_sample',
+                                                         arr[1], configfile,
+                                                         lineno)
+    return err
+
+
+def config_skip_unchanged(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: skip_unchanged'''
+
+    err, param.SKIP_UNCHANGED = _config_boolean('skip_unchanged', arr[1],
+                                                configfile, lineno)
+    return err
+
+
+def config_full_run_interval(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: full_run_interval'''
+
+    err, param.FULL_RUN_INTERVAL = _config_non_negative('full_run_interval',
+                                                        arr[1], configfile,
+                                                        lineno)
+    return err
+
+
+def config_rsync_batch(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: rsync_batch'''
+
+    err, param.RSYNC_BATCH = _config_boolean('rsync_batch', arr[1], configfile,
+                                             lineno)
+    return err
+
+
+def config_rsync_fingerprint(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: rsync_fingerprint'''
+
+    err, param.RSYNC_FINGERPRINT = _config_boolean('rsync_fingerprint', arr[1],
+                                                   configfile, lineno)
+    return err
+
+
 def config_ignore_dotfiles(arr: List[str], configfile: str, lineno: int) -> int:
     '''parse keyword: ignore_dotfiles'''
 
@@ -656,6 +739,38 @@ def config_slave(arr: List[str], configfile: str, lineno: int) -> int:
     return 0
 
 
+def config_relay(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: relay'''
+
+    if len(arr) < 3:
+        stderr("%s:%d: 'relay' requires at least two arguments: "
+               "a nodename, and the groups or nodes that it serves" %
+               (configfile, lineno))
+        return 1
+
+    relay = arr[1]
+    if relay in param.RELAYS:
+        stderr("%s:%d: relay '%s' already defined" % (configfile, lineno, relay))
+        return 1
+
+    # a relay is a slave, it gets a copy of the entire tree
+    if config_slave(arr[:2], configfile, lineno) != 0:
+        return 1
+
+    groups = []
+    for group in arr[2:]:
+        if not spellcheck(group):
+            stderr("%s:%d: invalid group name '%s'" %
+                   (configfile, lineno, group))
+            return 1
+
+        groups.append(group)
+
+    # check for valid groups is made later
+    param.RELAYS[relay] = groups
+    return 0
+
+
 def config_group(arr: List[str], configfile: str, lineno: int) -> int:
     '''parse keyword: group'''
 
@@ -1013,6 +1128,15 @@ def config_synctool_cmd(arr: List[str], configfile: str, lineno: int) -> int:
     return err
 
 
+def config_relay_cmd(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: relay_cmd'''
+
+    err, param.RELAY_CMD = _config_command('relay_cmd', arr,
+                                           'synctool_master.py', configfile,
+                                           lineno)
+    return err
+
+
 def config_pkg_cmd(arr: List[str], configfile: str, lineno: int) -> int:
     '''parse keyword: pkg_cmd'''
 
@@ -1034,6 +1158,105 @@ def config_num_proc(arr: List[str], configfile: str, lineno: int) -> int:
     return err
 
 
+def _config_non_negative(label: str, value: str, configfile: str, lineno: int) -> Tuple[int, int]:
+    '''helper for configuring a number that may be 0, but not negative
+    (like a timeout in seconds, where 0 means no timeout)
+    '''
+
+    err, nvalue = _config_integer(label, value, configfile, lineno)
+
+    if not err and nvalue < 0:
+        stderr("%s:%d: invalid argument for %s" % (configfile, lineno, label))
+        return 1, 0
+
+    return err, nvalue
+
+
+def config_aggregate_interval(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: aggregate_interval'''
+
+    err, param.AGGREGATE_INTERVAL = _config_non_negative('aggregate_interval',
+                                                         arr[1], configfile,
+                                                         lineno)
+    return err
+
+
+def config_rsync_num_proc(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: rsync_num_proc'''
+
+    err, param.RSYNC_NUM_PROC = _config_non_negative('rsync_num_proc', arr[1],
+                                                     configfile, lineno)
+    return err
+
+
+def config_ssh_num_proc(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: ssh_num_proc'''
+
+    err, param.SSH_NUM_PROC = _config_non_negative('ssh_num_proc', arr[1],
+                                                   configfile, lineno)
+    return err
+
+
+def config_parallel_engine(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: parallel_engine'''
+
+    if len(arr) != 2:
+        stderr("%s:%d: 'parallel_engine' requires a single argument" %
+               (configfile, lineno))
+        return 1
+
+    engine = arr[1].lower()
+    if engine not in param.KNOWN_PARALLEL_ENGINES:
+        stderr("%s:%d: unknown parallel engine '%s'" %
+               (configfile, lineno, arr[1]))
+        return 1
+
+    param.PARALLEL_ENGINE = engine
+    return 0
+
+
+def config_digest_algorithm(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: digest_algorithm'''
+
+    if len(arr) != 2:
+        stderr("%s:%d: 'digest_algorithm' requires a single argument" %
+               (configfile, lineno))
+        return 1
+
+    algorithm = arr[1].lower()
+    if algorithm not in param.KNOWN_DIGEST_ALGORITHMS:
+        stderr("%s:%d: unknown digest algorithm '%s'" %
+               (configfile, lineno, arr[1]))
+        return 1
+
+    param.DIGEST_ALGORITHM = algorithm
+    return 0
+
+
+def config_node_timeout(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: node_timeout'''
+
+    err, param.NODE_TIMEOUT = _config_non_negative('node_timeout', arr[1],
+                                                   configfile, lineno)
+    return err
+
+
+def config_rsync_timeout(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: rsync_timeout'''
+
+    err, param.RSYNC_TIMEOUT = _config_non_negative('rsync_timeout', arr[1],
+                                                    configfile, lineno)
+    return err
+
+
+def config_ssh_timeout(arr: List[str], configfile: str, lineno: int) -> int:
+    '''parse keyword: ssh_timeout'''
+
+    err, param.SSH_TIMEOUT = _config_non_negative('ssh_timeout', arr[1],
+                                                  configfile, lineno)
+    return err
+
+
 def expand_grouplist(grouplist: List[str]) -> List[str]:
     '''expand a list of (compound) groups recursively
     Returns the expanded group list
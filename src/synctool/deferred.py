@@ -0,0 +1,198 @@
+#
+#   synctool.deferred.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''post_num_proc: run .post scripts after the overlay walk, in parallel
+
+Normally a .post script runs right after its file was updated, and
+the walk waits for it. With post_num_proc set, the .post scripts are
+queued instead, and run when the walk is done, post_num_proc at a time.
+The same script for the same directory runs only once.
+The .post script of a directory runs only after all scripts for
+entries below that directory have finished.
+The output of each script is collected, and printed when it is done,
+so that the output of scripts running at the same time is not mixed up
+'''
+
+import os
+import sys
+import shlex
+import subprocess
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Tuple
+
+from synctool import param
+import synctool.durable
+import synctool.lib
+from synctool.lib import verbose, stdout, error, terse, unix_out, prettypath
+
+
+class Job:
+    '''a queued .post script'''
+
+    def __init__(self, script: str, run_dir: str, path: str, is_dir: bool) -> None:
+        '''initialize instance
+        path is the destination that the script is for
+        '''
+
+        self.script = script
+        self.run_dir = run_dir
+        self.path = path
+        self.is_dir = is_dir
+
+    def __repr__(self) -> str:
+        '''return string representation'''
+
+        return '[<Job>: %s (%s)]' % (self.script, self.run_dir)
+
+    def is_below(self, other: 'Job') -> bool:
+        '''Returns True if this job is for an entry below directory
+        job other
+        '''
+
+        if not other.is_dir or self is other:
+            return False
+
+        return self.path.startswith(other.path.rstrip(os.sep) + os.sep)
+
+
+# scripts in the order they were queued
+_QUEUE: List[Job] = []
+# (script, run_dir) of queued jobs
+_QUEUED: Dict[Tuple[str, str], Job] = {}
+
+
+def enabled() -> bool:
+    '''Returns True if .post scripts are run after the walk'''
+
+    return param.POST_NUM_PROC > 0 and not synctool.lib.DRY_RUN
+
+
+def add(script: str, run_dir: str, path: str, is_dir: bool) -> None:
+    '''queue a .post script'''
+
+    key = (script, run_dir)
+    job = _QUEUED.get(key)
+    if job is not None:
+        verbose('script %s is already queued' % prettypath(script))
+        if is_dir and not job.is_dir:
+            # it must wait for the entries below this directory, too
+            job.path = path
+            job.is_dir = True
+        return
+
+    job = Job(script, run_dir, path, is_dir)
+    _QUEUE.append(job)
+    _QUEUED[key] = job
+
+
+def run() -> None:
+    '''run all queued .post scripts'''
+
+    if not _QUEUE:
+        return
+
+    pending = _QUEUE[:]
+    _QUEUE.clear()
+    _QUEUED.clear()
+
+    verbose('running %d .post scripts, %d at a time' %
+            (len(pending), param.POST_NUM_PROC))
+
+    # the scripts get to see the installed files as they
+    # would be after a crash
+    synctool.durable.flush()
+
+    # the scripts run with the umask set by the sysadmin
+    os.umask(param.ORIG_UMASK)
+
+    running: Dict['Future[Tuple[int, bytes]]', Job] = {}
+    with ThreadPoolExecutor(max_workers=param.POST_NUM_PROC,
+                            thread_name_prefix='synctool-post') as pool:
+        while pending or running:
+            for job in pending[:]:
+                if len(running) >= param.POST_NUM_PROC:
+                    break
+
+                if any(other.is_below(job)
+                       for other in pending + list(running.values())):
+                    # wait for the scripts below this directory
+                    continue
+
+                pending.remove(job)
+                if _runnable(job):
+                    unix_out('cd %s' % job.run_dir)
+                    unix_out(job.script)
+                    running[pool.submit(_run_job, job)] = job
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                _report(running.pop(future), future.result())
+
+    os.umask(0o77)
+
+
+def _runnable(job: Job) -> bool:
+    '''Returns True if the script can be run'''
+
+    cmdfile = shlex.split(job.script)[0]
+    if not os.path.isfile(cmdfile):
+        error('command %s not found' % prettypath(cmdfile))
+        return False
+
+    if not os.access(cmdfile, os.X_OK):
+        error("file '%s' is not executable" % prettypath(cmdfile))
+        return False
+
+    return True
+
+
+def _run_job(job: Job) -> Tuple[int, bytes]:
+    '''run script of job
+    Runs in a thread
+    Returns exit code and output
+    '''
+
+    try:
+        completed = subprocess.run(shlex.split(job.script), cwd=job.run_dir,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, check=False)
+    except OSError as err:
+        return -1, ('%s: %s\n' % (job.run_dir, err.strerror)).encode()
+
+    return completed.returncode, completed.stdout
+
+
+def _report(job: Job, result: Tuple[int, bytes]) -> None:
+    '''print the outcome of a script'''
+
+    ret, output = result
+
+    if not synctool.lib.QUIET:
+        stdout('running command %s' % prettypath(job.script))
+    verbose('  os.chdir(%s)' % job.run_dir)
+    terse(synctool.lib.TERSE_EXEC, shlex.split(job.script)[0])
+
+    if ret == -1:
+        error("failed to run shell command '%s' : %s" %
+              (prettypath(job.script), output.decode(errors='replace').strip()))
+        return
+
+    if output:
+        sys.stdout.flush()
+        sys.stdout.write(output.decode(errors='replace'))
+        sys.stdout.flush()
+
+    verbose('exit code %d' % ret)
+
+# EOB
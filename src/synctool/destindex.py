@@ -0,0 +1,348 @@
+#
+#   synctool.destindex.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''persistent index of the overlay tree, by destination path
+
+--single, --ref, --diff and --upload look for the sources of only
+a few destination paths. Rather than walking the entire overlay tree,
+they look up the candidate sources in this index, and the walk only
+descends into the directories that lead to them.
+
+The index holds the names in every directory of the overlay tree,
+and the mtime of the directory. A lookup goes down the destination path
+in the index; only the directories on the way are stat'ed, and read
+again if their mtime changed. Names are mapped to destinations without
+regard to groups: the group extension is simply cut off. So the same
+index serves any node; it is the walk that picks the most important
+source among the candidates, like it always does.
+The index is kept in $SYNCTOOL/var/destindex
+'''
+
+import os
+import json
+import time
+
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from synctool import param
+from synctool.lib import verbose, terse_match
+import synctool.overlay
+
+# version of the index file format
+INDEX_VERSION = 1
+
+# a directory that changed this recently may change again without
+# a different mtime, on filesystems with coarse timestamps.
+# It is read again the next time
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+# directory under var/ -> (mtime_ns, names of subdirs, names of other entries)
+DirInfo = Tuple[int, List[str], List[str]]
+
+# (source dir, key in the index, destination dir)
+Level = List[Tuple[str, str, str]]
+
+_DIRS: Optional[Dict[str, DirInfo]] = None
+_DIRTY = False
+# start of the run; for spotting racy directories
+_START_NS = 0
+# directories that were checked in this run
+_CHECKED: Set[str] = set()
+
+
+def index_file() -> str:
+    '''Returns path of the index file'''
+
+    return os.path.join(param.ROOTDIR, param.DESTINDEX_FILE)
+
+
+def sources(tree: str, paths: Sequence[str]) -> Set[str]:
+    '''Returns set of source paths in tree (OVERLAY_DIR or DELETE_DIR)
+    that the (terse) destination paths may come from, together with
+    the directories that lead to them
+    '''
+
+    global _START_NS                                        # pylint: disable=global-statement
+
+    if _DIRS is None:
+        _START_NS = time.time_ns()
+        _load()
+
+    found: Set[str] = set()
+    for path in paths:
+        for src_path in _find(tree, path):
+            while src_path != tree and src_path not in found:
+                found.add(src_path)
+                src_path = os.path.dirname(src_path)
+    return found
+
+
+def dest_name(name: str) -> Optional[str]:
+    '''Returns destination name for name in the overlay tree,
+    whatever the groups. Returns None for .pre and .post scripts
+    '''
+
+    (base, ext) = os.path.splitext(name)
+    if ext in ('.pre', '.post'):
+        return None
+
+    if ext[:2] != '._' or ext == '._':
+        return name
+
+    if ext == '._template':
+        return base
+
+    # it has a group extension
+    (base2, ext) = os.path.splitext(base)
+    if ext in ('.pre', '.post'):
+        return None
+
+    if ext == '._template':
+        return base2
+
+    return base
+
+
+def _find(tree: str, path: str) -> List[str]:
+    '''Returns list of source paths for (terse) destination path'''
+
+    top = os.path.relpath(tree, param.VAR_DIR)
+    info = _dir_info(tree, top)
+    if info is None:
+        return []
+
+    # the group directories map onto the root directory
+    level = [(os.path.join(tree, group), os.path.join(top, group), os.sep)
+             for group in info[1]]
+
+    if path[:2] == os.sep + os.sep:
+        # terse path
+        idx = path.find(os.sep + '...' + os.sep)
+        if idx == -1:
+            # a very short terse path
+            path = path[1:]
+        else:
+            # go down to where the terse path is cut,
+            # and search everything below it
+            prefix = path[1:idx + 1]
+            parts = [part for part in prefix.split(os.sep) if part]
+            level = _descend(level, parts)
+            return _search(level, path)
+
+    parts = [part for part in path.split(os.sep) if part]
+    if not parts:
+        return []
+
+    level = _descend(level, parts[:-1])
+    found = []
+    for src_dir, key, _ in level:
+        info = _dir_info(src_dir, key)
+        if info is None:
+            continue
+
+        for name in info[1] + info[2]:
+            if dest_name(name) == parts[-1]:
+                found.append(os.path.join(src_dir, name))
+    return found
+
+
+def _descend(level: Level, parts: List[str]) -> Level:
+    '''Returns the source dirs that the destination dirs in parts
+    map onto, going down from level
+    '''
+
+    for part in parts:
+        next_level = []
+        for src_dir, key, dest_dir in level:
+            info = _dir_info(src_dir, key)
+            if info is None:
+                continue
+
+            for name in info[1]:
+                if dest_name(name) == part:
+                    next_level.append((os.path.join(src_dir, name),
+                                       os.path.join(key, name),
+                                       os.path.join(dest_dir, part)))
+        level = next_level
+    return level
+
+
+def _search(level: Level, terse_path: str) -> List[str]:
+    '''Returns list of source paths below level that map onto
+    destinations that terse_path matches
+    '''
+
+    found = []
+    while level:
+        src_dir, key, dest_dir = level.pop()
+        info = _dir_info(src_dir, key)
+        if info is None:
+            continue
+
+        for name in info[1] + info[2]:
+            dest = dest_name(name)
+            if dest is None:
+                continue
+
+            if terse_match(terse_path, os.path.join(dest_dir, dest)):
+                found.append(os.path.join(src_dir, name))
+
+        for name in info[1]:
+            dest = dest_name(name)
+            if dest is not None:
+                level.append((os.path.join(src_dir, name),
+                              os.path.join(key, name),
+                              os.path.join(dest_dir, dest)))
+    return found
+
+
+def _dir_info(path: str, key: str) -> Optional[DirInfo]:
+    '''Returns the names in directory path, or None on error
+    They come from the index, unless the directory changed
+    '''
+
+    global _DIRTY                                           # pylint: disable=global-statement
+
+    assert _DIRS is not None                                # this helps mypy
+
+    info = _DIRS.get(key)
+    if key in _CHECKED:
+        return info
+
+    _CHECKED.add(key)
+
+    try:
+        statbuf = os.stat(path)
+    except OSError:
+        if info is not None:
+            _forget(key)
+        return None
+
+    if info is not None and info[0] == statbuf.st_mtime_ns:
+        return info
+
+    subdirs = []
+    names = []
+    try:
+        with os.scandir(path) as it_entries:
+            for entry in it_entries:
+                if synctool.overlay.ignored(entry.name):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                else:
+                    names.append(entry.name)
+    except OSError:
+        return None
+
+    if info is not None:
+        # forget about subdirs that are gone
+        for name in set(info[1]) - set(subdirs):
+            _forget(os.path.join(key, name))
+
+    mtime = statbuf.st_mtime_ns
+    if mtime >= _START_NS - RACY_NS:
+        # read it again next time
+        mtime = 0
+
+    info = (mtime, subdirs, names)
+    _DIRS[key] = info
+    _DIRTY = True
+    return info
+
+
+def _forget(key: str) -> None:
+    '''remove directory and everything below it from the index'''
+
+    global _DIRTY                                           # pylint: disable=global-statement
+
+    assert _DIRS is not None                                # this helps mypy
+
+    for subkey in [subkey for subkey in _DIRS
+                   if subkey == key or subkey.startswith(key + os.sep)]:
+        del _DIRS[subkey]
+    _DIRTY = True
+
+
+def _ignore_config() -> List[str]:
+    '''Returns the ignore settings that the index was made with'''
+
+    return sorted(param.IGNORE_FILES) + ['|'] + param.IGNORE_FILES_WITH_WILDCARDS
+
+
+def save() -> None:
+    '''write the index file, if it changed'''
+
+    global _DIRTY                                           # pylint: disable=global-statement
+
+    if _DIRS is None or not _DIRTY:
+        return
+
+    index = {'synctool_destindex': INDEX_VERSION,
+             'ignore': _ignore_config(),
+             'dirs': _DIRS}
+
+    filename = index_file()
+    # write it atomically; a partial index would be discarded
+    tmp_filename = '%s.%d' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as findex:
+            json.dump(index, findex, separators=(',', ':'))
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        # the index is only an optimization
+        verbose('failed to write %s: %s' % (filename, err.strerror))
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        return
+
+    _DIRTY = False
+    verbose('saved %d directories in destination index' % len(_DIRS))
+
+
+def _load() -> None:
+    '''read the index file
+    A missing or invalid index file gives an empty index
+    '''
+
+    global _DIRS                                            # pylint: disable=global-statement
+
+    _DIRS = {}
+
+    filename = index_file()
+    try:
+        with open(filename, 'r', encoding='utf-8') as findex:
+            index = json.load(findex)
+    except OSError:
+        return
+    except ValueError:
+        verbose('ignoring destination index %s: invalid' % filename)
+        return
+
+    if (not isinstance(index, dict) or
+            index.get('synctool_destindex') != INDEX_VERSION or
+            not isinstance(index.get('dirs'), dict)):
+        verbose('ignoring destination index %s: invalid' % filename)
+        return
+
+    if index.get('ignore') != _ignore_config():
+        verbose('ignoring destination index %s: ignore settings changed' %
+                filename)
+        return
+
+    for key, info in index['dirs'].items():
+        _DIRS[key] = (info[0], info[1], info[2])
+
+    verbose('loaded %d directories from destination index' % len(_DIRS))
+
+# EOB
@@ -0,0 +1,188 @@
+#
+#   synctool.digestcache.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''persistent cache of the digests of files in the overlay tree
+
+The repository copy on a node only changes when the master rsyncs,
+so the digest of a source file is remembered by its device, inode,
+size, mtime and ctime. When the file is replaced or modified, at least
+one of these changes, and the cached digest is no longer used.
+The cache is kept in a compact binary file under $SYNCTOOL/var/
+'''
+
+import os
+import struct
+import hashlib
+import threading
+
+from typing import Dict, Set, Tuple, Optional
+
+from synctool import param
+import synctool.lib
+from synctool.lib import verbose
+
+# the file starts with a header that names the digest algorithm;
+# it is followed by fixed size records: key, digest
+# When the digest_algorithm setting changes, the cache starts over
+HEADER = b'synctool digests %s\n'
+KEY_STRUCT = struct.Struct('<QQQqq')
+
+# key is (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns)
+CacheKey = Tuple[int, int, int, int, int]
+
+_CACHE: Optional[Dict[CacheKey, bytes]] = None
+# keys that were looked up or stored in this run
+_USED: Set[CacheKey] = set()
+_DIRTY = False
+# lookups may come from the check threads
+_LOCK = threading.Lock()
+
+
+def cache_file() -> str:
+    '''Returns path of the cache file'''
+
+    return os.path.join(param.ROOTDIR, param.DIGESTS_FILE)
+
+
+def is_cached_path(path: str) -> bool:
+    '''Returns True if digests of path may be cached'''
+
+    if not param.OVERLAY_DIR:
+        return False
+
+    return path.startswith(param.OVERLAY_DIR + os.sep)
+
+
+def file_key(path: str) -> Optional[CacheKey]:
+    '''Returns cache key for file, or None on error'''
+
+    try:
+        statbuf = os.stat(path)
+    except OSError:
+        return None
+
+    return (statbuf.st_dev, statbuf.st_ino, statbuf.st_size,
+            statbuf.st_mtime_ns, statbuf.st_ctime_ns)
+
+
+def lookup(key: CacheKey) -> Optional[bytes]:
+    '''Returns cached digest, or None if not in the cache'''
+
+    with _LOCK:
+        if _CACHE is None:
+            _load()
+        assert _CACHE is not None                           # this helps mypy
+
+        digest = _CACHE.get(key)
+        if digest is not None:
+            _USED.add(key)
+        return digest
+
+
+def store(key: CacheKey, digest: bytes) -> None:
+    '''put digest in the cache'''
+
+    global _DIRTY                                           # pylint: disable=global-statement
+
+    with _LOCK:
+        if _CACHE is None:
+            _load()
+        assert _CACHE is not None                           # this helps mypy
+
+        if _CACHE.get(key) != digest:
+            _CACHE[key] = digest
+            _DIRTY = True
+        _USED.add(key)
+
+
+def save(prune: bool = False) -> None:
+    '''write the cache file, if it changed
+    If prune is True, entries that were not used in this run are dropped;
+    only do this after comparing every file in the overlay tree
+    A dry run writes nothing
+    '''
+
+    global _CACHE, _DIRTY                                   # pylint: disable=global-statement
+
+    cache = _CACHE
+    if cache is None:
+        # not used in this run
+        return
+
+    if synctool.lib.DRY_RUN:
+        return
+
+    if prune and len(_USED) != len(cache):
+        verbose('pruning %d stale entries from digest cache' %
+                (len(cache) - len(_USED)))
+        cache = _CACHE = {key: cache[key] for key in _USED}
+        _DIRTY = True
+
+    if not _DIRTY:
+        return
+
+    filename = cache_file()
+    # write it atomically; a partial cache file would be discarded
+    tmp_filename = '%s.%d' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as fcache:
+            fcache.write(HEADER % param.DIGEST_ALGORITHM.encode())
+            for key, digest in cache.items():
+                fcache.write(KEY_STRUCT.pack(*key))
+                fcache.write(digest)
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        # the cache is only an optimization
+        verbose('failed to write %s: %s' % (filename, err.strerror))
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        return
+
+    _DIRTY = False
+    verbose('saved %d entries in digest cache' % len(cache))
+
+
+def _load() -> None:
+    '''read the cache file
+    A missing or invalid cache file gives an empty cache
+    '''
+
+    global _CACHE                                           # pylint: disable=global-statement
+
+    _CACHE = {}
+
+    filename = cache_file()
+    try:
+        with open(filename, 'rb') as fcache:
+            data = fcache.read()
+    except OSError:
+        return
+
+    header = HEADER % param.DIGEST_ALGORITHM.encode()
+    if not data.startswith(header):
+        verbose('ignoring digest cache %s: different digest' % filename)
+        return
+
+    digest_size = hashlib.new(param.DIGEST_ALGORITHM).digest_size
+    record_size = KEY_STRUCT.size + digest_size
+    offset = len(header)
+    if (len(data) - offset) % record_size != 0:
+        verbose('ignoring digest cache %s: truncated' % filename)
+        return
+
+    for pos in range(offset, len(data), record_size):
+        key: CacheKey = KEY_STRUCT.unpack_from(data, pos)   # type: ignore
+        _CACHE[key] = data[pos + KEY_STRUCT.size:pos + record_size]
+
+    verbose('loaded %d entries from digest cache' % len(_CACHE))
+
+# EOB
@@ -0,0 +1,104 @@
+#
+#   synctool.durable.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''durable_writes: make installed files durable in batches
+
+Calling fsync() for every file that is installed is slow; every call
+waits for the disk. Instead, the files are tracked as they are written,
+and synced all at once with fdatasync(): before a .pre or .post script
+runs, and at the end of the run, so the waiting is done in a few places
+rather than after every file.
+The directories where files were renamed into are synced as well.
+(Python has no syncfs(), and os.sync() would flush every filesystem
+on the node, along with the writes of everything else running there)
+'''
+
+import os
+
+from typing import List, Set, Tuple
+
+from synctool import param
+from synctool.lib import verbose, error
+
+# flush when this many files are pending, to limit the open fds
+MAX_PENDING = 256
+
+# dup'ed file descriptors and names of files written since the last flush
+_PENDING_FILES: List[Tuple[int, str]] = []
+# directories that had entries renamed into them
+_PENDING_DIRS: Set[str] = set()
+
+
+def add_file(fdesc: int, name: str) -> None:
+    '''track a file that was written to fdesc
+    name is only used in error messages
+    '''
+
+    if not param.DURABLE_WRITES:
+        return
+
+    try:
+        _PENDING_FILES.append((os.dup(fdesc), name))
+    except OSError:
+        # out of fds; sync it now
+        _sync_fd(fdesc, name)
+        return
+
+    if len(_PENDING_FILES) >= MAX_PENDING:
+        flush()
+
+
+def add_dir(path: str) -> None:
+    '''track a directory that had an entry renamed into it'''
+
+    if param.DURABLE_WRITES:
+        _PENDING_DIRS.add(path)
+
+
+def flush() -> None:
+    '''sync all pending files and directories'''
+
+    if not (_PENDING_FILES or _PENDING_DIRS):
+        return
+
+    verbose('syncing %d files in %d directories' % (len(_PENDING_FILES),
+                                                    len(_PENDING_DIRS)))
+
+    for fdesc, name in _PENDING_FILES:
+        _sync_fd(fdesc, name)
+        os.close(fdesc)
+    _PENDING_FILES.clear()
+
+    for path in sorted(_PENDING_DIRS):
+        try:
+            fdesc = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as err:
+            error('failed to open directory %s: %s' % (path, err.strerror))
+            continue
+
+        _sync_fd(fdesc, path)
+        os.close(fdesc)
+    _PENDING_DIRS.clear()
+
+
+def _sync_fd(fdesc: int, name: str) -> None:
+    '''fdatasync() the file descriptor, or fsync() where there is
+    no fdatasync()
+    '''
+
+    try:
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fdesc)
+        else:
+            os.fsync(fdesc)
+    except OSError as err:
+        error('failed to sync %s: %s' % (name, err.strerror))
+
+# EOB
@@ -0,0 +1,186 @@
+#
+#   synctool.fingerprint.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''fingerprints of the repository
+
+A fingerprint is a digest over the metadata of a directory tree:
+the names, types, modes and owners of everything in it, and the sizes
+and mtimes of the files.
+This is what rsync looks at to decide what to transfer, so when
+the fingerprint did not change, there is nothing to rsync
+'''
+
+import os
+import stat
+import fnmatch
+import hashlib
+
+from typing import Dict, List, Optional, Sequence, Callable
+
+from synctool import param
+
+# these are excluded by the rsync filter, so they do not count
+# and the node state files do not count either
+# Like the anchored rsync filter rules, they match the whole relative
+# path, and a wildcard does not match across a '/'
+EXCLUDE_PATTERNS = ('sbin/*.pyc', 'lib/synctool/*.pyc',
+                    'lib/synctool/pkg/*.pyc',
+                    param.CHANGED_DIR) + param.NODE_STATE_FILES
+
+# the patterns split into path components
+_EXCLUDE_PARTS = [tuple(pattern.split(os.sep)) for pattern in EXCLUDE_PATTERNS]
+
+# dirs under var/ that hold a subdirectory per group
+GROUP_DIRS = ('overlay', 'delete', 'purge')
+
+# digests of the tree outside the group dirs, and of group dirs
+# computed only once per run
+_BASE_DIGEST = ''
+_GROUP_DIGESTS: Dict[str, str] = {}
+
+
+def repo_fingerprint(groups: Optional[Sequence[str]], extra: str = '') -> str:
+    '''Returns fingerprint of the part of the repository that a node
+    with these groups gets. If groups is None, it is the full repository
+    (for slave nodes)
+    extra is mixed in; it may be anything else that determines
+    what the node gets, like the rsync filter and command
+    '''
+
+    if groups is None:
+        groups = sorted(repo_groups())
+
+    hasher = hashlib.sha1()
+    hasher.update(base_fingerprint().encode())
+    for group in groups:
+        hasher.update(('%s %s\n' % (group, group_fingerprint(group))).encode())
+    hasher.update(extra.encode())
+    return hasher.hexdigest()
+
+
+def base_fingerprint() -> str:
+    '''Returns fingerprint of the repository, minus the group dirs'''
+
+    global _BASE_DIGEST                                     # pylint: disable=global-statement
+
+    if not _BASE_DIGEST:
+        _BASE_DIGEST = _digest(param.ROOTDIR, _skip_group_dirs)
+
+    return _BASE_DIGEST
+
+
+def group_fingerprint(group: str) -> str:
+    '''Returns fingerprint of the overlay/, delete/ and purge/ dirs
+    of a group
+    '''
+
+    if group not in _GROUP_DIGESTS:
+        hasher = hashlib.sha1()
+        for label in GROUP_DIRS:
+            path = os.path.join(param.VAR_DIR, label, group)
+            hasher.update(('%s %s\n' % (label, _digest(path))).encode())
+
+        _GROUP_DIGESTS[group] = hasher.hexdigest()
+
+    return _GROUP_DIGESTS[group]
+
+
+def repo_groups() -> List[str]:
+    '''Returns names of all group dirs in the repository'''
+
+    groups = set()
+    for label in GROUP_DIRS:
+        path = os.path.join(param.VAR_DIR, label)
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        groups.add(entry.name)
+        except OSError:
+            pass
+
+    return list(groups)
+
+
+def _skip_group_dirs(relpath: str) -> bool:
+    '''Returns True if relpath is a group dir'''
+
+    parts = relpath.split(os.sep)
+    return len(parts) == 3 and parts[0] == 'var' and parts[1] in GROUP_DIRS
+
+
+def _excluded(relpath: str) -> bool:
+    '''Returns True if relpath matches any of EXCLUDE_PATTERNS'''
+
+    parts = relpath.split(os.sep)
+    for pattern_parts in _EXCLUDE_PARTS:
+        if (len(pattern_parts) == len(parts) and
+                all(fnmatch.fnmatchcase(part, pattern_part)
+                    for part, pattern_part in zip(parts, pattern_parts))):
+            return True
+
+    return False
+
+
+def _digest(top: str, skip: Optional[Callable[[str], bool]] = None) -> str:
+    '''Returns digest over the metadata of the tree under top
+    The optional skip function is passed relative paths, and
+    returns True for any path to leave out
+    '''
+
+    hasher = hashlib.sha1()
+
+    # depth-first walk with sorted entries, so the digest is stable
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        try:
+            with os.scandir(os.path.join(top, reldir)) as it_entries:
+                entries = sorted(it_entries, key=lambda entry: entry.name)
+        except OSError:
+            # gone or not a directory; that's the same as empty
+            continue
+
+        subdirs = []
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name)
+            if skip is not None and skip(relpath):
+                continue
+
+            if _excluded(relpath):
+                continue
+
+            try:
+                statbuf = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            line = '%s %o %d %d' % (relpath, statbuf.st_mode,
+                                    statbuf.st_uid, statbuf.st_gid)
+            if stat.S_ISDIR(statbuf.st_mode):
+                # the size and mtime of a directory change along with
+                # its entries, which are in the digest anyway
+                subdirs.append(relpath)
+            else:
+                line += ' %d %d' % (statbuf.st_size, statbuf.st_mtime_ns)
+                if stat.S_ISLNK(statbuf.st_mode):
+                    try:
+                        line += ' -> ' + os.readlink(entry.path)
+                    except OSError:
+                        pass
+
+            hasher.update(line.encode('utf-8', 'surrogateescape'))
+            hasher.update(b'\n')
+
+        stack.extend(reversed(subdirs))
+
+    return hasher.hexdigest()
+
+# EOB
@@ -16,9 +16,11 @@ import datetime
 import subprocess
 import errno
 import shlex
+import signal
 import syslog
+import threading
 
-from typing import List, Optional
+from typing import List, Set, Optional, Callable
 
 from synctool import param
 
@@ -30,6 +32,12 @@ UNIX_CMD = False
 NO_POST = False
 MASTERLOG = False
 
+# directories that mkdir_p() made or found to exist in this run
+DIRS_MADE: Set[str] = set()
+
+# number of errors in this run
+ERROR_COUNT = 0
+
 # print nodename in output?
 # This option is pretty useless except in synctool-ssh it may be useful
 OPT_NODENAME = True
@@ -60,6 +68,13 @@ TERSE_TXT = ('info', 'WARN', 'ERROR', 'FAIL',
              'sync', 'link', 'mkdir', 'rm', 'chown', 'chmod', 'exec',
              'upload', 'new', 'type', 'DRYRUN', 'FIXING', 'OK')
 
+# exit code of a command that was killed because it ran too long
+# (the same exit code as the timeout(1) command)
+EXIT_TIMEOUT = 124
+
+# seconds between terminating and killing a command that timed out
+KILL_GRACE = 5
+
 COLORMAP = {'black': 30,
             'darkgray': 30,
             'red': 31,
@@ -98,6 +113,9 @@ def stderr(msg: str) -> None:
 def error(msg: str) -> None:
     '''print error message'''
 
+    global ERROR_COUNT                                      # pylint: disable=global-statement
+
+    ERROR_COUNT += 1
     stderr('error: ' + msg)
 
 
@@ -296,6 +314,11 @@ def _masterlog(msg: str) -> None:
     if DRY_RUN or not param.SYSLOGGING:
         return
 
+    if MASTERLOG:
+        # running on a relay node; pass it on to the master
+        print('%synctool-log%', msg)
+        return
+
     syslog.syslog(syslog.LOG_INFO | syslog.LOG_USER, msg)
 
 
@@ -320,10 +343,30 @@ def _pass_output(line: str, nodename: str) -> None:
             print(line)
 
 
-def run_with_nodename(cmd_arr: List[str], nodename: str) -> int:
+def pass_relayed_output(line: str) -> None:
+    '''print output of a relay node
+    The relay already shows the nodenames, and it passes the log lines
+    of its nodes on to the master, including the nodename
+    '''
+
+    if line[:15] == '%synctool-log% ':
+        _masterlog(line[15:])
+    else:
+        print(line)
+
+
+def run_with_nodename(cmd_arr: List[str], nodename: str, timeout: float = 0,
+                      output: Optional[Callable[[str], None]] = None,
+                      stdin_file: Optional[str] = None) -> int:
     '''run command and show output with nodename
     It will run regardless of what DRY_RUN is
-    Returns process return code or -1 on error
+    If timeout is given, the command (and all of its children) are killed
+    when it runs for longer than timeout seconds
+    If output is given, it is called for every line of output
+    instead of showing it
+    If stdin_file is given, the command reads its input from that file
+    Returns process return code, EXIT_TIMEOUT if it timed out,
+    or -1 on error
     '''
 
     unix_out(' '.join(cmd_arr))
@@ -331,17 +374,29 @@ def run_with_nodename(cmd_arr: List[str], nodename: str) -> int:
     sys.stdout.flush()
     sys.stderr.flush()
 
+    fd_stdin = None
+    if stdin_file is not None:
+        try:
+            fd_stdin = open(stdin_file, 'rb')                       # pylint: disable=consider-using-with
+        except OSError as err:
+            stderr('failed to open %s: %s' % (stdin_file, err.strerror))
+            return -1
+
+    # with a timeout, run in a process group of its own
+    # so that it can be killed together with its children
+    # (like the ssh that rsync runs)
     try:
         with subprocess.Popen(cmd_arr,
+                              stdin=fd_stdin,
                               stdout=subprocess.PIPE,
                               stderr=subprocess.STDOUT,
-                              universal_newlines=True) as proc:
-            assert proc.stdout is not None                          # this helps mypy
-            for line in proc.stdout:
-                line = line.rstrip()
-                _pass_output(line, nodename)
+                              universal_newlines=True,
+                              start_new_session=timeout > 0) as proc:
+            if _pass_lines(proc, nodename, timeout, output):
+                _pass_output('error: timed out after %d seconds' % timeout, nodename)
+                _masterlog('%s: timed out after %d seconds' % (nodename, timeout))
+                return EXIT_TIMEOUT
 
-            proc.wait()
             if proc.returncode != 0:
                 verbose('exit code %d' % proc.returncode)
 
@@ -350,9 +405,84 @@ def run_with_nodename(cmd_arr: List[str], nodename: str) -> int:
     except OSError as err:
         stderr('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
 
+    finally:
+        if fd_stdin is not None:
+            fd_stdin.close()
+
     return -1
 
 
+def _pass_lines(proc: subprocess.Popen, nodename: str, timeout: float,
+                output: Optional[Callable[[str], None]]) -> bool:
+    '''pass on the output of proc and wait for it to exit
+    If timeout is given, the process group is killed when the deadline
+    passes
+    Returns True if it timed out
+    '''
+
+    assert proc.stdout is not None                                  # this helps mypy
+
+    expired = threading.Event()
+    finished = threading.Event()
+    if timeout > 0:
+        threading.Thread(target=_kill_on_deadline,
+                         args=(proc, timeout, expired, finished),
+                         daemon=True).start()
+    try:
+        for line in proc.stdout:
+            line = line.rstrip()
+            if output is not None:
+                output(line)
+            else:
+                _pass_output(line, nodename)
+
+        proc.wait()
+
+    except KeyboardInterrupt:
+        # the process group does not get the Ctrl-C from the tty
+        if timeout > 0:
+            _killpg(proc.pid, signal.SIGTERM)
+        raise
+
+    finally:
+        finished.set()
+
+    return expired.is_set()
+
+
+def _kill_on_deadline(proc: subprocess.Popen, timeout: float,
+                      expired: threading.Event, finished: threading.Event) -> None:
+    '''thread that kills the process group of proc when it did not
+    finish within timeout seconds
+    '''
+
+    if finished.wait(timeout):
+        return
+
+    expired.set()
+
+    # first ask nicely, then pull the plug
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if not _killpg(proc.pid, sig):
+            return
+
+        if finished.wait(KILL_GRACE):
+            return
+
+
+def _killpg(pgid: int, sig: int) -> bool:
+    '''send signal to process group
+    Returns False if the process group is gone
+    '''
+
+    try:
+        os.killpg(pgid, sig)
+    except OSError:
+        return False
+
+    return True
+
+
 def shell_command(cmd: str) -> int:
     '''run a shell command
     Unless DRY_RUN is set
@@ -512,7 +642,11 @@ def mkdir_p(path: str, mode: int = 0o700) -> bool:
     Returns False on error, else True
     '''
 
+    if path in DIRS_MADE:
+        return True
+
     if path_exists(path):
+        DIRS_MADE.add(path)
         return True
 
     # temporarily restore admin's umask
@@ -527,9 +661,31 @@ def mkdir_p(path: str, mode: int = 0o700) -> bool:
     unix_out('mkdir -p -m %04o %s' % (mode, path))
 
     os.umask(mask)
+
+    # the leading dirs exist now, too
+    while path and path not in DIRS_MADE:
+        DIRS_MADE.add(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
     return True
 
 
+def forget_dirs(path: str) -> None:
+    '''path was deleted or moved away; so were any dirs under it
+    mkdir_p() will have to make them again
+    '''
+
+    path = path.rstrip(os.sep)
+    DIRS_MADE.discard(path)
+
+    prefix = path + os.sep
+    for dirname in [x for x in DIRS_MADE if x.startswith(prefix)]:
+        DIRS_MADE.discard(dirname)
+
+
 #
 #   functions for straightening out paths that were given by the user
 #
@@ -54,8 +54,7 @@ def main() -> int:
     '''run the program'''
 
     get_options()
-    lines = sys.stdin.readlines()
-    synctool.aggr.aggregate(lines)
+    synctool.aggr.aggregate(sys.stdin)
     return 0
 
 # EOB
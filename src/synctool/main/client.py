@@ -17,16 +17,24 @@ import shlex
 import getopt
 import subprocess
 
-from typing import List, Dict, Tuple, Callable
+from typing import List, Dict, Set, Tuple, Callable, Iterator
 
 from synctool import config, param
+import synctool.deferred
+import synctool.destindex
+import synctool.digestcache
+import synctool.durable
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, error, warning, terse
 from synctool.lib import unix_out, prettypath
 from synctool.main.wrapper import catch_signals
 import synctool.object
 import synctool.overlay
+import synctool.plan
+import synctool.prefetch
+import synctool.statedb
 import synctool.syncstat
+import synctool.verify
 from synctool.object import SyncObject
 
 # hardcoded name because otherwise we get "synctool_client.py"
@@ -37,9 +45,14 @@ ACTION_DEFAULT = 0
 ACTION_DIFF = 1
 ACTION_ERASE_SAVED = 2
 ACTION_REFERENCE = 3
+ACTION_PLAN = 4
+ACTION_APPLY = 5
 
 SINGLE_FILES: List[str] = []
 
+# file to write the plan to (--plan) or to read it from (--apply)
+PLAN_FILE = ''
+
 
 def generate_template(obj: SyncObject, post_dict: Dict[str, str]) -> bool:
     '''run template .post script, generating a new file
@@ -321,6 +334,9 @@ def _run_rsync_purge(cmd_arr: List[str]) -> None:
             msg = code[1:]
             msg = msg.strip()
             stdout('%s %s (purge)' % (msg, prettypath(path)))
+            if not synctool.lib.DRY_RUN:
+                # it may have been a directory that mkdir_p() knows of
+                synctool.lib.forget_dirs(path)
         else:
             stdout('%s mismatch (purge)' % prettypath(path))
 
@@ -328,7 +344,9 @@ def _run_rsync_purge(cmd_arr: List[str]) -> None:
 def overlay_files() -> None:
     '''run the overlay function'''
 
-    synctool.overlay.visit(param.OVERLAY_DIR, _overlay_callback)
+    synctool.overlay.visit(param.OVERLAY_DIR, _overlay_callback, prefetch=True,
+                           incremental=True)
+    synctool.prefetch.shutdown()
 
 
 def _overlay_callback(obj: SyncObject, pre_dict: Dict[str, str], post_dict: Dict[str, str]) -> Tuple[bool, bool]:
@@ -341,6 +359,7 @@ def _overlay_callback(obj: SyncObject, pre_dict: Dict[str, str], post_dict: Dict
 
     verbose('checking %s' % obj.print_src())
     fixup = obj.check()
+    synctool.plan.add_fix(obj, fixup, pre_dict, post_dict)
     updated = obj.fix(fixup, pre_dict, post_dict)
     return True, updated
 
@@ -375,13 +394,49 @@ def _delete_callback(obj: SyncObject, _pre_dict: Dict[str, str], post_dict: Dict
         if vnode is None:
             # error message already printed
             return True, False
+        synctool.plan.add_delete(obj, post_dict)
         vnode.harddelete()
-        obj.run_script(post_dict)
+        obj.run_post_script(post_dict)
         return True, True
 
     return True, False
 
 
+def apply_plan() -> None:
+    '''make the changes in PLAN_FILE
+    Exits the program on error
+    '''
+
+    steps = synctool.plan.load(PLAN_FILE)
+    if steps is None or not synctool.overlay.check_plan(PLAN_FILE, steps):
+        sys.exit(1)
+
+    # directories that were updated; their .post script should run
+    updated_dirs: Set[str] = set()
+
+    for step in steps:
+        if step['step'] == synctool.plan.STEP_SCRIPT:
+            if step['dest'] in updated_dirs:
+                obj = SyncObject('', step['dest'])
+                obj.dest_stat = synctool.syncstat.SyncStat(obj.dest_path)
+                obj.src_stat = obj.dest_stat
+                obj.run_post_script({obj.dest_path: step['post']})
+            continue
+
+        obj = synctool.plan.make_object(step)
+        pre_dict, post_dict = synctool.plan.scripts(step)
+        if step['step'] == synctool.plan.STEP_DELETE:
+            _, updated = _delete_callback(obj, pre_dict, post_dict)
+        else:
+            _, updated = _overlay_callback(obj, pre_dict, post_dict)
+
+        if updated:
+            if obj.src_stat.is_dir():
+                updated_dirs.add(obj.dest_path)
+            else:
+                updated_dirs.add(os.path.dirname(obj.dest_path))
+
+
 def erase_saved() -> None:
     '''List and delete *.saved backup files'''
 
@@ -413,15 +468,17 @@ def _erase_saved_callback(obj: SyncObject, _pre_dict: Dict[str, str], post_dict:
     return True, False
 
 
-def visit_purge_single(callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> None:
-    '''look in the purge/ dir for SINGLE_FILES, and call callback'''
+def purge_single() -> Iterator[synctool.overlay.WalkItem]:
+    '''look in the purge/ dir for SINGLE_FILES
+    Yields (SyncObject, pre_dict, post_dict), like overlay.walk()
+    '''
 
     if not SINGLE_FILES:
         return
 
     purge_groups = os.listdir(param.PURGE_DIR)
 
-    # use a copy of SINGLE_FILES, because the callback will remove items
+    # use a copy of SINGLE_FILES, because the consumer will remove items
     for dest in SINGLE_FILES[:]:
         filepath = dest
         if filepath[0] == os.sep:
@@ -438,11 +495,25 @@ def visit_purge_single(callback: Callable[[SyncObject, Dict[str, str], Dict[str,
                 obj.src_stat = synctool.syncstat.SyncStat(obj.src_path)
                 obj.dest_stat = synctool.syncstat.SyncStat(obj.dest_path)
 
-                # call the callback function
-                callback(obj, {}, {})
+                yield obj, {}, {}
                 break
 
 
+def visit_purge_single(callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> None:
+    '''look in the purge/ dir for SINGLE_FILES, and call callback'''
+
+    for obj, pre_dict, post_dict in purge_single():
+        callback(obj, pre_dict, post_dict)
+
+
+def _single_sources(overlay: str) -> Set[str]:
+    '''Returns the source paths in overlay that SINGLE_FILES may come from,
+    and the directories that lead to them
+    '''
+
+    return synctool.destindex.sources(overlay, SINGLE_FILES)
+
+
 def _match_single(path: str) -> bool:
     '''Returns True if (terse) path is in SINGLE_FILES, else False'''
 
@@ -536,7 +607,8 @@ def single_files() -> None:
     '''check/update a list of single files'''
 
     synctool.overlay.visit(param.OVERLAY_DIR,
-                           _single_overlay_callback)
+                           _single_overlay_callback,
+                           only=_single_sources(param.OVERLAY_DIR))
 
     # For files that were not found, look in the purge/ tree
     # Any overlay-ed files have already been removed from SINGLE_FILES
@@ -547,7 +619,8 @@ def single_files() -> None:
         # there are still single files left
         # maybe they are in the delete tree?
         synctool.overlay.visit(param.DELETE_DIR,
-                               _single_delete_callback)
+                               _single_delete_callback,
+                               only=_single_sources(param.DELETE_DIR))
 
     for filename in SINGLE_FILES:
         stderr('%s is not in the overlay tree' % filename)
@@ -586,20 +659,24 @@ def single_erase_saved() -> None:
     '''erase single backup files'''
 
     synctool.overlay.visit(param.OVERLAY_DIR,
-                           _single_erase_saved_callback)
+                           _single_erase_saved_callback,
+                           only=_single_sources(param.OVERLAY_DIR))
 
     if SINGLE_FILES:
         # there are still single files left
         # maybe they are in the delete tree?
         synctool.overlay.visit(param.DELETE_DIR,
-                               _single_erase_saved_callback)
+                               _single_erase_saved_callback,
+                               only=_single_sources(param.DELETE_DIR))
 
     for filename in SINGLE_FILES:
         stderr('%s is not in the overlay tree' % filename)
 
 
-def _reference_callback(obj: SyncObject, _pre_dict: Dict[str, str], _post_dict: Dict[str, str]) -> Tuple[bool, bool]:
-    '''callback for reference_files()'''
+def _reference(obj: SyncObject) -> bool:
+    '''print source of obj if it is one of the single files
+    Returns False when there are no single files left
+    '''
 
     if obj.ov_type == synctool.overlay.OV_TEMPLATE:
         if obj.dest_path in SINGLE_FILES:
@@ -607,26 +684,27 @@ def _reference_callback(obj: SyncObject, _pre_dict: Dict[str, str], _post_dict:
             print(obj.print_src())
             SINGLE_FILES.remove(obj.dest_path)
             if not SINGLE_FILES:
-                return False, False
+                return False
 
-        return True, False
+        return True
 
     if _match_single(obj.dest_path):
         print(obj.print_src())
 
-    if not SINGLE_FILES:
-        return False, False
-
-    return True, False
+    return bool(SINGLE_FILES)
 
 
 def reference_files() -> None:
     '''show which source file in the repository synctool uses'''
 
-    synctool.overlay.visit(param.OVERLAY_DIR, _reference_callback)
+    for obj, _, _ in synctool.overlay.walk(param.OVERLAY_DIR,
+                                           only=_single_sources(param.OVERLAY_DIR)):
+        if not _reference(obj):
+            break
 
     # look in the purge/ tree, too
-    visit_purge_single(_reference_callback)
+    for obj, _, _ in purge_single():
+        _reference(obj)
 
     for filename in SINGLE_FILES:
         stderr('%s is not in the overlay tree' % filename)
@@ -644,28 +722,34 @@ def _exec_diff(src: str, dest: str) -> None:
     synctool.lib.exec_command(cmd_arr)
 
 
-def _diff_callback(obj: SyncObject, _pre_dict: Dict[str, str], post_dict: Dict[str, str]) -> Tuple[bool, bool]:
-    '''callback function for doing a diff on overlay/ files'''
+def _diff(obj: SyncObject, post_dict: Dict[str, str]) -> bool:
+    '''display a diff if obj is one of the single files
+    Returns False when done, or on error
+    '''
 
     if obj.ov_type == synctool.overlay.OV_TEMPLATE:
-        return generate_template(obj, post_dict), False
+        return generate_template(obj, post_dict)
 
     if _match_single(obj.dest_path):
         _exec_diff(obj.src_path, obj.dest_path)
 
         if not SINGLE_FILES:
-            return False, False
+            return False
 
-    return True, False
+    return True
 
 
 def diff_files() -> None:
     '''display a diff of the single files'''
 
-    synctool.overlay.visit(param.OVERLAY_DIR, _diff_callback)
+    for obj, _, post_dict in synctool.overlay.walk(param.OVERLAY_DIR,
+                                                   only=_single_sources(param.OVERLAY_DIR)):
+        if not _diff(obj, post_dict):
+            break
 
     # look in the purge/ tree, too
-    visit_purge_single(_diff_callback)
+    for obj, _, post_dict in purge_single():
+        _diff(obj, post_dict)
 
     for filename in SINGLE_FILES:
         stderr('%s is not in the overlay tree' % filename)
@@ -724,6 +808,9 @@ def usage() -> None:
   -e, --erase-saved     Erase *.saved backup files
   -f, --fix             Perform updates (otherwise, do dry-run)
       --no-post         Do not run any .post scripts
+      --plan=FILE       Do a dry run, and write the changes to FILE
+      --apply=FILE      Make the changes in plan FILE
+      --full            Do not skip unchanged subtrees
   -N, --nodename=NODE   Force nodename
   -F, --fullpath        Show full paths instead of shortened ones
   -T, --terse           Show terse, shortened paths
@@ -743,7 +830,7 @@ def get_options() -> int:
 
     # pylint: disable=too-many-statements,too-many-branches
 
-    global SINGLE_FILES                                             # pylint: disable=global-statement
+    global SINGLE_FILES, PLAN_FILE                                  # pylint: disable=global-statement
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'hc:d:1:r:efNFTvq',
@@ -751,7 +838,8 @@ def get_options() -> int:
                                     'ref=', 'erase-saved', 'fix', 'no-post',
                                     'fullpath', 'terse', 'color', 'no-color',
                                     'masterlog', 'node=', 'nodename=',
-                                    'verbose', 'quiet', 'unix', 'version'])
+                                    'verbose', 'quiet', 'unix', 'version',
+                                    'plan=', 'apply=', 'full'])
     except getopt.GetoptError as reason:
         print('%s: %s' % (PROGNAME, reason))
         usage()
@@ -831,6 +919,10 @@ def get_options() -> int:
             synctool.lib.NO_POST = True
             continue
 
+        if opt == '--full':
+            synctool.statedb.FULL_RUN = True
+            continue
+
         if opt == '--color':
             param.COLORIZE = True
             continue
@@ -914,6 +1006,18 @@ def get_options() -> int:
             action = ACTION_ERASE_SAVED
             continue
 
+        if opt in ('--plan', '--apply'):
+            if PLAN_FILE:
+                error('option --plan and --apply can not be combined')
+                sys.exit(1)
+
+            PLAN_FILE = arg
+            if opt == '--plan':
+                action = ACTION_PLAN
+            else:
+                action = ACTION_APPLY
+            continue
+
         error("unknown command line option '%s'" % opt)
         errors += 1
 
@@ -929,6 +1033,17 @@ def get_options() -> int:
 
     option_combinations(opt_diff, opt_single, opt_reference, opt_erase_saved,
                         opt_upload, opt_suffix, opt_fix)
+
+    if PLAN_FILE:
+        if opt_diff or opt_single or opt_reference or opt_erase_saved:
+            error('option --plan and --apply can not be combined with '
+                  'other actions')
+            sys.exit(1)
+
+        if action == ACTION_PLAN and opt_fix:
+            error('option --plan is a dry run; use --apply with --fix')
+            sys.exit(1)
+
     return action
 
 
@@ -1044,11 +1159,33 @@ def main() -> int:
 
     elif SINGLE_FILES:
         single_files()
+        synctool.digestcache.save()
+
+    elif action == ACTION_APPLY:
+        synctool.verify.init()
+        purge_files()
+        apply_plan()
+        synctool.digestcache.save()
 
     else:
+        if action == ACTION_PLAN:
+            synctool.plan.start()
+        synctool.verify.init()
         purge_files()
         overlay_files()
         delete_files()
+        # drop stale digests, but only if every file was compared;
+        # the files in skipped subtrees and trusted files were not
+        synctool.digestcache.save(prune=not (synctool.statedb.skipped() or
+                                             synctool.verify.TRUSTED))
+        if action == ACTION_PLAN and not synctool.plan.save(PLAN_FILE):
+            return 1
+
+    # queued .post scripts
+    synctool.deferred.run()
+    synctool.durable.flush()
+    synctool.destindex.save()
+    synctool.statedb.save()
 
     unix_out('# EOB')
     return 0
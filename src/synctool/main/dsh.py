@@ -95,7 +95,7 @@ def run_dsh(address_list: List[str], remote_cmd_arr: List[str], ssh_options: str
     synctool.parallel.do(worker_ssh, address_list)
 
 
-def worker_ssh(addr: str) -> None:
+def worker_ssh(addr: str) -> synctool.parallel.Commands:
     '''worker process: sync script and run ssh+command to the node'''
 
     # Note that this func even runs ssh to the local node if
@@ -131,7 +131,7 @@ def worker_ssh(addr: str) -> None:
         cmd_arr.append('--')
         cmd_arr.append('%s' % REMOTE_CMD_ARR[0])
         cmd_arr.append('%s:%s' % (addr, REMOTE_CMD_ARR[0]))
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+        yield synctool.parallel.Command(cmd_arr, nodename)
 
     cmd_str = ' '.join(REMOTE_CMD_ARR)
 
@@ -158,7 +158,7 @@ def worker_ssh(addr: str) -> None:
     else:
         # run_with_nodename() shows the nodename, but
         # does not expect any prompts while running the cmd
-        synctool.lib.run_with_nodename(ssh_cmd_arr, nodename)
+        yield synctool.parallel.Command(ssh_cmd_arr, nodename)
 
 
 def start_multiplex(address_list: List[str], ssh_persist: Optional[str] = None) -> None:
@@ -106,7 +106,7 @@ def run_remote_copy(address_list: List[str], files: List[str], opts: Options) ->
     synctool.parallel.do(worker_dsh_cp, address_list)
 
 
-def worker_dsh_cp(addr: str) -> None:
+def worker_dsh_cp(addr: str) -> synctool.parallel.Commands:
     '''do remote copy to node'''
 
     nodename = NODESET.get_nodename_from_address(addr)
@@ -141,7 +141,7 @@ def worker_dsh_cp(addr: str) -> None:
     stdout(msg)
 
     if not synctool.lib.DRY_RUN:
-        synctool.lib.run_with_nodename(dsh_cp_cmd_arr, nodename)
+        yield synctool.parallel.Command(dsh_cp_cmd_arr, nodename)
     else:
         unix_out(' '.join(dsh_cp_cmd_arr) + '    # dry run')
 
@@ -11,7 +11,6 @@
 '''ping the synctool nodes'''
 
 import sys
-import subprocess
 import getopt
 import shlex
 
@@ -20,7 +19,7 @@ from typing import List, Tuple
 from synctool import config, param
 import synctool.aggr
 import synctool.lib
-from synctool.lib import verbose, error, unix_out
+from synctool.lib import verbose, error
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
 import synctool.parallel
@@ -50,36 +49,35 @@ def ping_nodes(address_list: List[str]) -> None:
     synctool.parallel.do(ping_node, address_list)
 
 
-def ping_node(addr: str) -> None:
+def ping_node(addr: str) -> synctool.parallel.Commands:
     '''ping a single node'''
 
     node = NODESET.get_nodename_from_address(addr)
     verbose('pinging %s' % node)
-    unix_out('%s %s' % (param.PING_CMD, addr))
 
-    packets_received = 0
+    # the number of packets received, once found in the output
+    result: List[int] = []
+
+    def _parse_line(line: str) -> None:
+        '''parse a line of ping output'''
+
+        if not result:
+            packets_received, done = _parse_ping_output(line)
+            if done:
+                result.append(packets_received)
 
     # execute ping command
     cmd = '%s %s' % (param.PING_CMD, addr)
     cmd_arr = shlex.split(cmd)
-    try:
-        with subprocess.Popen(cmd_arr,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True) as proc:
-            assert proc.stdout is not None                          # this helps mypy
-            for line in proc.stdout:
-                packets_received, done = _parse_ping_output(line)
-                if done:
-                    break
-
-        if packets_received > 0:
-            print('%s: up' % node)
-        else:
-            print('%s: not responding' % node)
-
-    except OSError as err:
-        error('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
+    exitcode = yield synctool.parallel.Command(cmd_arr, node, output=_parse_line)
+    if exitcode == -1:
+        # failed to run command; error has already been printed
+        return
+
+    if result and result[0] > 0:
+        print('%s: up' % node)
+    else:
+        print('%s: not responding' % node)
 
 
 def _parse_ping_output(line: str) -> Tuple[int, bool]:
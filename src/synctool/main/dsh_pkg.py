@@ -64,7 +64,7 @@ def run_remote_pkg(address_list: List[str]) -> None:
     synctool.parallel.do(worker_pkg, address_list)
 
 
-def worker_pkg(addr: str) -> None:
+def worker_pkg(addr: str) -> synctool.parallel.Commands:
     '''runs ssh + synctool-pkg to the nodes in parallel'''
 
     nodename = NODESET.get_nodename_from_address(addr)
@@ -94,7 +94,7 @@ def worker_pkg(addr: str) -> None:
     else:
         # run_with_nodename() shows the nodename, but
         # does not expect any prompts while running the cmd
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+        yield synctool.parallel.Command(cmd_arr, nodename)
 
 
 def rearrange_options() -> List[str]:
@@ -17,11 +17,15 @@ import sys
 import getopt
 import shlex
 import tempfile
+import time
 
-from typing import List, IO
+from typing import List, Dict, Set, Tuple, Sequence, Optional, Generator, IO
 
 from synctool import config, param
 import synctool.aggr
+import synctool.batch
+import synctool.changed
+import synctool.fingerprint
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, error, warning, terse
 from synctool.lib import prettypath
@@ -44,6 +48,49 @@ NODESET = synctool.nodeset.NodeSet()
 OPT_SKIP_RSYNC = False
 PASS_ARGS: List[str] = []
 
+# set when running on a relay node, on behalf of the master
+OPT_RELAY = False
+
+# --changed: only run on nodes affected by changes since the baseline
+# --baseline: save the baseline after a full run
+OPT_CHANGED = False
+OPT_BASELINE = False
+
+# record failed nodes as pending for the next --changed run
+TRACK_PENDING = False
+
+# nodes that a relay node runs synctool for, by relay nodename
+RELAY_NODES: Dict[str, List[str]] = {}
+
+# a relay passes the exit code of each of its nodes back to the master
+# in a line of output with this tag
+RELAY_RESULT_TAG = '%synctool-result% '
+
+# exit codes of the nodes that relays ran synctool for, by nodename
+RELAY_RESULTS: Dict[str, int] = {}
+
+# pipeline stages of worker_synctool
+STAGE_RSYNC = 'rsync'
+STAGE_SSH = 'ssh'
+
+# rsync filter files per group profile; a profile of None is for
+# the slave nodes, that get the full repository
+RSYNC_FILTERS: Dict[Optional[Tuple[str, ...]], str] = {}
+
+# names of the group dirs under overlay/, delete/ and purge/
+REPO_GROUPS: Optional[Set[str]] = None
+
+# rsync batches per group profile (if rsync_batch is enabled)
+RSYNC_BATCHES: Dict[Optional[Tuple[str, ...]], synctool.batch.Batch] = {}
+
+# fingerprints of the repository per group profile
+# (if rsync_fingerprint or rsync_batch is enabled)
+RSYNC_FINGERPRINTS: Dict[Optional[Tuple[str, ...]], str] = {}
+
+# exit code of the remote fingerprint check when the node is out of date
+# (EX_TEMPFAIL from sysexits.h)
+EXIT_STALE = 75
+
 
 class Options:
     '''represents program options and arguments'''
@@ -61,17 +108,55 @@ class Options:
 def run_remote_synctool(address_list: List[str]) -> None:
     '''run synctool on target nodes'''
 
-    synctool.parallel.do(worker_synctool, address_list)
+    if not OPT_RELAY:
+        address_list = assign_relays(address_list)
+
+    try:
+        make_rsync_filters(address_list)
+
+        # rsync and ssh are pipelined stages, each with their own limit;
+        # one node may be running synctool while the next is still rsyncing
+        synctool.parallel.do(worker_synctool, address_list,
+                             {STAGE_RSYNC: param.RSYNC_NUM_PROC,
+                              STAGE_SSH: param.SSH_NUM_PROC})
+    finally:
+        remove_rsync_filters()
 
 
-def worker_synctool(addr: str) -> None:
+def worker_synctool(addr: str) -> synctool.parallel.Commands:
     '''run rsync of ROOTDIR to the nodes and ssh+synctool, in parallel'''
 
     nodename = NODESET.get_nodename_from_address(addr)
 
+    exitcode = yield from sync_node(addr, nodename)
+
+    if OPT_RELAY:
+        # pass the result on to the master
+        print('%s%s %d' % (RELAY_RESULT_TAG, nodename, exitcode))
+
+    if TRACK_PENDING:
+        # failed nodes are contacted again by the next --changed run
+        if nodename in RELAY_NODES:
+            for node in RELAY_NODES[nodename]:
+                # a node that the relay did not report on has failed
+                synctool.changed.mark_pending(node, RELAY_RESULTS.get(node, -1) != 0)
+        else:
+            synctool.changed.mark_pending(nodename, exitcode != 0)
+
+
+def sync_node(addr: str, nodename: str) -> Generator[synctool.parallel.Command, int, int]:
+    '''rsync ROOTDIR/dirs/ to the node and run synctool on it
+    Returns exit code of the last command
+    '''
+
+    # wall clock deadline for this node (if any)
+    if param.NODE_TIMEOUT > 0:
+        deadline = time.monotonic() + param.NODE_TIMEOUT
+    else:
+        deadline = 0.0
+
     if nodename == param.NODENAME:
-        run_local_synctool()
-        return
+        return (yield from run_local_synctool(deadline))
 
     # use ssh connection multiplexing (if possible)
     use_multiplex = synctool.multiplex.use_mux(nodename)
@@ -80,64 +165,418 @@ def worker_synctool(addr: str) -> None:
     if use_multiplex:
         synctool.multiplex.ssh_args(ssh_cmd_arr, nodename)
 
+    fingerprint = ''
+
     # rsync ROOTDIR/dirs/ to the node
     # if "it wants it"
     if not (OPT_SKIP_RSYNC or nodename in param.NO_RSYNC):
-        verbose('running rsync $SYNCTOOL/ to node %s' % nodename)
+        if param.RSYNC_FINGERPRINT and nodename not in RELAY_NODES:
+            fingerprint = RSYNC_FINGERPRINTS.get(_filter_profile(nodename), '')
+
+        if fingerprint:
+            # if the node already has this version of the repository,
+            # it runs synctool right away; no rsync needed
+            cmd_arr = ssh_cmd_arr[:]
+            cmd_arr.append('--')
+            cmd_arr.append(addr)
+            cmd_arr.extend(_check_fingerprint(fingerprint))
+            cmd_arr.extend(_synctool_cmd(nodename))
+
+            verbose('running synctool on node %s if up to date' % nodename)
+            exitcode = yield synctool.parallel.Command(cmd_arr, nodename,
+                                                       _timeout(param.SSH_TIMEOUT,
+                                                                deadline),
+                                                       stage=STAGE_SSH)
+            if exitcode != EXIT_STALE:
+                return exitcode
+
+            verbose('node %s is not up to date' % nodename)
+
+        exitcode = yield from rsync_repository(addr, nodename, ssh_cmd_arr,
+                                               deadline)
+        if exitcode == synctool.lib.EXIT_TIMEOUT:
+            # give up on this node; move on to the next one
+            return exitcode
+
+        if exitcode != 0:
+            # the node has some unknown version now
+            fingerprint = ''
+
+    if nodename in RELAY_NODES:
+        return (yield from run_relay_synctool(addr, nodename, ssh_cmd_arr))
 
-        # make rsync filter to include the correct dirs
-        tmp_filename = rsync_include_filter(nodename)
+    # run 'ssh node synctool_cmd'
+    cmd_arr = ssh_cmd_arr[:]
+    cmd_arr.append('--')
+    cmd_arr.append(addr)
+    if fingerprint:
+        cmd_arr.extend(_save_fingerprint(fingerprint))
+    cmd_arr.extend(_synctool_cmd(nodename))
 
-        cmd_arr = shlex.split(param.RSYNC_CMD)
-        cmd_arr.append('--filter=. %s' % tmp_filename)
+    verbose('running synctool on node %s' % nodename)
+    return (yield synctool.parallel.Command(cmd_arr, nodename,
+                                            _timeout(param.SSH_TIMEOUT, deadline),
+                                            stage=STAGE_SSH))
 
-        # add "-e ssh_cmd" to rsync command
-        cmd_arr.extend(['-e', ' '.join(ssh_cmd_arr)])
 
-        cmd_arr.append('--')
-        cmd_arr.append('%s/' % param.ROOTDIR)
-        cmd_arr.append('%s:%s/' % (addr, param.ROOTDIR))
+def _synctool_cmd(nodename: str) -> List[str]:
+    '''Returns synctool command to run on the node'''
 
-        # double check the rsync destination
-        # our filters are like playing with fire
-        if not param.ROOTDIR or (param.ROOTDIR == os.sep):
-            warning('cowardly refusing to rsync with rootdir == %s' %
-                    param.ROOTDIR)
-            sys.exit(-1)
+    cmd_arr = shlex.split(param.SYNCTOOL_CMD)
+    cmd_arr.append('--nodename=%s' % nodename)
+    cmd_arr.extend(PASS_ARGS)
+    return cmd_arr
 
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
 
-        # delete temp file
-        try:
-            os.unlink(tmp_filename)
-        except OSError:
-            # silently ignore unlink error
-            pass
+def _fingerprint_file() -> str:
+    '''Returns path of the file that holds the fingerprint
+    of the repository on the node
+    '''
+
+    return os.path.join(param.ROOTDIR, param.FINGERPRINT_FILE)
+
+
+def _check_fingerprint(fingerprint: str) -> List[str]:
+    '''Returns remote shell code that exits with EXIT_STALE
+    if the node does not have this fingerprint
+    It goes before the synctool command
+    '''
+
+    return ['test', '"$(cat %s 2>/dev/null)"' % _fingerprint_file(),
+            '=', fingerprint, '||', 'exit', '%d' % EXIT_STALE, ';', 'exec']
+
+
+def _save_fingerprint(fingerprint: str) -> List[str]:
+    '''Returns remote shell code that saves the fingerprint on the node
+    It goes before the synctool command
+    '''
+
+    # failing to save it is not an error; the node will get rsynced again
+    return ['{', 'echo', fingerprint, '>%s' % _fingerprint_file(), ';', '}',
+            '2>/dev/null', ';', 'exec']
+
+
+def rsync_repository(addr: str, nodename: str, ssh_cmd_arr: List[str],
+                     deadline: float) -> Generator[synctool.parallel.Command, int, int]:
+    '''rsync ROOTDIR/dirs/ to the node
+    Returns exit code of rsync
+    '''
+
+    # double check the rsync destination
+    # our filters are like playing with fire
+    if not param.ROOTDIR or (param.ROOTDIR == os.sep):
+        warning('cowardly refusing to rsync with rootdir == %s' %
+                param.ROOTDIR)
+        sys.exit(-1)
+
+    profile = _filter_profile(nodename)
+
+    # replay the rsync batch if the node has what the batch was made against
+    batch = RSYNC_BATCHES.get(profile)
+    if batch is not None and batch.matches(nodename):
+        verbose('replaying rsync batch on node %s' % nodename)
+
+        def _batch_output(line: str) -> None:
+            '''only show output in verbose mode; we can still fall back'''
+
+            verbose('%s: %s' % (nodename, line))
+
+        exitcode = yield synctool.parallel.Command(batch.read_cmd(ssh_cmd_arr, addr),
+                                                   nodename,
+                                                   _timeout(param.RSYNC_TIMEOUT,
+                                                            deadline),
+                                                   output=_batch_output,
+                                                   stage=STAGE_RSYNC,
+                                                   stdin_file=batch.filename)
+        if exitcode == 0:
+            batch.record(nodename)
+            return exitcode
+
+        if exitcode == synctool.lib.EXIT_TIMEOUT:
+            synctool.batch.forget(nodename)
+            return exitcode
+
+        verbose('rsync batch failed on node %s, falling back to rsync' % nodename)
+
+    verbose('running rsync $SYNCTOOL/ to node %s' % nodename)
+
+    # rsync filter to include the correct dirs
+    tmp_filename = RSYNC_FILTERS[profile]
+
+    cmd_arr = shlex.split(param.RSYNC_CMD)
+    cmd_arr.append('--filter=. %s' % tmp_filename)
+
+    # add "-e ssh_cmd" to rsync command
+    cmd_arr.extend(['-e', ' '.join(ssh_cmd_arr)])
+
+    cmd_arr.append('--')
+    cmd_arr.append('%s/' % param.ROOTDIR)
+    cmd_arr.append('%s:%s/' % (addr, param.ROOTDIR))
+
+    exitcode = yield synctool.parallel.Command(cmd_arr, nodename,
+                                               _timeout(param.RSYNC_TIMEOUT,
+                                                        deadline),
+                                               stage=STAGE_RSYNC)
+    if batch is not None:
+        # after a full rsync, the node is at the state of the mirror
+        if exitcode == 0:
+            batch.record(nodename)
+        else:
+            synctool.batch.forget(nodename)
+
+    return exitcode
+
+
+def run_relay_synctool(addr: str, relay: str,
+                       ssh_cmd_arr: List[str]) -> Generator[synctool.parallel.Command, int, int]:
+    '''run synctool on a relay node, which runs it on
+    the nodes in its subtree, and passes the output back to us
+    The exit codes of the nodes go into RELAY_RESULTS
+    Returns exit code of the relay
+    '''
 
-    # run 'ssh node synctool_cmd'
     cmd_arr = ssh_cmd_arr[:]
     cmd_arr.append('--')
     cmd_arr.append(addr)
-    cmd_arr.extend(shlex.split(param.SYNCTOOL_CMD))
-    cmd_arr.append('--nodename=%s' % nodename)
-    cmd_arr.extend(PASS_ARGS)
+    cmd_arr.extend(shlex.split(param.RELAY_CMD))
+    cmd_arr.append('--relay=%s' % relay)
+    cmd_arr.append('--node=%s' % synctool.range.compress(RELAY_NODES[relay]))
+    if OPT_SKIP_RSYNC:
+        cmd_arr.append('--skip-rsync')
 
-    verbose('running synctool on node %s' % nodename)
-    synctool.lib.run_with_nodename(cmd_arr, nodename)
+    # the relay logs through us anyway
+    cmd_arr.extend([arg for arg in PASS_ARGS if arg != '--masterlog'])
+
+    def _relay_output(line: str) -> None:
+        '''pick out the results of the nodes; pass on the rest'''
+
+        if line.startswith(RELAY_RESULT_TAG):
+            arr = line[len(RELAY_RESULT_TAG):].split()
+            if len(arr) == 2 and arr[0] in RELAY_NODES[relay]:
+                try:
+                    RELAY_RESULTS[arr[0]] = int(arr[1])
+                except ValueError:
+                    pass
+            return
+
+        synctool.lib.pass_relayed_output(line)
+
+    # The relay applies node_timeout per node, running num_proc nodes
+    # at a time. The relay itself gets that long for all of its nodes,
+    # plus one node_timeout for starting up, in case the relay hangs
+    timeout = 0.0
+    if param.NODE_TIMEOUT > 0:
+        waves = -(-len(RELAY_NODES[relay]) // max(param.NUM_PROC, 1))
+        timeout = float(param.NODE_TIMEOUT * (waves + 1))
+
+    verbose('running synctool on relay %s for %d nodes' %
+            (relay, len(RELAY_NODES[relay])))
+    return (yield synctool.parallel.Command(cmd_arr, relay, timeout,
+                                            output=_relay_output))
+
+
+def assign_relays(address_list: List[str]) -> List[str]:
+    '''hand nodes over to their relay nodes
+    Returns new address list, in which the relays stand in
+    for the nodes in their subtree
+    '''
+
+    if not param.RELAYS:
+        return address_list
+
+    # a node belongs to the first relay that lists any of its groups
+    # relays themselves (and the master) are never relayed
+    relays = set(param.RELAYS)
+    subtrees = [(relay, _relay_subtree(relay) - relays)
+                for relay in param.RELAYS if relay != param.NODENAME]
 
+    direct = []
+    for addr in address_list:
+        nodename = NODESET.get_nodename_from_address(addr)
+        if nodename == param.NODENAME:
+            direct.append(addr)
+            continue
+
+        for relay, subtree in subtrees:
+            if nodename == relay or nodename in subtree:
+                RELAY_NODES.setdefault(relay, []).append(nodename)
+                break
+        else:
+            direct.append(addr)
+
+    for relay, nodes in list(RELAY_NODES.items()):
+        addr = config.get_node_ipaddress(relay)
+        if nodes == [relay]:
+            # nothing to relay; it's just a node
+            del RELAY_NODES[relay]
+            direct.append(addr)
+            continue
+
+        # the relay may not be in the nodeset itself
+        NODESET.namemap[addr] = relay
+        direct.append(addr)
+
+    return direct
+
+
+def _relay_subtree(relay: str) -> Set[str]:
+    '''Returns set of nodes that the relay serves'''
+
+    groups = param.RELAYS[relay]
+    nodes = config.get_nodes_in_groups(groups)
+    # plain nodenames are allowed, too
+    nodes |= set(groups) & set(param.NODES)
+    return nodes
+
+
+def update_baseline(fingerprints: Dict[str, str], affected: Optional[Set[str]],
+                    address_list: List[str]) -> None:
+    '''save the baseline after a --changed or --baseline run
+    Affected nodes that were not in this run become pending
+    '''
+
+    if affected is None:
+        affected = set(config.get_all_nodes())
+
+    done = set(NODESET.get_nodename_from_address(addr) for addr in address_list)
+    for nodename in affected - done:
+        synctool.changed.mark_pending(nodename, True)
 
-def run_local_synctool() -> None:
-    '''run synctool on the master node itself'''
+    synctool.changed.save_baseline(fingerprints)
+
+
+def run_local_synctool(deadline: float = 0.0) -> Generator[synctool.parallel.Command, int, int]:
+    '''run synctool on the master node itself
+    Returns exit code
+    '''
 
-    cmd_arr = shlex.split(param.SYNCTOOL_CMD) + PASS_ARGS
+    cmd_arr = _synctool_cmd(param.NODENAME)
 
     verbose('running synctool on node %s' % param.NODENAME)
-    synctool.lib.run_with_nodename(cmd_arr, param.NODENAME)
+    return (yield synctool.parallel.Command(cmd_arr, param.NODENAME,
+                                            _timeout(param.SSH_TIMEOUT, deadline),
+                                            stage=STAGE_SSH))
+
+
+def _timeout(phase_timeout: int, deadline: float) -> float:
+    '''Returns timeout in seconds for a phase of the node's run,
+    which is the phase timeout, but no later than the node's deadline
+    Returns 0 for no timeout
+    '''
+
+    if not deadline:
+        return phase_timeout
+
+    # a phase always gets at least one second
+    time_left = max(deadline - time.monotonic(), 1.0)
+    if phase_timeout > 0:
+        return min(phase_timeout, time_left)
+
+    return time_left
+
+
+def make_rsync_filters(address_list: List[str]) -> None:
+    '''create the rsync filter files for the nodes in address_list
+    Nodes with the same groups get the same filter, so there is
+    only one filter file per distinct group profile
+    '''
+
+    if OPT_SKIP_RSYNC:
+        return
+
+    for addr in address_list:
+        nodename = NODESET.get_nodename_from_address(addr)
+        if nodename == param.NODENAME or nodename in param.NO_RSYNC:
+            continue
+
+        profile = _filter_profile(nodename)
+        if profile not in RSYNC_FILTERS:
+            RSYNC_FILTERS[profile] = rsync_include_filter(profile)
+
+    verbose('made %d rsync filters' % len(RSYNC_FILTERS))
+
+    if not (param.RSYNC_FINGERPRINT or param.RSYNC_BATCH):
+        return
+
+    for profile, filter_file in RSYNC_FILTERS.items():
+        RSYNC_FINGERPRINTS[profile] = _rsync_fingerprint(profile, filter_file)
+
+    if param.RSYNC_BATCH:
+        # the batches are made once per profile, here in the master process
+        for profile, filter_file in RSYNC_FILTERS.items():
+            batch = synctool.batch.Batch(synctool.batch.profile_key(profile))
+            if batch.write(filter_file, RSYNC_FINGERPRINTS[profile]):
+                RSYNC_BATCHES[profile] = batch
+
+        # the profiles of all nodes, not only the ones in this run
+        keys = set()
+        for nodename in param.NODES:
+            if nodename != param.NODENAME and nodename not in param.NO_RSYNC:
+                keys.add(synctool.batch.profile_key(_filter_profile(nodename)))
+        synctool.batch.prune(keys)
+
+
+def _rsync_fingerprint(profile: Optional[Tuple[str, ...]],
+                       filter_file: str) -> str:
+    '''Returns fingerprint of what a node with this profile gets rsynced'''
+
+    # the filter and rsync command determine what the node gets, too
+    try:
+        with open(filter_file, 'r', encoding='utf-8') as fio:
+            extra = fio.read()
+    except OSError as err:
+        error('failed to read %s: %s' % (filter_file, err.strerror))
+        # no fingerprint; always rsync
+        return ''
+
+    extra += param.RSYNC_CMD
+    return synctool.fingerprint.repo_fingerprint(profile, extra)
+
 
+def remove_rsync_filters() -> None:
+    '''delete the rsync filter files'''
 
-def rsync_include_filter(nodename: str) -> str:
+    for filename in RSYNC_FILTERS.values():
+        try:
+            os.unlink(filename)
+        except OSError:
+            # silently ignore unlink error
+            pass
+
+    RSYNC_FILTERS.clear()
+
+
+def _filter_profile(nodename: str) -> Optional[Tuple[str, ...]]:
+    '''Returns the group profile of a node, which determines
+    its rsync filter, or None for a slave node
+    The profile holds only the groups of the node that have a dir
+    under overlay/, delete/ or purge/; the other groups (like the
+    nodename itself) make no difference for what the node gets
+    '''
+
+    global REPO_GROUPS                                      # pylint: disable=global-statement
+
+    if nodename in param.SLAVES:
+        return None
+
+    if REPO_GROUPS is None:
+        REPO_GROUPS = set()
+        for path in (param.OVERLAY_DIR, param.DELETE_DIR, param.PURGE_DIR):
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+
+            REPO_GROUPS.update(name for name in names
+                               if os.path.isdir(os.path.join(path, name)))
+
+    return tuple(sorted(set(param.NODES.get(nodename, [])) & REPO_GROUPS))
+
+
+def rsync_include_filter(groups: Optional[Sequence[str]]) -> str:
     '''create temp file with rsync filter rules
-    Include only those dirs that apply for this node
+    Include only those dirs that apply for these groups;
+    if groups is None, include the entire tree (for slave nodes)
     Returns filename of the filter file
     '''
 
@@ -156,18 +595,14 @@ def rsync_include_filter(nodename: str) -> str:
     # include $SYNCTOOL/var/ but exclude
     # the top overlay/ and delete/ dir
     with ftemp:
-        ftemp.write('# synctool rsync filter')
-
-        # set mygroups for this nodename
-        param.NODENAME = nodename
-        param.MY_GROUPS = config.get_my_groups()
+        ftemp.write('# synctool rsync filter\n')
 
         # slave nodes get a copy of the entire tree
         # all other nodes use a specific rsync filter
-        if nodename not in param.SLAVES:
-            if not (_write_overlay_filter(ftemp) and
-                    _write_delete_filter(ftemp) and
-                    _write_purge_filter(ftemp)):
+        if groups is not None:
+            if not (_write_overlay_filter(ftemp, groups) and
+                    _write_delete_filter(ftemp, groups) and
+                    _write_purge_filter(ftemp, groups)):
                 # an error occurred;
                 # delete temp file and exit
                 ftemp.close()
@@ -185,12 +620,22 @@ def rsync_include_filter(nodename: str) -> str:
                     '- /lib/synctool/*.pyc\n'
                     '- /lib/synctool/pkg/*.pyc\n')
 
+        # the state of --changed is for the master only
+        ftemp.write('- /%s/\n' % param.CHANGED_DIR)
+
+        # the state files on the node are not in the repository;
+        # protect them from --delete, and do not send the master's own
+        for state_file in param.NODE_STATE_FILES:
+            ftemp.write('P /%s\n'
+                        '- /%s\n' % (state_file, state_file))
+
     # Note: remind to delete the temp file later
 
     return filename
 
 
-def _write_rsync_filter(fio: IO, overlaydir: str, label: str) -> None:
+def _write_rsync_filter(fio: IO, overlaydir: str, label: str,
+                        my_groups: Sequence[str]) -> None:
     '''helper function for writing rsync filter'''
 
     fio.write('+ /var/%s/\n' % label)
@@ -198,7 +643,7 @@ def _write_rsync_filter(fio: IO, overlaydir: str, label: str) -> None:
     groups = os.listdir(overlaydir)
 
     # add only the group dirs that apply
-    for grp in param.MY_GROUPS:
+    for grp in my_groups:
         if grp in groups:
             fdir = os.path.join(overlaydir, grp)
             if os.path.isdir(fdir):
@@ -207,25 +652,25 @@ def _write_rsync_filter(fio: IO, overlaydir: str, label: str) -> None:
     fio.write('- /var/%s/*\n' % label)
 
 
-def _write_overlay_filter(fio: IO) -> bool:
+def _write_overlay_filter(fio: IO, my_groups: Sequence[str]) -> bool:
     '''write rsync filter rules for overlay/ tree
     Returns False on error
     '''
 
-    _write_rsync_filter(fio, param.OVERLAY_DIR, 'overlay')
+    _write_rsync_filter(fio, param.OVERLAY_DIR, 'overlay', my_groups)
     return True
 
 
-def _write_delete_filter(fio: IO) -> bool:
+def _write_delete_filter(fio: IO, my_groups: Sequence[str]) -> bool:
     '''write rsync filter rules for delete/ tree
     Returns False on error
     '''
 
-    _write_rsync_filter(fio, param.DELETE_DIR, 'delete')
+    _write_rsync_filter(fio, param.DELETE_DIR, 'delete', my_groups)
     return True
 
 
-def _write_purge_filter(fio: IO) -> bool:
+def _write_purge_filter(fio: IO, my_groups: Sequence[str]) -> bool:
     '''write rsync filter rules for purge/ tree
     Returns False on error
     '''
@@ -235,7 +680,7 @@ def _write_purge_filter(fio: IO) -> bool:
     purge_groups = os.listdir(param.PURGE_DIR)
 
     # add only the group dirs that apply
-    for grp in param.MY_GROUPS:
+    for grp in my_groups:
         if grp in purge_groups:
             purge_root = os.path.join(param.PURGE_DIR, grp)
             if not os.path.isdir(purge_root):
@@ -253,7 +698,7 @@ def _write_purge_filter(fio: IO) -> bool:
                                'under %s/' % prettypath(purge_root))
                         return False
                 else:
-                    fio.write('+ /var/purge/%s/' % grp)
+                    fio.write('+ /var/purge/%s/\n' % grp)
                     break
 
     fio.write('- /var/purge/*\n')
@@ -338,6 +783,11 @@ def check_cmd_config() -> None:
     if not okay:
         errors += 1
 
+    if param.RELAYS:
+        okay, param.RELAY_CMD = config.check_cmd_config('relay_cmd', param.RELAY_CMD)
+        if not okay:
+            errors += 1
+
 #    okay, param.PKG_CMD = config.check_cmd_config('pkg_cmd', param.PKG_CMD)
 #    if not okay:
 #        errors += 1
@@ -420,12 +870,20 @@ def usage() -> None:
   -p, --purge=GROUP           Upload file or directory to $purge/group/
   -e, --erase-saved           Erase *.saved backup files
       --no-post               Do not run any .post scripts
+      --plan=FILE             Do a dry run, and write the changes to
+                              FILE on the nodes
+      --apply=FILE            Make the changes in plan FILE on the nodes
+      --full                  Do not skip unchanged subtrees
   -N, --numproc=NUM           Number of concurrent procs
   -F, --fullpath              Show full paths instead of shortened ones
   -T, --terse                 Show terse, shortened paths
       --color                 Use colored output (only for terse mode)
       --no-color              Do not color output
   -S, --skip-rsync            Do not sync the repository
+      --changed               Run only on nodes affected by changes
+                              since the baseline
+      --baseline              Save the baseline after this run
+      --relay=NODE            Run as relay node NODE for the master
       --version               Show current version number
       --check-update          Check for availibility of newer version
       --download              Download latest version
@@ -445,7 +903,8 @@ def get_options() -> Options:
 
     # pylint: disable=too-many-statements,too-many-branches,too-many-locals
 
-    global PASS_ARGS, OPT_SKIP_RSYNC                                # pylint: disable=global-statement
+    global PASS_ARGS, OPT_SKIP_RSYNC, OPT_RELAY                     # pylint: disable=global-statement
+    global OPT_CHANGED, OPT_BASELINE                                # pylint: disable=global-statement
 
     # check for typo's on the command-line;
     # things like "-diff" will trigger "-f" => "--fix"
@@ -462,7 +921,8 @@ def get_options() -> Options:
                                     'numproc=', 'fullpath', 'terse', 'color',
                                     'no-color', 'quiet', 'aggregate', 'unix',
                                     'skip-rsync', 'version', 'check-update',
-                                    'download'])
+                                    'download', 'relay=', 'changed',
+                                    'baseline', 'plan=', 'apply=', 'full'])
     except getopt.GetoptError as reason:
         print('%s: %s' % (PROGNAME, reason))
         # usage()
@@ -653,6 +1113,22 @@ def get_options() -> Options:
             OPT_SKIP_RSYNC = True
             continue
 
+        if opt == '--changed':
+            OPT_CHANGED = True
+            continue
+
+        if opt == '--baseline':
+            OPT_BASELINE = True
+            continue
+
+        if opt == '--relay':
+            # we are a relay node, running synctool on behalf of the master
+            OPT_RELAY = True
+            param.NODENAME = arg
+            # pass log lines on to the master
+            synctool.lib.MASTERLOG = True
+            continue
+
         if opt == '--check-update':
             options.check_update = True
             continue
@@ -703,6 +1179,22 @@ def get_options() -> Options:
 
     option_combinations(opt_diff, opt_single, opt_reference, opt_erase_saved,
                         opt_upload, opt_fix, opt_group)
+
+    if OPT_CHANGED and OPT_BASELINE:
+        error('option --changed and --baseline can not be combined')
+        sys.exit(1)
+
+    regular_run = not (opt_diff or opt_single or opt_reference or
+                       opt_erase_saved or opt_upload)
+
+    if OPT_CHANGED and not regular_run:
+        error('option --changed can only be used with a regular run')
+        sys.exit(1)
+
+    if OPT_BASELINE and not regular_run:
+        error('option --baseline can only be used with a regular run')
+        sys.exit(1)
+
     return options
 
 
@@ -712,6 +1204,8 @@ def main() -> int:
 
     # pylint: disable=too-many-statements,too-many-branches
 
+    global TRACK_PENDING                                            # pylint: disable=global-statement
+
     param.init()
 
     sys.stdout = synctool.unbuffered.Unbuffered(sys.stdout)             # type: ignore
@@ -745,7 +1239,7 @@ def main() -> int:
 
     config.init_mynodename()
 
-    if param.MASTER != param.HOSTNAME:
+    if param.MASTER != param.HOSTNAME and not OPT_RELAY:
         verbose('master %s != hostname %s' % (param.MASTER, param.HOSTNAME))
         error('not running on the master node')
         sys.exit(-1)
@@ -756,8 +1250,25 @@ def main() -> int:
 
     synctool.lib.openlog()
 
+    # take the fingerprints before the run; changes made during the run
+    # are seen by the next run
+    fingerprints: Dict[str, str] = {}
+    affected: Optional[Set[str]] = None
+    if OPT_CHANGED or OPT_BASELINE:
+        fingerprints = synctool.changed.fingerprints()
+        affected = synctool.changed.affected_nodes(fingerprints)
+        if OPT_CHANGED and affected is not None:
+            NODESET.restrict(affected)
+
     address_list = NODESET.addresses()
     if not address_list:
+        if OPT_CHANGED and address_list is not None:
+            stdout('no nodes affected by changes')
+            if not synctool.lib.DRY_RUN:
+                update_baseline(fingerprints, affected, [])
+            synctool.lib.closelog()
+            return 0
+
         print('no valid nodes specified')
         sys.exit(1)
 
@@ -775,7 +1286,8 @@ def main() -> int:
     else:
         # do regular synctool run
         # first print message about DRY RUN
-        if not synctool.lib.QUIET:
+        # a relay node leaves this to the master
+        if not (synctool.lib.QUIET or OPT_RELAY):
             if synctool.lib.DRY_RUN:
                 stdout('DRY RUN, not doing any updates')
                 terse(synctool.lib.TERSE_DRYRUN, 'not doing any updates')
@@ -789,8 +1301,14 @@ def main() -> int:
                 verbose('--fix specified, applying changes')
 
         make_tempdir()
+
+        TRACK_PENDING = (OPT_CHANGED or OPT_BASELINE) and not synctool.lib.DRY_RUN
+
         run_remote_synctool(address_list)
 
+        if TRACK_PENDING:
+            update_baseline(fingerprints, affected, address_list)
+
     synctool.lib.closelog()
     return 0
 
@@ -44,6 +44,8 @@ class NodeSet:
         self.exclude_nodes: Set[str] = set()
         self.exclude_groups: Set[str] = set()
         self.namemap: Dict[str, str] = {}
+        # if set, only these nodes are selected
+        self.restricted: Optional[Set[str]] = None
 
     def add_node(self, nodelist: str) -> None:
         '''add a node to the nodeset'''
@@ -85,6 +87,14 @@ class NodeSet:
             else:
                 self.exclude_groups.add(group)
 
+    def restrict(self, nodes: Set[str]) -> None:
+        '''select only these nodes (out of the nodeset)'''
+
+        if self.restricted is None:
+            self.restricted = set(nodes)
+        else:
+            self.restricted &= nodes
+
     def addresses(self, silent: bool = False) -> Optional[List[str]]:
         '''return list of addresses of relevant nodes
         or None on error
@@ -123,6 +133,9 @@ class NodeSet:
         # remove excluded nodes from nodelist
         self.nodelist -= self.exclude_nodes
 
+        if self.restricted is not None:
+            self.nodelist &= self.restricted
+
         if not self.nodelist:
             return []
 
@@ -12,27 +12,125 @@
 
 import os
 import stat
+import errno
 import datetime
 import shutil
-import hashlib
+import tempfile
+from concurrent.futures import Future
 
 try:
     import posix
 except ImportError:
     pass
 
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional, Tuple
 
+from synctool.compare import compare_contents
+import synctool.compare
+import synctool.deferred
+import synctool.durable
 import synctool.lib
 from synctool.lib import verbose, stdout, error, terse, unix_out, log
 from synctool.lib import dryrun_msg, prettypath, TERSE_FAIL, print_timestamp
 import synctool.param
+import synctool.prefetch
 import synctool.syncstat
+import synctool.verify
 
 SyncStat = synctool.syncstat.SyncStat
 
-# size for doing I/O while checksumming files
-IO_SIZE = 16 * 1024
+# destination stat of a SyncObject before make_stat() is called
+# it is never changed, so all objects share it
+_NO_STAT = SyncStat()
+
+# max bytes per copy_file_range() or sendfile() call
+COPY_SIZE = 1024 * 1024 * 1024
+# errors that mean the copy method is not supported here
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.ENOTSUP)
+
+# max length in bytes of the destination name in the name of a temp file;
+# the temp name has a prefix and suffix, and must not exceed NAME_MAX
+TEMP_NAME_MAX = 200
+
+
+def _temp_name(name: str) -> str:
+    '''Returns name, shortened to at most TEMP_NAME_MAX bytes'''
+
+    while len(os.fsencode(name)) > TEMP_NAME_MAX:
+        name = name[:-1]
+    return name
+
+
+def _copy_file_data(src_fd: int, dest_fd: int) -> None:
+    '''copy the contents of file src_fd to dest_fd
+    copy_file_range() copies inside the kernel, and on filesystems that
+    support it, the copy shares the data blocks (reflink).
+    If it is not supported, or stops short of the size of the source,
+    fall back to sendfile(), and then to plain reads and writes.
+    Each continues where the previous one left off; the file offsets
+    have moved along
+    Raises OSError on error, or if the copy is still short
+    '''
+
+    size = os.fstat(src_fd).st_size
+    copied = 0
+
+    if hasattr(os, 'copy_file_range'):
+        copied += _copy_in_kernel(lambda: os.copy_file_range(src_fd, dest_fd,
+                                                             COPY_SIZE))
+
+    if copied < size and hasattr(os, 'sendfile'):
+        copied += _copy_in_kernel(lambda: os.sendfile(dest_fd, src_fd, None,
+                                                      COPY_SIZE))
+
+    if copied < size:
+        copied += _copy_read_write(src_fd, dest_fd)
+
+    if copied < size:
+        raise OSError(errno.EIO, 'short copy, %d of %d bytes' % (copied, size))
+
+
+def _copy_in_kernel(copy_chunk: Callable[[], int]) -> int:
+    '''copy with copy_chunk() until it returns 0
+    Returns number of bytes copied; if the copy method is not supported,
+    that is what was copied until then
+    May raise OSError
+    '''
+
+    copied = 0
+    try:
+        while True:
+            num = copy_chunk()
+            if num <= 0:
+                break
+            copied += num
+    except OSError as err:
+        if err.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+
+    return copied
+
+
+def _copy_read_write(src_fd: int, dest_fd: int) -> int:
+    '''copy with plain reads and writes, until the end of file
+    Returns number of bytes copied
+    May raise OSError
+    '''
+
+    copied = 0
+    while True:
+        data = os.read(src_fd, synctool.compare.IO_SIZE)
+        if not data:
+            break
+
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.write(dest_fd, view[written:])
+        copied += written
+
+    return copied
 
 
 class VNode:
@@ -73,6 +171,8 @@ class VNode:
                                                               self.name,
                                                               err.strerror))
                 terse(TERSE_FAIL, 'save %s.saved' % self.name)
+            else:
+                synctool.lib.forget_dirs(self.name)
 
     def harddelete(self) -> None:
         '''delete existing entry'''
@@ -205,6 +305,8 @@ class VNodeFile(VNode):
 
         super().__init__(filename, statbuf, exists)
         self.src_path = src_path
+        # result of compare_contents(), if it was done ahead of time
+        self.prefetched: Optional['Future[Optional[Tuple[bool, str]]]'] = None
 
     def typename(self) -> str:
         '''return file type as human readable string'''
@@ -225,67 +327,45 @@ class VNodeFile(VNode):
             unix_out('# updating file %s' % self.name)
             return False
 
+        if synctool.verify.trust(self.stat, dest_stat):
+            return True
+
         return self._compare_checksums(src_path)
 
     def _compare_checksums(self, src_path: str) -> bool:
-        '''compare checksum of src_path and dest: self.name
+        '''compare contents of src_path and dest: self.name
         Return True if the same'''
 
-        try:
-            ffile1 = open(src_path, 'rb')
-        except OSError as err:
-            error('failed to open %s : %s' % (src_path, err.strerror))
-            # return True because we can't fix an error in src_path
-            return True
-
-        sum1 = hashlib.md5()
-        sum2 = hashlib.md5()
+        result = None
+        if self.prefetched is not None:
+            # the compare was done ahead of time in a thread
+            result = self.prefetched.result()
 
-        with ffile1:
-            try:
-                ffile2 = open(self.name, 'rb')
-            except OSError as err:
-                error('failed to open %s : %s' % (self.name, err.strerror))
-                return False
-
-            with ffile2:
-                ended = False
-                while not ended and (sum1.digest() == sum2.digest()):
-                    try:
-                        data1 = ffile1.read(IO_SIZE)
-                    except OSError as err:
-                        error('failed to read file %s: %s' % (src_path,
-                                                              err.strerror))
-                        return False
+        if result is None:
+            result = compare_contents(src_path, self.name)
 
-                    if not data1:
-                        ended = True
-                    else:
-                        sum1.update(data1)
+        same, errmsg = result
+        if errmsg:
+            error(errmsg)
+            return same
 
-                    try:
-                        data2 = ffile2.read(IO_SIZE)
-                    except OSError as err:
-                        error('failed to read file %s: %s' % (self.name,
-                                                              err.strerror))
-                        return False
+        if not same:
+            self._checksum_mismatch()
+            return False
 
-                    if not data2:
-                        ended = True
-                    else:
-                        sum2.update(data2)
+        return True
 
-        if sum1.digest() != sum2.digest():
-            if synctool.lib.DRY_RUN:
-                stdout('%s mismatch (MD5 checksum)' % self.name)
-            else:
-                stdout('%s updated (MD5 mismatch)' % self.name)
+    def _checksum_mismatch(self) -> None:
+        '''report that the contents of dest: self.name do not match'''
 
-            unix_out('# updating file %s' % self.name)
-            terse(synctool.lib.TERSE_SYNC, self.name)
-            return False
+        checksum = synctool.param.DIGEST_ALGORITHM.upper()
+        if synctool.lib.DRY_RUN:
+            stdout('%s mismatch (%s checksum)' % (self.name, checksum))
+        else:
+            stdout('%s updated (%s mismatch)' % (self.name, checksum))
 
-        return True
+        unix_out('# updating file %s' % self.name)
+        terse(synctool.lib.TERSE_SYNC, self.name)
 
     def create(self) -> None:
         '''copy file'''
@@ -304,6 +384,181 @@ class VNodeFile(VNode):
                       (prettypath(self.src_path), self.name, err.strerror))
                 terse(TERSE_FAIL, self.name)
 
+    def fix(self) -> None:
+        '''install the file atomically
+        The file is copied to a temp file in the destination directory,
+        which gets the owner, mode and times of the source,
+        and then it is renamed into place
+        '''
+
+        if synctool.lib.DRY_RUN:
+            # only print what would be done
+            super().fix()
+            return
+
+        self.mkdir_basepath()
+
+        if not self.exists:
+            terse(synctool.lib.TERSE_NEW, self.name)
+
+        verbose('  copy %s %s' % (self.src_path, self.name))
+        unix_out('cp %s %s' % (self.src_path, self.name))
+
+        tmp_filename = self._copy_to_tempfile()
+        if tmp_filename is None:
+            # error message already printed
+            return
+
+        if self.exists:
+            if os.path.isdir(self.name) and not os.path.islink(self.name):
+                # rename() can not replace a directory with a file
+                self._remove_dir()
+            elif synctool.param.BACKUP_COPIES:
+                # keep the old file in place, so the destination never
+                # goes missing
+                self._link_saved()
+
+        # rename() replaces any existing file atomically
+        try:
+            os.rename(tmp_filename, self.name)
+        except OSError as err:
+            error('failed to copy %s to %s: %s' %
+                  (prettypath(self.src_path), self.name, err.strerror))
+            terse(TERSE_FAIL, self.name)
+            try:
+                os.unlink(tmp_filename)
+            except OSError:
+                pass
+        else:
+            synctool.durable.add_dir(os.path.dirname(self.name))
+
+    def _remove_dir(self) -> None:
+        '''remove the directory that is in the way of the file
+        With backup_copies, or if it is not empty, move it to .saved
+        '''
+
+        if not synctool.param.BACKUP_COPIES:
+            verbose('  os.rmdir(%s)' % self.name)
+            try:
+                os.rmdir(self.name)
+            except OSError:
+                # probably directory not empty
+                verbose('refusing to delete directory %s' % self.name)
+            else:
+                synctool.lib.forget_dirs(self.name)
+                return
+
+        self.move_saved()
+
+    def _link_saved(self) -> None:
+        '''hard link existing file to .saved
+        If that is not possible, move it to .saved
+        '''
+
+        # do not save files that already are .saved
+        _, ext = os.path.splitext(self.name)
+        if ext == '.saved':
+            return
+
+        saved = '%s.saved' % self.name
+        verbose('saving %s as %s' % (self.name, saved))
+        unix_out('ln -f %s %s' % (self.name, saved))
+
+        verbose('  os.link(%s, %s)' % (self.name, saved))
+        try:
+            try:
+                os.link(self.name, saved)
+            except FileExistsError:
+                # replace the old .saved
+                os.unlink(saved)
+                os.link(self.name, saved)
+        except OSError as err:
+            if err.errno in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+                # the filesystem does not support hard links
+                self.move_saved()
+                return
+
+            error('failed to save %s as %s : %s' % (self.name, saved,
+                                                    err.strerror))
+            terse(TERSE_FAIL, 'save %s' % saved)
+
+    def _copy_to_tempfile(self) -> Optional[str]:
+        '''copy source to a new temp file next to the destination,
+        and set owner, mode and times on the open file
+        Returns the temp filename, or None on error
+        '''
+
+        try:
+            fdesc, tmp_filename = tempfile.mkstemp(
+                prefix='.%s.' % _temp_name(os.path.basename(self.name)),
+                suffix='.synctool', dir=os.path.dirname(self.name))
+        except OSError as err:
+            error('failed to create temp file for %s: %s' % (self.name,
+                                                             err.strerror))
+            terse(TERSE_FAIL, self.name)
+            return None
+
+        with os.fdopen(fdesc, 'wb') as fdest:
+            try:
+                with open(self.src_path, 'rb') as fsrc:
+                    _copy_file_data(fsrc.fileno(), fdest.fileno())
+            except OSError as err:
+                error('failed to copy %s to %s: %s' %
+                      (prettypath(self.src_path), self.name, err.strerror))
+                terse(TERSE_FAIL, self.name)
+                try:
+                    os.unlink(tmp_filename)
+                except OSError:
+                    pass
+                return None
+
+            self._set_attributes(fdest.fileno())
+            synctool.durable.add_file(fdest.fileno(), self.name)
+
+        return tmp_filename
+
+    def _set_attributes(self, fdesc: int) -> None:
+        '''set owner, mode and times on the open file
+        Errors are reported, but the file is still installed
+        '''
+
+        # chown before chmod; chown clears the setuid and setgid bits
+        verbose('  os.chown(%s, %d, %d)' % (self.name, self.stat.uid,
+                                            self.stat.gid))
+        unix_out('chown %s.%s %s' % (self.stat.ascii_uid(),
+                                     self.stat.ascii_gid(), self.name))
+        try:
+            os.fchown(fdesc, self.stat.uid, self.stat.gid)
+        except OSError as err:
+            error('failed to chown %s.%s %s : %s' %
+                  (self.stat.ascii_uid(), self.stat.ascii_gid(),
+                   self.name, err.strerror))
+            terse(TERSE_FAIL, 'owner %s' % self.name)
+
+        verbose('  os.chmod(%s, %04o)' % (self.name, self.stat.mode & 0o7777))
+        unix_out('chmod 0%o %s' % (self.stat.mode & 0o7777, self.name))
+        try:
+            os.fchmod(fdesc, self.stat.mode & 0o7777)
+        except OSError as err:
+            error('failed to chmod %04o %s : %s' %
+                  (self.stat.mode & 0o7777, self.name, err.strerror))
+            terse(TERSE_FAIL, 'mode %s' % self.name)
+
+        if not synctool.param.SYNC_TIMES:
+            return
+
+        verbose('  os.utime(%s, %s)' % (self.name,
+                                        print_timestamp(self.stat.mtime)))
+        datet = datetime.datetime.fromtimestamp(self.stat.mtime)
+        time_str = datet.strftime('%Y%m%d%H%M.%S')
+        unix_out('touch -t %s %s' % (time_str, self.name))
+        try:
+            os.utime(fdesc, (self.stat.atime, self.stat.mtime))
+        except OSError as err:
+            error('failed to set utime on %s : %s' % (self.name,
+                                                      err.strerror))
+            terse(TERSE_FAIL, 'utime %s' % self.name)
+
 
 class VNodeDir(VNode):
     '''vnode for a directory'''
@@ -358,6 +613,8 @@ class VNodeDir(VNode):
                 # refuse to delete dir, just move it aside
                 verbose('refusing to delete directory %s' % self.name)
                 self.move_saved()
+            else:
+                synctool.lib.forget_dirs(self.name)
 
     def quiet_delete(self) -> None:
         '''silently delete directory; only called by fix()'''
@@ -371,6 +628,8 @@ class VNodeDir(VNode):
                 # refuse to delete dir, just move it aside
                 verbose('refusing to delete directory %s' % self.name)
                 self.move_saved()
+            else:
+                synctool.lib.forget_dirs(self.name)
 
     def set_times(self) -> None:
         '''set access and modification times'''
@@ -645,6 +904,10 @@ class SyncObject():
     FIX_MODE = 8    # this is actually a bit
     FIX_TIME = 16   # this is actually a bit
 
+    # there is one for every entry in the overlay tree; no __dict__
+    __slots__ = ('src_path', 'dest_path', 'ov_type', 'src_stat', '_dest_stat',
+                 '_dest_snapshot', 'fix_action', 'prefetched')
+
     def __init__(self, src_name: str, dest_name: str, ov_type: int = 0) -> None:
         '''src_name is simple filename without leading path
         dest_name is the src_name without group extension
@@ -658,16 +921,65 @@ class SyncObject():
         self.dest_path = dest_name
         self.ov_type = ov_type
         self.src_stat = synctool.syncstat.SyncStat()
-        self.dest_stat = synctool.syncstat.SyncStat()
+        # the destination is stat'ed when it is first needed; see dest_stat
+        self._dest_stat: Optional[SyncStat] = _NO_STAT
+        self._dest_snapshot: Optional[synctool.syncstat.DirSnapshot] = None
         self.fix_action = SyncObject.FIX_UNDEF
+        # compare of the contents, started ahead of time (if any)
+        self.prefetched: Optional['Future[Optional[Tuple[bool, str]]]'] = None
 
     def make(self, src_dir: str, dest_dir: str) -> None:
         '''make() fills in the full paths and stat structures'''
 
+        self.make_paths(src_dir, dest_dir)
+        self.make_stat()
+
+    def make_paths(self, src_dir: str, dest_dir: str) -> None:
+        '''fills in the full paths, but not the stat structures'''
+
         self.src_path = os.path.join(src_dir, self.src_path)
-        self.src_stat = synctool.syncstat.SyncStat(self.src_path)
         self.dest_path = os.path.join(dest_dir, self.dest_path)
-        self.dest_stat = synctool.syncstat.SyncStat(self.dest_path)
+
+    def make_stat(self, src_entry: Optional['os.DirEntry[str]'] = None,
+                  dest_snapshot: Optional[synctool.syncstat.DirSnapshot] = None) -> None:
+        '''fills in the stat structures
+        The source stat is taken from src_entry, if given
+        The destination stat is taken from dest_snapshot, if given,
+        when it is first needed. Callbacks that never look at the
+        destination (like for --ref) do not stat it at all
+        '''
+
+        self.src_stat = synctool.syncstat.SyncStat(self.src_path, src_entry)
+        self._dest_stat = None
+        self._dest_snapshot = dest_snapshot
+
+    @property
+    def dest_stat(self) -> SyncStat:
+        '''the stat of the destination'''
+
+        if self._dest_stat is None:
+            if self._dest_snapshot is not None:
+                self._dest_stat = self._dest_snapshot.stat(self.dest_path)
+                self._dest_snapshot = None
+            else:
+                self._dest_stat = synctool.syncstat.SyncStat(self.dest_path)
+        return self._dest_stat
+
+    @dest_stat.setter
+    def dest_stat(self, statbuf: SyncStat) -> None:
+        '''set the stat of the destination'''
+
+        self._dest_stat = statbuf
+        self._dest_snapshot = None
+
+    def checked_stat(self) -> Optional[SyncStat]:
+        '''Returns the stat of the destination that it was checked against,
+        or None if it was not looked at
+        '''
+
+        if self._dest_stat is None or self._dest_stat is _NO_STAT:
+            return None
+        return self._dest_stat
 
     def print_src(self) -> str:
         '''pretty print my source path'''
@@ -714,6 +1026,9 @@ class SyncObject():
             # error message already printed
             return SyncObject.FIX_UNDEF
 
+        if isinstance(vnode, VNodeFile):
+            vnode.prefetched = self.prefetched
+
         if not vnode.compare(self.src_path, self.dest_stat):
             # content is different; change the entire object
             log('updating %s' % self.dest_path)
@@ -818,7 +1133,7 @@ class SyncObject():
         # run .post script, if needed
         # Note: for dirs, it is run from overlay._walk_subtree()
         if need_run and not self.src_stat.is_dir():
-            self.run_script(post_dict)
+            self.run_post_script(post_dict)
 
         return True
 
@@ -833,18 +1148,44 @@ class SyncObject():
 
         script = scripts_dict[self.dest_path]
 
+        # the script gets to see the installed files as they
+        # would be after a crash
+        synctool.durable.flush()
+        # and it may change files that were compared ahead of time,
+        # or create destinations that were not there when the dir was read
+        synctool.prefetch.invalidate()
+        synctool.syncstat.invalidate()
+
         # temporarily restore original umask
         # so the script runs with the umask set by the sysadmin
         os.umask(synctool.param.ORIG_UMASK)
+        synctool.lib.run_command_in_dir(self._script_dir(), script)
+        os.umask(0o77)
+
+    def run_post_script(self, post_dict: Dict[str, str]) -> None:
+        '''run .post script, if any
+        With post_num_proc set, it is queued to run after the walk
+        '''
+
+        if not synctool.deferred.enabled():
+            self.run_script(post_dict)
+            return
+
+        if synctool.lib.NO_POST or self.dest_path not in post_dict:
+            return
+
+        synctool.deferred.add(post_dict[self.dest_path], self._script_dir(),
+                              self.dest_path, self.src_stat.is_dir())
+
+    def _script_dir(self) -> str:
+        '''Returns directory to run .pre/.post script in'''
 
         if self.dest_stat.is_dir():
             # run in the directory itself
-            synctool.lib.run_command_in_dir(self.dest_path, script)
-        else:
-            # run in the directory where the file is
-            synctool.lib.run_command_in_dir(os.path.dirname(self.dest_path),
-                                            script)
-        os.umask(0o77)
+            return self.dest_path
+
+        # run in the directory where the file is
+        return os.path.dirname(self.dest_path)
 
     def vnode_obj(self) -> Optional[VNode]:
         '''create vnode object for this SyncObject
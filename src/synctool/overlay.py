@@ -32,19 +32,28 @@
     scripts that are in the current directory. Additionally, if the current
     directory itself has a .post script (which is in the parent directory),
     then the .post script is passed in the dict as well.
+
+    walk() yields the selected entries one by one, lazily; visit() calls
+    a callback function for each of them.
 '''
 
 import os
+import re
+import sys
 import fnmatch
-from functools import cmp_to_key
+import hashlib
 
-from typing import List, Dict, Tuple, Set, Callable, Optional
+from typing import List, Dict, Tuple, Set, Callable, Generator, Optional, Pattern
 
 import synctool.lib
-from synctool.lib import verbose, warning, terse, prettypath
+from synctool.lib import verbose, warning, error, terse, prettypath
 import synctool.object
 from synctool.object import SyncObject
 import synctool.param
+import synctool.plan
+import synctool.prefetch
+import synctool.statedb
+import synctool.syncstat
 
 # const enum object types
 OV_REG = 0
@@ -55,6 +64,220 @@ OV_TEMPLATE_POST = 4
 OV_NO_EXT = 5
 OV_IGNORE = 6
 
+# minimum number of entries in an overlay dir to read
+# the destination dir at once, rather than lstat() each entry
+DEST_SNAPSHOT_MIN = 8
+
+# walk() yields (SyncObject, pre_dict, post_dict)
+# the consumer may send back whether it updated the entry
+WalkItem = Tuple[SyncObject, Dict[str, str], Dict[str, str]]
+
+# max number of filenames that the Resolver remembers
+# the names that come back (in every group dir, and in delete/)
+# are mostly seen early on; this limits the memory for huge trees
+RESOLVER_MEMO_MAX = 100000
+
+# filenames that are skipped by _split_extension()
+# these are not real ov_types; they go with importance -1
+_UNKNOWN_GROUP = -1
+_NOT_MY_GROUP = -2
+
+# sort order of the types of entries in a directory
+# .pre and .post scripts come first, so that pre_dict and post_dict
+# have the script when it is needed. Then come the template generators,
+# and then the templates. Everything else sorts by importance only
+_TYPE_ORDER = {OV_PRE: 0, OV_POST: 1, OV_TEMPLATE_POST: 2, OV_TEMPLATE: 3}
+_TYPE_ORDER_OTHER = 4
+
+
+class Resolver:
+    '''resolves names in the overlay tree
+    It is made once per run, rather than for every entry: it holds
+    the importance of each group, a single regex for all ignore patterns,
+    and a memo of the filenames parsed so far
+    (the same names come back in overlay/ and delete/, and in every
+    group directory)
+    '''
+
+    def __init__(self) -> None:
+        '''initialize instance from the config in synctool.param'''
+
+        self.my_groups = synctool.param.MY_GROUPS[:]
+        self.ignore_files = set(synctool.param.IGNORE_FILES)
+        self.ignore_wildcards = synctool.param.IGNORE_FILES_WITH_WILDCARDS[:]
+
+        # importance of each group; the first one counts
+        self.importance: Dict[str, int] = {}
+        for idx, group in enumerate(self.my_groups):
+            self.importance.setdefault(group, idx)
+        # the importance of group 'all'; it is the final group in MY_GROUPS
+        self.group_all = len(self.my_groups) - 1
+
+        self.ignore_re: Optional[Pattern[str]] = None
+        if self.ignore_wildcards:
+            self.ignore_re = re.compile('|'.join(fnmatch.translate(pattern)
+                                                 for pattern in self.ignore_wildcards))
+
+        # filename -> (ov_type, dest_name, importance)
+        self.memo: Dict[str, Tuple[int, str, int]] = {}
+
+    def is_current(self) -> bool:
+        '''Returns True if the config did not change'''
+
+        return (self.my_groups == synctool.param.MY_GROUPS and
+                self.ignore_files == synctool.param.IGNORE_FILES and
+                self.ignore_wildcards == synctool.param.IGNORE_FILES_WITH_WILDCARDS)
+
+    def parse(self, filename: str) -> Tuple[int, str, int]:
+        '''parse filename in the overlay tree, without leading path
+        Returns tuple: ov_type, dest_name, importance
+        If importance is -1, ov_type says why the name is skipped
+        '''
+
+        parsed = self.memo.get(filename)
+        if parsed is None:
+            parsed = self._parse(filename)
+            if len(self.memo) < RESOLVER_MEMO_MAX:
+                self.memo[filename] = parsed
+        return parsed
+
+    def _parse(self, filename: str) -> Tuple[int, str, int]:
+        '''parse filename, without the memo'''
+
+        # pylint: disable=too-many-branches, too-many-return-statements
+
+        (name, ext) = os.path.splitext(filename)
+        if not ext:
+            return OV_NO_EXT, sys.intern(name), self.group_all
+
+        if ext == '.pre':
+            # it's a generic .pre script
+            return OV_PRE, sys.intern(name), self.group_all
+
+        if ext == '.post':
+            (name2, ext) = os.path.splitext(name)
+            if ext == '._template':
+                # it's a generic template generator
+                return OV_TEMPLATE_POST, sys.intern(name), self.group_all
+
+            # it's a generic .post script
+            return OV_POST, sys.intern(name), self.group_all
+
+        if ext[:2] != '._':
+            return OV_NO_EXT, sys.intern(filename), self.group_all
+
+        ext = ext[2:]
+        if not ext:
+            return OV_NO_EXT, sys.intern(filename), self.group_all
+
+        if ext == 'template':
+            return OV_TEMPLATE, sys.intern(name), self.group_all
+
+        importance = self.importance.get(ext, -1)
+        if importance < 0:
+            if ext not in synctool.param.ALL_GROUPS:
+                return _UNKNOWN_GROUP, '', -1
+
+            # it is not one of my groups
+            return _NOT_MY_GROUP, '', -1
+
+        (name2, ext) = os.path.splitext(name)
+
+        if ext == '.pre':
+            # register group-specific .pre script
+            return OV_PRE, sys.intern(name2), importance
+
+        if ext == '.post':
+            _, ext = os.path.splitext(name2)
+            if ext == '._template':
+                # it's a group-specific template generator
+                return OV_TEMPLATE_POST, sys.intern(name2), importance
+
+            # register group-specific .post script
+            return OV_POST, sys.intern(name2), importance
+
+        if ext == '._template':
+            return OV_TEMPLATE, sys.intern(name2), importance
+
+        return OV_REG, sys.intern(name), importance
+
+
+_RESOLVER: Optional[Resolver] = None
+
+
+class DestSet:
+    '''set of destination paths that were already handled
+    Rather than the full path of every entry, it keeps a set of names
+    per directory. The names are interned, so a name is kept only once
+    for all directories that have it, and for the Resolver memo
+    '''
+
+    __slots__ = ('dirs',)
+
+    def __init__(self) -> None:
+        '''initialize instance'''
+
+        self.dirs: Dict[str, Set[str]] = {}
+
+    def __contains__(self, path: str) -> bool:
+        '''Returns True if path is in the set'''
+
+        dirname, name = os.path.split(path)
+        names = self.dirs.get(dirname)
+        return names is not None and name in names
+
+    def __len__(self) -> int:
+        '''Returns number of paths in the set'''
+
+        return sum(len(names) for names in self.dirs.values())
+
+    def add(self, path: str) -> None:
+        '''add path to the set'''
+
+        dirname, name = os.path.split(path)
+        names = self.dirs.get(dirname)
+        if names is None:
+            names = self.dirs[dirname] = set()
+        names.add(sys.intern(name))
+
+
+class _WalkContext:
+    '''settings and state shared by all directories of a walk; see walk()'''
+
+    __slots__ = ('duplicates', 'prefetch', 'only', 'incremental')
+
+    def __init__(self, prefetch: bool, only: Optional[Set[str]],
+                 incremental: bool) -> None:
+        '''initialize instance'''
+
+        # keeps us from selecting any duplicate matches
+        self.duplicates = DestSet()
+        self.prefetch = prefetch
+        self.only = only
+        self.incremental = incremental
+
+
+def _resolver() -> Resolver:
+    '''Returns the Resolver for this run
+    It is made anew only if the config changed
+    '''
+
+    global _RESOLVER                                        # pylint: disable=global-statement
+
+    if _RESOLVER is None or not _RESOLVER.is_current():
+        _RESOLVER = Resolver()
+    return _RESOLVER
+
+
+def ignored(name: str) -> bool:
+    '''Returns True if name is in ignore_files, or matches an ignore pattern'''
+
+    resolver = _resolver()
+    if name in resolver.ignore_files:
+        return True
+
+    return resolver.ignore_re is not None and resolver.ignore_re.match(name) is not None
+
 
 def _toplevel(overlay: str) -> List[str]:
     '''Returns sorted list of fullpath directories under overlay/'''
@@ -64,11 +287,11 @@ def _toplevel(overlay: str) -> List[str]:
 
     arr: List[Tuple[str, int]] = []
 
+    importances = _resolver().importance
     for entry in os.listdir(overlay):
         fullpath = os.path.join(overlay, entry)
-        try:
-            importance = synctool.param.MY_GROUPS.index(entry)
-        except ValueError:
+        importance = importances.get(entry, -1)
+        if importance < 0:
             verbose('%s/ is not one of my groups, skipping' %
                     prettypath(fullpath))
             continue
@@ -82,173 +305,126 @@ def _toplevel(overlay: str) -> List[str]:
     return [x[0] for x in arr]
 
 
-def _group_all() -> int:
-    '''Return the importance level of group 'all' '''
-
-    # it is the final group in MY_GROUPS
-    return len(synctool.param.MY_GROUPS) - 1
-
-
 def _split_extension(filename: str, src_dir: str) -> Tuple[Optional[SyncObject], int]:
     '''filename in the overlay tree, without leading path
     src_dir is passed for the purpose of printing error messages
     Returns tuple: SyncObject, importance
     '''
 
-    # pylint: disable=too-many-branches, too-many-return-statements
-
-    (name, ext) = os.path.splitext(filename)
-    if not ext:
-        return SyncObject(filename, name, OV_NO_EXT), _group_all()
-
-    if ext == '.pre':
-        # it's a generic .pre script
-        return SyncObject(filename, name, OV_PRE), _group_all()
-
-    if ext == '.post':
-        (name2, ext) = os.path.splitext(name)
-        if ext == '._template':
-            # it's a generic template generator
-            return SyncObject(filename, name, OV_TEMPLATE_POST), _group_all()
-
-        # it's a generic .post script
-        return SyncObject(filename, name, OV_POST), _group_all()
-
-    if ext[:2] != '._':
-        return SyncObject(filename, filename, OV_NO_EXT), _group_all()
-
-    ext = ext[2:]
-    if not ext:
-        return SyncObject(filename, filename, OV_NO_EXT), _group_all()
-
-    if ext == 'template':
-        return SyncObject(filename, name, OV_TEMPLATE), _group_all()
-
-    try:
-        importance = synctool.param.MY_GROUPS.index(ext)
-    except ValueError:
-        if ext not in synctool.param.ALL_GROUPS:
-            src_path = os.path.join(src_dir, filename)
+    ov_type, dest_name, importance = _resolver().parse(filename)
+    if importance < 0:
+        src_path = os.path.join(src_dir, filename)
+        if ov_type == _UNKNOWN_GROUP:
             if synctool.param.TERSE:
                 terse(synctool.lib.TERSE_ERROR, ('invalid group on %s' %
                                                  src_path))
             else:
                 warning('unknown group on %s, skipped' % prettypath(src_path))
-            return None, -1
-
-        # it is not one of my groups
-        verbose('skipping %s, it is not one of my groups' %
-                prettypath(os.path.join(src_dir, filename)))
+        else:
+            verbose('skipping %s, it is not one of my groups' %
+                    prettypath(src_path))
         return None, -1
 
-    (name2, ext) = os.path.splitext(name)
+    return SyncObject(filename, dest_name, ov_type), importance
 
-    if ext == '.pre':
-        # register group-specific .pre script
-        return SyncObject(filename, name2, OV_PRE), importance
 
-    if ext == '.post':
-        _, ext = os.path.splitext(name2)
-        if ext == '._template':
-            # it's a group-specific template generator
-            return (SyncObject(filename, name2, OV_TEMPLATE_POST), importance)
-
-        # register group-specific .post script
-        return SyncObject(filename, name2, OV_POST), importance
-
-    if ext == '._template':
-        return SyncObject(filename, name2, OV_TEMPLATE), importance
-
-    return SyncObject(filename, name), importance
-
-
-def _sort_by_importance_post_first(item1: Tuple[SyncObject, int], item2: Tuple[SyncObject, int]) -> int:
-    '''sort by importance, but always put .post scripts first'''
+def _sort_key(item: Tuple[SyncObject, int]) -> Tuple[int, int]:
+    '''Returns sort key for (SyncObject, importance):
+    by type of entry, then by importance
+    '''
 
-    # pylint: disable=too-many-return-statements
+    obj, importance = item
+    return _TYPE_ORDER.get(obj.ov_type, _TYPE_ORDER_OTHER), importance
 
-    # after the .post scripts come ._template.post scripts
-    # then come regular files
-    # This order is important
 
-    obj1, importance1 = item1
-    obj2, importance2 = item2
+def _scan_dir(src_dir: str) -> Tuple[List[Tuple[SyncObject, int]],
+                                     Dict[str, 'os.DirEntry[str]']]:
+    '''read directory in the overlay tree
+    Returns list of (SyncObject, importance), sorted with .pre and .post
+    scripts first, and dict of DirEntry objects by filename
+    Ignored entries and entries for other groups are left out
+    '''
 
-    # if types are the same, just sort by importance
-    if obj1.ov_type == obj2.ov_type:
-        if importance1 < importance2:
-            return -1
-        return int(importance1 == importance2)
+    resolver = _resolver()
 
-    if obj1.ov_type == OV_PRE:
-        return -1
-    if obj2.ov_type == OV_PRE:
-        return 1
+    # The DirEntry objects from scandir() know the file type without
+    # doing a stat(), and they cache the stat once it is done.
+    # Entries that are skipped are never stat'ed at all
+    arr = []
+    entries: Dict[str, 'os.DirEntry[str]'] = {}
+    with os.scandir(src_dir) as it_entries:
+        for entry in it_entries:
+            name = entry.name
+            if name in resolver.ignore_files:
+                verbose('ignoring %s' % prettypath(entry.path))
+                continue
 
-    if obj1.ov_type == OV_POST:
-        return -1
-    if obj2.ov_type == OV_POST:
-        return 1
+            # check any ignored files with wildcards
+            # before any group extension is examined
+            if resolver.ignore_re is not None and resolver.ignore_re.match(name):
+                verbose('ignoring %s (pattern match)' % prettypath(entry.path))
+                continue
 
-    if obj1.ov_type == OV_TEMPLATE_POST:
-        return -1
-    if obj2.ov_type == OV_TEMPLATE_POST:
-        return 1
+            obj, importance = _split_extension(name, src_dir)
+            if obj is None:
+                continue
 
-    if obj1.ov_type == OV_TEMPLATE:
-        return -1
-    if obj2.ov_type == OV_TEMPLATE:
-        return 1
+            arr.append((obj, importance))
+            entries[name] = entry
 
-    # get the REG vs NO_EXT/IGNORE types here
-    return 0
+    # sort with .pre and .post scripts first
+    # this ensures that post_dict will have the required script when needed
+    arr.sort(key=_sort_key)
+    return arr, entries
 
 
-def _walk_subtree(src_dir: str, dest_dir: str, duplicates: Set[str],
-                  callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> Tuple[bool, bool]:
+def _walk_subtree(src_dir: str, dest_dir: str, ctx: _WalkContext,
+                  dest_new: bool = False) -> Generator[WalkItem, Optional[bool], bool]:
     '''walk subtree under overlay/group/
-    duplicates is a set that keeps us from selecting any duplicate matches
-    Returns pair of booleans: ok, dir was updated
+    Yields (SyncObject, pre_dict, post_dict) for every selected entry;
+    see walk()
+    dest_new is True if dest_dir did not exist before this run
+    If ctx.prefetch is True, file contents are compared ahead in threads
+    If ctx.only is given, entries that are not in it are skipped
+    If ctx.incremental is True, the subtree is skipped if it did not change
+    since the last run
+    Returns True if the dir was updated
     '''
 
     # pylint: disable=too-many-locals,too-many-statements,too-many-branches
 
-    arr = []
-    for entry in os.listdir(src_dir):
-        if entry in synctool.param.IGNORE_FILES:
-            verbose('ignoring %s' % prettypath(os.path.join(src_dir, entry)))
-            continue
-
-        # check any ignored files with wildcards
-        # before any group extension is examined
-        wildcard_match = False
-        for wildcard_entry in synctool.param.IGNORE_FILES_WITH_WILDCARDS:
-            if fnmatch.fnmatchcase(entry, wildcard_entry):
-                wildcard_match = True
-                verbose('ignoring %s (pattern match)' %
-                        prettypath(os.path.join(src_dir, entry)))
-                break
-
-        if wildcard_match:
-            continue
+    duplicates = ctx.duplicates
 
-        obj, importance = _split_extension(entry, src_dir)
-        if obj is None:
-            continue
+    if ctx.incremental and synctool.statedb.unchanged(dest_dir):
+        verbose('skipping %s, unchanged since the last run' %
+                (prettypath(src_dir) + os.sep))
+        return False
 
-        arr.append((obj, importance))
+    arr, entries = _scan_dir(src_dir)
 
-    # sort with .pre and .post scripts first
-    # this ensures that post_dict will have the required script when needed
+    # Read the destination dir only once, rather than lstat() every entry.
+    # Entries that are not in the snapshot cost nothing, and if the dir
+    # does not exist, it is a single syscall for all entries.
+    # A big destination dir (like /usr/bin) with only a few entries
+    # in the overlay is cheaper to lstat() entry by entry
+    dest_snapshot = None
+    if dest_new or len(arr) >= DEST_SNAPSHOT_MIN:
+        dest_snapshot = synctool.syncstat.DirSnapshot(dest_dir)
 
-    arr.sort(key=cmp_to_key(_sort_by_importance_post_first))
+    dir_prefetch = None
+    if ctx.prefetch:
+        dir_prefetch = synctool.prefetch.enter_dir(_prefetch_pairs(arr, entries,
+                                                                   src_dir, dest_dir,
+                                                                   duplicates))
 
     pre_dict: Dict[str, str] = {}
     post_dict: Dict[str, str] = {}
     dir_changed = False
 
-    for obj, importance in arr:
-        obj.make(src_dir, dest_dir)
+    for obj, _ in arr:
+        entry = entries[obj.src_path]
+        # scripts are only registered; they need no stat
+        obj.make_paths(src_dir, dest_dir)
 
         if obj.ov_type == OV_PRE:
             # register the .pre script and continue
@@ -277,45 +453,50 @@ def _walk_subtree(src_dir: str, dest_dir: str, duplicates: Set[str],
             post_dict[obj.dest_path] = obj.src_path
             continue
 
-        if obj.src_stat.is_dir():
+        if ctx.only is not None and obj.src_path not in ctx.only:
+            # not on the way to any entry that we are looking for
+            continue
+
+        if entry.is_dir(follow_symlinks=False):
             if synctool.param.IGNORE_DOTDIRS:
-                name = os.path.basename(obj.src_path)
-                if name[0] == '.':
-                    verbose('ignoring dotdir %s' % obj.print_src())
+                if entry.name[0] == '.':
+                    verbose('ignoring dotdir %s' % (prettypath(obj.src_path) + os.sep))
                     continue
 
             updated = False
+            subdir_new = False
             if obj.dest_path not in duplicates:
                 # this is the most important source for this dir
                 duplicates.add(obj.dest_path)
+                obj.make_stat(entry, dest_snapshot)
+                subdir_new = not obj.dest_stat.exists()
 
-                # run callback on the directory itself
-                # this will create or fix directory entry if needed
+                # yield the directory itself
+                # the consumer will create or fix directory entry if needed
                 # a .pre script may be run
                 # a .post script should not be run
-                okay, updated = callback(obj, pre_dict, {})
-                if not okay:
-                    # quick exit
-                    return False, dir_changed
+                updated = bool((yield obj, pre_dict, {}))
+                if ctx.incremental:
+                    synctool.statedb.checked(obj.dest_path, obj.checked_stat(), updated)
 
             # recurse down into the directory
             # with empty pre_dict and post_dict parameters
-            okay, updated2 = _walk_subtree(obj.src_path, obj.dest_path,
-                                           duplicates, callback)
-            if not okay:
-                # quick exit
-                return False, dir_changed
+            updated2 = yield from _walk_subtree(obj.src_path, obj.dest_path,
+                                                ctx, subdir_new)
 
             # we still need to run the .post script on the dir (if any)
             if updated or updated2:
-                obj.run_script(post_dict)
+                if not obj.src_stat.exists():
+                    # it was a duplicate dir; not stat'ed yet
+                    obj.make_stat(entry, dest_snapshot)
+                synctool.plan.add_dir_script(obj, post_dict)
+                obj.run_post_script(post_dict)
 
             # finished checking directory
             continue
 
         if synctool.param.IGNORE_DOTFILES:
-            name = os.path.basename(obj.src_path)
-            if name[0] == '.':
+            if entry.name[0] == '.':
                 verbose('ignoring dotfile %s' % obj.print_src())
                 continue
 
@@ -332,46 +513,336 @@ def _walk_subtree(src_dir: str, dest_dir: str, duplicates: Set[str],
             continue
 
         duplicates.add(obj.dest_path)
+        obj.make_stat(entry, dest_snapshot)
+        if dir_prefetch is not None:
+            obj.prefetched = dir_prefetch.take(obj.dest_path)
 
-        okay, updated = callback(obj, pre_dict, post_dict)
-        if not okay:
-            # quick exit
-            return False, dir_changed
+        updated = bool((yield obj, pre_dict, post_dict))
 
         if obj.ov_type == OV_IGNORE:
             # OV_IGNORE may be set by templates that didn't finish
+            if ctx.incremental:
+                synctool.statedb.checked(obj.dest_path, None, False)
             continue
 
         if obj.ov_type == OV_TEMPLATE:
             # a new file was generated
-            # call callback on the generated file
+            # yield the generated file
             obj.ov_type = OV_REG
             obj.make(src_dir, dest_dir)
 
-            okay, updated = callback(obj, pre_dict, post_dict)
-            if not okay:
-                # quick exit
-                return False, dir_changed
+            updated = bool((yield obj, pre_dict, post_dict))
+
+        if ctx.incremental:
+            synctool.statedb.checked(obj.dest_path, obj.checked_stat(), updated)
 
         if updated:
             dir_changed = True
 
-    return True, dir_changed
+    if dir_prefetch is not None:
+        synctool.prefetch.leave_dir(dir_prefetch)
+
+    return dir_changed
+
+
+def _prefetch_pairs(arr: List[Tuple[SyncObject, int]],
+                    entries: Dict[str, 'os.DirEntry[str]'],
+                    src_dir: str, dest_dir: str,
+                    duplicates: DestSet) -> List[Tuple[str, str]]:
+    '''Returns list of (src_path, dest_path) of the regular files
+    that the walk is going to check, in walk order
+    '''
+
+    pairs = []
+    seen = set()
+    for obj, _ in arr:
+        if obj.ov_type not in (OV_REG, OV_NO_EXT):
+            continue
+
+        if synctool.param.REQUIRE_EXTENSION and obj.ov_type == OV_NO_EXT:
+            continue
+
+        entry = entries[obj.src_path]
+        if synctool.param.IGNORE_DOTFILES and entry.name[0] == '.':
+            continue
+
+        if not entry.is_file(follow_symlinks=False):
+            continue
+
+        dest_path = os.path.join(dest_dir, obj.dest_path)
+        if dest_path in duplicates or dest_path in seen:
+            continue
+
+        seen.add(dest_path)
+        pairs.append((os.path.join(src_dir, obj.src_path), dest_path))
+
+    return pairs
+
+
+def fingerprints(overlay: str, settled_ns: int) -> Dict[str, Optional[str]]:
+    '''Returns the fingerprint of the sources of each destination dir
+    It is a hash over the metadata of all sources below the destination
+    dir, in all of my groups. Like in a Merkle tree, the fingerprint of
+    a directory covers those of its subdirectories, so any change below
+    a directory changes its fingerprint.
+    A destination dir has no fingerprint (None) if there are templates
+    below it, as they are generated anew every run, or if any source
+    changed at or after settled_ns; it may change again unnoticed
+    '''
+
+    # dest dir -> list of (src dir, fingerprint), in order of importance
+    sources: Dict[str, List[Tuple[str, Optional[bytes]]]] = {}
+    for direct in _toplevel(overlay):
+        _fingerprint_dir(direct, os.sep, sources, settled_ns)
+
+    result: Dict[str, Optional[str]] = {}
+    for dest_dir, arr in sources.items():
+        hasher = hashlib.sha1()
+        for src_dir, digest in arr:
+            if digest is None:
+                result[dest_dir] = None
+                break
+
+            hasher.update(src_dir.encode(errors='surrogateescape'))
+            hasher.update(digest)
+        else:
+            result[dest_dir] = hasher.hexdigest()
+    return result
+
+
+def _fingerprint_dir(src_dir: str, dest_dir: str,
+                     sources: Dict[str, List[Tuple[str, Optional[bytes]]]],
+                     settled_ns: int) -> Optional[bytes]:
+    '''Returns fingerprint of overlay directory src_dir and all below it,
+    or None if it has none; see fingerprints()
+    The fingerprint is added to sources, for dest_dir
+    '''
+
+    hasher = hashlib.sha1()
+
+    dir_entries = _sorted_entries(src_dir)
+    settled = dir_entries is not None
+
+    for entry in dir_entries or []:
+        name = entry.name
+        if ignored(name):
+            continue
+
+        ov_type, dest_name, importance = _resolver().parse(name)
+        if importance < 0:
+            # not one of my groups
+            continue
 
+        if ov_type in (OV_TEMPLATE, OV_TEMPLATE_POST):
+            settled = False
 
-def visit(overlay: str, callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]]) -> None:
+        metadata = _entry_metadata(entry, settled_ns)
+        if metadata is None:
+            settled = False
+            continue
+
+        hasher.update(metadata)
+
+        if (ov_type in (OV_REG, OV_NO_EXT) and
+                entry.is_dir(follow_symlinks=False) and
+                not (synctool.param.IGNORE_DOTDIRS and name[0] == '.')):
+            digest = _fingerprint_dir(entry.path, os.path.join(dest_dir, dest_name),
+                                      sources, settled_ns)
+            if digest is None:
+                settled = False
+            else:
+                hasher.update(digest)
+
+    fingerprint = hasher.digest() if settled else None
+    sources.setdefault(dest_dir, []).append((src_dir, fingerprint))
+    return fingerprint
+
+
+def _sorted_entries(src_dir: str) -> Optional[List['os.DirEntry[str]']]:
+    '''Returns the entries of src_dir sorted by name, or None on error'''
+
+    try:
+        with os.scandir(src_dir) as it_entries:
+            return sorted(it_entries, key=lambda entry: entry.name)
+    except OSError:
+        return None
+
+
+def _entry_metadata(entry: 'os.DirEntry[str]', settled_ns: int) -> Optional[bytes]:
+    '''Returns the metadata of an overlay entry for its fingerprint,
+    or None if it changed at or after settled_ns, or on error
+    '''
+
+    try:
+        statbuf = entry.stat(follow_symlinks=False)
+    except OSError:
+        return None
+
+    if statbuf.st_ctime_ns >= settled_ns:
+        return None
+
+    return ('%s %o %d %d %d %d %d %d\n' %
+            (entry.name, statbuf.st_mode, statbuf.st_uid, statbuf.st_gid,
+             statbuf.st_size, statbuf.st_mtime_ns, statbuf.st_ctime_ns,
+             statbuf.st_ino)).encode(errors='surrogateescape')
+
+
+def walk(overlay: str, prefetch: bool = False,
+         only: Optional[Set[str]] = None,
+         incremental: bool = False) -> Generator[WalkItem, Optional[bool], None]:
+    '''walk the overlay tree
+    overlay is either synctool.param.OVERLAY_DIR or synctool.param.DELETE_DIR
+    Yields (SyncObject, pre_dict, post_dict) for every entry that is
+    selected, in order; the most important source for each destination
+    The walk is lazy; the consumer may stop at any time
+    The consumer may send() back whether it updated the entry; this is
+    needed to run the .post scripts of directories. A for loop sends
+    nothing, and then no entry counts as updated
+    If prefetch is True, the contents of regular files are compared
+    ahead of time in threads (if check_threads is set)
+    If only is given, the walk only goes into these source paths;
+    see synctool.destindex
+    If incremental is True, subtrees that did not change since the last
+    run are skipped (if skip_unchanged is set); see synctool.statedb
+    '''
+
+    prefetch = prefetch and synctool.prefetch.enabled()
+    incremental = incremental and synctool.statedb.enabled()
+
+    ctx = _WalkContext(prefetch, only, incremental)
+
+    if incremental:
+        synctool.statedb.start(fingerprints(overlay, synctool.statedb.settled_ns()))
+
+    try:
+        for direct in _toplevel(overlay):
+            if only is not None and direct not in only:
+                continue
+
+            yield from _walk_subtree(direct, os.sep, ctx)
+
+        if incremental:
+            # the walk is complete
+            synctool.statedb.walked()
+    finally:
+        if prefetch:
+            # after an early stop, directories may be left active
+            synctool.prefetch.leave_all()
+
+
+def visit(overlay: str, callback: Callable[[SyncObject, Dict[str, str], Dict[str, str]], Tuple[bool, bool]],
+          prefetch: bool = False, only: Optional[Set[str]] = None,
+          incremental: bool = False) -> None:
     '''visit all entries in the overlay tree
     overlay is either synctool.param.OVERLAY_DIR or synctool.param.DELETE_DIR
     callback will called with arguments: (SyncObject, pre_dict, post_dict)
     callback must return a two booleans: ok, updated
+    If prefetch is True, the contents of regular files are compared
+    ahead of time in threads (if check_threads is set)
+    If only is given, the walk only goes into these source paths
+    If incremental is True, unchanged subtrees are skipped
     '''
 
-    duplicates: Set[str] = set()
+    entries = walk(overlay, prefetch, only, incremental)
+    try:
+        item = next(entries)
+        while True:
+            okay, updated = callback(*item)
+            if not okay:
+                # quick exit
+                break
+
+            item = entries.send(updated)
+    except StopIteration:
+        pass
+    finally:
+        entries.close()
 
-    for direct in _toplevel(overlay):
-        okay, _ = _walk_subtree(direct, os.sep, duplicates, callback)
-        if not okay:
-            # quick exit
-            break
+
+def check_plan(filename: str, steps: List[synctool.plan.Step]) -> bool:
+    '''Returns True if the sources and scripts of every step in the plan
+    belong to the destination of the step, like the walk would find them
+    The scripts in a plan run as root; any other path is refused
+    '''
+
+    for step in steps:
+        if not _check_step(step):
+            error('invalid plan %s: bad path in step %r' % (filename, step))
+            return False
+
+    return True
+
+
+def _check_step(step: synctool.plan.Step) -> bool:
+    '''Returns True if the source and scripts of the step
+    belong to its destination
+    '''
+
+    dest = step['dest']
+    if not isinstance(dest, str):
+        return False
+
+    # the delete/ dir has its own scripts
+    if step['step'] == synctool.plan.STEP_DELETE:
+        topdir = synctool.param.DELETE_DIR
+    else:
+        topdir = synctool.param.OVERLAY_DIR
+
+    # a source is a file, not a script or template
+    if (step['step'] != synctool.plan.STEP_SCRIPT and
+            not _belongs(step['src'], topdir, dest, (OV_REG, OV_NO_EXT))):
+        return False
+
+    for key, ov_type in (('pre', OV_PRE), ('post', OV_POST)):
+        script = step.get(key)
+        if script is not None and not _belongs(script, topdir, dest,
+                                               (ov_type,)):
+            return False
+
+    return True
+
+
+def _belongs(path: object, topdir: str, dest: str, ov_types: Tuple[int, ...]) -> bool:
+    '''Returns True if path is in topdir/group/, for one of my groups,
+    in the directory that maps onto the directory of dest,
+    and its name makes it one of ov_types for dest
+    '''
+
+    if not isinstance(path, str) or not path:
+        return False
+
+    # resolve the directory; the entry itself may be a symlink
+    src_dir = os.path.realpath(os.path.dirname(path))
+    topdir = os.path.realpath(topdir)
+    if not src_dir.startswith(topdir + os.sep):
+        return False
+
+    parts = src_dir[len(topdir) + 1:].split(os.sep)
+    if parts[0] not in synctool.param.MY_GROUPS:
+        return False
+
+    if _dest_dir(parts[1:]) != os.path.dirname(dest):
+        return False
+
+    ov_type, dest_name, importance = _resolver().parse(os.path.basename(path))
+    return (importance >= 0 and ov_type in ov_types and
+            dest_name == os.path.basename(dest))
+
+
+def _dest_dir(parts: List[str]) -> Optional[str]:
+    '''Returns destination dir for the dirs parts, that are under a group dir
+    The dirs may have group extensions, like etc._group
+    Returns None if any of them is not for my groups
+    '''
+
+    resolver = _resolver()
+    names = []
+    for part in parts:
+        ov_type, dest_name, importance = resolver.parse(part)
+        if importance < 0 or ov_type not in (OV_REG, OV_NO_EXT):
+            return None
+        names.append(dest_name)
+
+    return os.sep + os.sep.join(names)
 
 # EOB
@@ -16,75 +16,240 @@
 import os
 import sys
 import errno
+import socket
 import time
+import signal
+import inspect
+import asyncio
+import resource
 
-from typing import List, Set, Callable, Any
+from asyncio.subprocess import Process
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Set, Tuple, Callable, Any, Optional, Generator, Iterator
 
-from synctool.lib import error
+from synctool.lib import error, stderr, verbose, unix_out
 from synctool.main.wrapper import catch_signals
+import synctool.aggr
+import synctool.lib
 import synctool.param
 
 ALL_PIDS: Set[int] = set()
 
+# a work item is passed through the queue as its index into the work list
+# an empty message tells the rank that there is no more work to do
+END_OF_WORK = b''
 
-def do(func: Callable[[Any], None], work: List[Any]) -> None:
-    '''run func in parallel'''
+# the asyncio engine reads output lines of up to this size
+STREAM_LIMIT = 1024 * 1024
+
+# Concurrency limits per stage work like the make jobserver:
+# a pipe holds one token per free slot. A rank takes a token before
+# it runs a command in that stage, and puts it back afterwards
+STAGE_TOKENS: Dict[str, Tuple[int, int]] = {}
+TOKEN = b'+'
+
+
+class Command:
+    '''a command that a worker hands to the parallel engine to run
+    The engine runs the command, showing its output with nodename,
+    and sends the exit code back to the worker
+    '''
+
+    def __init__(self, cmd_arr: List[str], nodename: str, timeout: float = 0,
+                 output: Optional[Callable[[str], None]] = None,
+                 stage: str = '', stdin_file: Optional[str] = None) -> None:
+        '''initialize instance'''
+
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+
+        self.cmd_arr = cmd_arr
+        self.nodename = nodename
+        self.timeout = timeout
+        # if output is set, it is called for every line of output
+        self.output = output
+        # commands in the same stage may share a concurrency limit
+        self.stage = stage
+        # if stdin_file is set, the command reads its input from it
+        self.stdin_file = stdin_file
+
+    def run(self) -> int:
+        '''run the command right here
+        Returns exit code
+        '''
+
+        tokens = STAGE_TOKENS.get(self.stage)
+        if tokens is None:
+            return self._run()
+
+        rfd, wfd = tokens
+        # this blocks until a slot in this stage is free
+        os.read(rfd, 1)
+        try:
+            return self._run()
+        finally:
+            os.write(wfd, TOKEN)
+
+    def _run(self) -> int:
+        '''run the command, showing output with nodename
+        Returns exit code
+        '''
+
+        return synctool.lib.run_with_nodename(self.cmd_arr, self.nodename,
+                                              self.timeout, self.output,
+                                              self.stdin_file)
+
+
+# A worker func may be a generator that yields the Commands to run
+# and gets their exit codes back; the engine decides how to run them
+Commands = Generator[Command, int, None]
+
+
+def do(func: Callable[[Any], Any], work: List[Any],
+       stage_limits: Optional[Dict[str, int]] = None) -> None:
+    '''run func in parallel
+    stage_limits maps a stage to the max number of commands in that
+    stage that may run at the same time; 0 means no extra limit
+    '''
 
     # pylint: disable=invalid-name
 
     if synctool.param.SLEEP_TIME != 0:
         synctool.param.NUM_PROC = 1
 
-    # 'part' becomes amount of work for each rank to do
     len_work = len(work)
-    if len_work <= synctool.param.NUM_PROC:
-        num_proc = len_work
-        part = 1
-    else:
-        num_proc = synctool.param.NUM_PROC
-        part = len_work // num_proc
-        if len_work % num_proc != 0:
-            part += 1
+    num_proc = min(len_work, synctool.param.NUM_PROC)
+    if num_proc <= 0:
+        return
+
+    # a stage limit only matters when it is less than num_proc
+    limits: Dict[str, int] = {}
+    if stage_limits is not None:
+        limits = {stage: limit for stage, limit in stage_limits.items()
+                  if 0 < limit < num_proc}
+
+    if synctool.param.PARALLEL_ENGINE == 'asyncio':
+        _do_asyncio(func, work, num_proc, limits)
+        return
+
+    if not _make_stage_tokens(limits):
+        return
+
+    # Work is handed out through a shared queue; a rank takes the next
+    # item as soon as it is done with the previous one. This way a slow
+    # node only holds up its own rank, and not all nodes that would
+    # otherwise have been queued behind it
+    # The queue is a datagram socket, so every read returns exactly
+    # one message, even when many ranks are reading at the same time
+    try:
+        queue_out, queue_in = socket.socketpair(socket.AF_UNIX,
+                                                socket.SOCK_DGRAM)
+    except OSError as err:
+        error('failed to create work queue: %s' % err.strerror)
+        _close_stage_tokens()
+        return
 
     # spawn pool of workers
-    for rank in range(num_proc):
+    for _ in range(num_proc):
         try:
             pid = os.fork()
         except OSError as err:
             error('failed to fork(): %s' % err.strerror)
-            return
+            break
 
         if pid == 0:
             # child process
-            worker(rank, func, work, part)
+            queue_out.close()
+            worker(func, work, queue_in)
             sys.exit(0)
 
         # parent process
         ALL_PIDS.add(pid)
 
+    queue_in.close()
+
+    # feed the queue
+    # this blocks while the queue is full and all ranks are busy
+    with queue_out:
+        try:
+            for idx in range(len_work):
+                queue_out.send(b'%d' % idx)
+
+            for _ in range(len(ALL_PIDS)):
+                queue_out.send(END_OF_WORK)
+
+        except OSError as err:
+            # all ranks are gone
+            error('failed to hand out work: %s' % err.strerror)
+
     # wait for all workers to exit
     join()
+    _close_stage_tokens()
 
 
 @catch_signals
-def worker(rank: int, func: Callable[[Any], None], work: List[Any], part: int) -> int:
-    '''run func to do part of work for parallel rank'''
+def worker(func: Callable[[Any], Any], work: List[Any], queue: socket.socket) -> int:
+    '''run func for every work item that this rank takes from the queue'''
 
-    # determine which chunk of work to do
-    lower = part * rank
-    upper = part * (rank + 1)
-    len_work = len(work)
-    upper = min(upper, len_work)
+    while True:
+        msg = queue.recv(32)
+        if msg == END_OF_WORK:
+            break
 
-    # run all work items in sequence
-    for item in work[lower:upper]:
-        func(item)
+        commands = func(work[int(msg)])
+        if inspect.isgenerator(commands):
+            run_commands(commands)
         # this is for option --zzz
         if synctool.param.SLEEP_TIME > 0:
             time.sleep(synctool.param.SLEEP_TIME)
+
+    queue.close()
     return 0
 
 
+def run_commands(commands: Commands) -> None:
+    '''run the commands that a worker yields, one after the other'''
+
+    nodenames = set()
+    try:
+        cmd = next(commands)
+        while True:
+            nodenames.add(cmd.nodename)
+            cmd = commands.send(cmd.run())
+    except StopIteration:
+        pass
+
+    synctool.aggr.nodes_done(nodenames)
+
+
+def _make_stage_tokens(limits: Dict[str, int]) -> bool:
+    '''make token pipes for stage limits
+    Returns False on error
+    '''
+
+    for stage, limit in limits.items():
+        try:
+            rfd, wfd = os.pipe()
+        except OSError as err:
+            error('failed to create pipe: %s' % err.strerror)
+            _close_stage_tokens()
+            return False
+
+        STAGE_TOKENS[stage] = (rfd, wfd)
+        os.write(wfd, TOKEN * limit)
+
+    return True
+
+
+def _close_stage_tokens() -> None:
+    '''close the token pipes for stage limits'''
+
+    for rfd, wfd in STAGE_TOKENS.values():
+        os.close(rfd)
+        os.close(wfd)
+
+    STAGE_TOKENS.clear()
+
+
 def join() -> None:
     '''wait for parallel threads to exit'''
 
@@ -104,6 +269,208 @@ def join() -> None:
                 ALL_PIDS.remove(pid)
 
 
+def _do_asyncio(func: Callable[[Any], Any], work: List[Any], num_proc: int,
+                limits: Dict[str, int]) -> None:
+    '''run func for all work items from a single process
+    At most num_proc commands run at the same time
+    '''
+
+    _raise_nofile_limit(num_proc)
+    asyncio.run(_run_all(func, work, num_proc, limits))
+
+
+def _raise_nofile_limit(num_proc: int) -> None:
+    '''make sure we may open enough files for num_proc subprocesses'''
+
+    # every subprocess takes a couple of file descriptors for its pipes
+    needed = 4 * num_proc + 64
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard != resource.RLIM_INFINITY:
+                needed = min(needed, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+    except (OSError, ValueError) as err:
+        verbose('failed to raise limit on open files: %s' % err)
+
+
+async def _run_all(func: Callable[[Any], Any], work: List[Any], num_proc: int,
+                   limits: Dict[str, int]) -> None:
+    '''run func for all work items, in num_proc worker tasks
+    Like the ranks of the fork engine, each task takes the next item
+    as soon as it is done with the previous one
+    '''
+
+    stage_slots = {stage: asyncio.Semaphore(limit) for stage, limit in limits.items()}
+    items = iter(work)
+    # a plain func blocks, and runs in a thread; there may be
+    # as many of them as there are worker tasks
+    with ThreadPoolExecutor(max_workers=num_proc,
+                            thread_name_prefix='synctool-parallel') as pool:
+        await asyncio.gather(*[_run_items(func, items, pool, stage_slots)
+                               for _ in range(num_proc)])
+
+
+async def _run_items(func: Callable[[Any], Any], items: Iterator[Any],
+                     pool: ThreadPoolExecutor,
+                     stage_slots: Dict[str, asyncio.Semaphore]) -> None:
+    '''worker task: run func for work items until there are none left'''
+
+    for item in items:
+        await _run_item(func, item, pool, stage_slots)
+
+
+async def _run_item(func: Callable[[Any], Any], item: Any, pool: ThreadPoolExecutor,
+                    stage_slots: Dict[str, asyncio.Semaphore]) -> None:
+    '''run func for a single work item'''
+
+    # a plain func blocks; run it in a thread
+    # like in the fork engine, a func that returns a generator
+    # yields the commands to run (it may be a partial or be decorated)
+    commands = await asyncio.get_running_loop().run_in_executor(pool, func, item)
+    if inspect.isgenerator(commands):
+        await _run_yielded(commands, stage_slots)
+
+    # this is for option --zzz
+    if synctool.param.SLEEP_TIME > 0:
+        await asyncio.sleep(synctool.param.SLEEP_TIME)
+
+
+async def _run_yielded(commands: Commands,
+                       stage_slots: Dict[str, asyncio.Semaphore]) -> None:
+    '''run the commands that a worker yields, one after the other
+    This is the asyncio equivalent of run_commands()
+    '''
+
+    nodenames = set()
+    try:
+        cmd = next(commands)
+        while True:
+            nodenames.add(cmd.nodename)
+            exitcode = await _run_staged(cmd, stage_slots)
+            cmd = commands.send(exitcode)
+    except StopIteration:
+        pass
+
+    synctool.aggr.nodes_done(nodenames)
+
+
+async def _run_staged(cmd: Command, stage_slots: Dict[str, asyncio.Semaphore]) -> int:
+    '''run command once there is a free slot in its stage
+    Returns exit code
+    '''
+
+    stage_slot = stage_slots.get(cmd.stage)
+    if stage_slot is None:
+        return await _run_command(cmd)
+
+    async with stage_slot:
+        return await _run_command(cmd)
+
+
+async def _run_command(cmd: Command) -> int:
+    '''run command as subprocess, and show output with nodename
+    This is the asyncio equivalent of synctool.lib.run_with_nodename()
+    Returns process return code, EXIT_TIMEOUT if it timed out,
+    or -1 on error
+    '''
+
+    unix_out(' '.join(cmd.cmd_arr))
+
+    proc = await _spawn(cmd)
+    if proc is None:
+        return -1
+
+    try:
+        if cmd.timeout > 0:
+            exitcode = await asyncio.wait_for(_pass_lines(cmd, proc), cmd.timeout)
+        else:
+            exitcode = await _pass_lines(cmd, proc)
+
+    except asyncio.TimeoutError:
+        await _kill_timed_out(cmd, proc)
+        return synctool.lib.EXIT_TIMEOUT
+
+    except asyncio.CancelledError:
+        # interrupted; the process group does not get the Ctrl-C from the tty
+        if cmd.timeout > 0:
+            synctool.lib._killpg(proc.pid, signal.SIGTERM)      # pylint: disable=protected-access
+        raise
+
+    if exitcode != 0:
+        verbose('exit code %d' % exitcode)
+
+    return exitcode
+
+
+async def _spawn(cmd: Command) -> Optional[Process]:
+    '''start command as subprocess
+    Returns the process, or None on error
+    '''
+
+    if cmd.stdin_file is not None:
+        try:
+            fd_stdin = os.open(cmd.stdin_file, os.O_RDONLY)
+        except OSError as err:
+            stderr('failed to open %s: %s' % (cmd.stdin_file, err.strerror))
+            return None
+    else:
+        fd_stdin = asyncio.subprocess.DEVNULL
+
+    # with a timeout, run in a process group of its own
+    # so that it can be killed together with its children
+    try:
+        return await asyncio.create_subprocess_exec(*cmd.cmd_arr,
+                                                    stdin=fd_stdin,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT,
+                                                    limit=STREAM_LIMIT,
+                                                    start_new_session=cmd.timeout > 0)
+    except OSError as err:
+        stderr('failed to run command %s: %s' % (cmd.cmd_arr[0], err.strerror))
+        return None
+
+    finally:
+        # the child has its own copy
+        if cmd.stdin_file is not None:
+            os.close(fd_stdin)
+
+
+async def _pass_lines(cmd: Command, proc: Process) -> int:
+    '''pass on the output and wait for the process to exit'''
+
+    assert proc.stdout is not None                                  # this helps mypy
+    async for data in proc.stdout:
+        line = data.decode(errors='replace').rstrip()
+        if cmd.output is not None:
+            cmd.output(line)
+        else:
+            synctool.lib._pass_output(line, cmd.nodename)               # pylint: disable=protected-access
+
+    return await proc.wait()
+
+
+async def _kill_timed_out(cmd: Command, proc: Process) -> None:
+    '''kill the process group of a command that timed out'''
+
+    # pylint: disable=protected-access
+
+    # first ask nicely, then pull the plug
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if not synctool.lib._killpg(proc.pid, sig):
+            break
+        try:
+            await asyncio.wait_for(proc.wait(), synctool.lib.KILL_GRACE)
+            break
+        except asyncio.TimeoutError:
+            pass
+
+    synctool.lib._pass_output('error: timed out after %d seconds' % cmd.timeout,
+                              cmd.nodename)
+    synctool.lib._masterlog('%s: timed out after %d seconds' % (cmd.nodename,
+                                                                cmd.timeout))
+
+
 # unit test
 if __name__ == '__main__':
     @catch_signals
@@ -46,17 +46,77 @@ TEMP_DIR = '/tmp/synctool'
 HOSTNAME = ''
 NODENAME = ''
 
+# files that synctool keeps on the node, relative to ROOTDIR
+# They are not in the repository; the master excludes them
+# from the rsync, and protects them from --delete
+FINGERPRINT_FILE = os.path.join('var', 'fingerprint')
+DIGESTS_FILE = os.path.join('var', 'digests')
+DESTINDEX_FILE = os.path.join('var', 'destindex')
+STATEDB_FILE = os.path.join('var', 'statedb')
+VERIFY_FILE = os.path.join('var', 'verify')
+NODE_STATE_FILES = (FINGERPRINT_FILE, DIGESTS_FILE, DESTINDEX_FILE,
+                    STATEDB_FILE, VERIFY_FILE)
+# dir on the master that holds the state of synctool-master --changed
+# It is not in the repository either, and not sent to the nodes
+CHANGED_DIR = os.path.join('var', 'changed')
+
 DIFF_CMD = 'diff -u'
 PING_CMD = 'ping -q -c 1 -w 1'
 SSH_CMD = 'ssh -o ConnectTimeout=10 -x -q'
 RSYNC_CMD = "rsync -ar --delete --delete-excluded -q"
 SYNCTOOL_CMD = ''
+RELAY_CMD = ''
 PKG_CMD = ''
 
 PACKAGE_MANAGER = ''
 
 NUM_PROC = 16
 SLEEP_TIME = 0
+# how to run things in parallel: 'fork' or 'asyncio'
+PARALLEL_ENGINE = 'fork'
+# max parallel rsyncs and ssh+synctool runs in synctool-master
+# 0 means only limited by NUM_PROC
+RSYNC_NUM_PROC = 0
+SSH_NUM_PROC = 0
+# replay rsync batches on nodes that are at the same state
+RSYNC_BATCH = False
+# skip the rsync for nodes that already have the current repository
+RSYNC_FINGERPRINT = False
+
+# deadlines in seconds for synctool-master, per node and per phase
+# 0 means no deadline
+NODE_TIMEOUT = 0
+RSYNC_TIMEOUT = 0
+SSH_TIMEOUT = 0
+
+# print aggregated output every this many seconds; 0 means at the end
+AGGREGATE_INTERVAL = 0
+
+# digest for the cached checksums of files in the repository
+DIGEST_ALGORITHM = 'md5'
+
+# sync installed files to disk in batches
+DURABLE_WRITES = False
+
+# number of threads that compare file contents ahead of the overlay walk
+# 0 means no threads
+CHECK_THREADS = 0
+
+# run .post scripts after the overlay walk, this many at a time
+# 0 means run them right away
+POST_NUM_PROC = 0
+
+# with sync_times, take files with the same size and mtime to be the same
+TRUST_MTIME = False
+# compare all contents every Nth run, and a random 1 in N files every run
+# 0 means never
+DEEP_VERIFY_INTERVAL = 0
+DEEP_VERIFY_SAMPLE = 0
+
+# skip subtrees whose sources and destinations did not change
+# since the last run; every Nth run is a full run, 0 means never
+SKIP_UNCHANGED = False
+FULL_RUN_INTERVAL = 10
 
 CONTROL_PERSIST = '1h'
 REQUIRE_EXTENSION = True
@@ -82,6 +142,10 @@ MASTER = ''
 # set of slaves by nodename
 SLAVES: Set[str] = set()
 
+# relay nodes run synctool for the nodes in their groups
+# RELAYS is a dict of relay nodename -> list of groups and nodes
+RELAYS: Dict[str, List[str]] = {}
+
 # NODES is a dict of nodes
 # each node is a list of groups, ordered by importance;
 # first listed group is most important, last group is least important
@@ -143,6 +207,11 @@ KNOWN_PACKAGE_MANAGERS = ('apk', 'apt-get', 'brew', 'bsdpkg', 'dnf',
                           'pacman', 'pkg', 'yum', 'zypper')
 # 'urpmi', 'portage', 'port', 'swaret', 'xbps', 'nix'
 
+KNOWN_PARALLEL_ENGINES = ('fork', 'asyncio')
+
+KNOWN_DIGEST_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512',
+                           'blake2b', 'blake2s')
+
 ORIG_UMASK = 0o22
 
 
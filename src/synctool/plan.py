@@ -0,0 +1,249 @@
+#
+#   synctool.plan.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''plan files: decide what to change first, and change it later
+
+synctool-client --plan=FILE does a dry run, and writes every change
+that it would make to FILE, in JSON. Entries that are up to date are
+not in the plan.
+synctool-client --fix --apply=FILE makes the changes in the plan,
+without walking the overlay tree again. Every entry in the plan
+is stat'ed again; when the source and destination still have the same
+size, mode, owner, mtime and ctime (in ns) as when the plan was made,
+the contents are taken to be as the plan says, and are not compared
+again. If anything changed, the entry is checked in full.
+The scripts in a plan run as root, so the plan is only applied if every
+source and script is in the repository, where it belongs to its
+destination; see synctool.overlay.check_plan()
+'''
+
+import os
+import json
+import time
+
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from synctool import param
+from synctool.lib import error
+from synctool.object import SyncObject
+from synctool.syncstat import SyncStat
+
+# version of the plan file format
+PLAN_VERSION = 2
+
+# kinds of steps in a plan
+STEP_FIX = 'fix'
+STEP_DELETE = 'delete'
+STEP_SCRIPT = 'script'
+
+# names of the FIX_xxx actions, for the reader of the plan
+FIX_NAMES = {
+    SyncObject.FIX_CREATE: 'create',
+    SyncObject.FIX_TYPE: 'type',
+    SyncObject.FIX_UPDATE: 'update',
+    SyncObject.FIX_OWNER: 'owner',
+}
+
+# keys that each kind of step must have
+STEP_KEYS = {
+    STEP_FIX: ('src', 'dest', 'fix', 'src_stat', 'dest_stat'),
+    STEP_DELETE: ('src', 'dest'),
+    STEP_SCRIPT: ('dest', 'post'),
+}
+
+Step = Dict[str, Any]
+
+_RECORDING = False
+_STEPS: List[Step] = []
+
+
+def start() -> None:
+    '''start recording a plan'''
+
+    global _RECORDING                                       # pylint: disable=global-statement
+
+    _RECORDING = True
+    _STEPS.clear()
+
+
+def add_fix(obj: SyncObject, fix_action: int, pre_dict: Dict[str, str],
+            post_dict: Dict[str, str]) -> None:
+    '''record a check() result that needs fixing'''
+
+    if not _RECORDING or fix_action == SyncObject.FIX_UNDEF:
+        return
+
+    _STEPS.append({'step': STEP_FIX,
+                   'src': obj.src_path,
+                   'dest': obj.dest_path,
+                   'fix': fix_names(fix_action),
+                   'pre': pre_dict.get(obj.dest_path),
+                   'post': post_dict.get(obj.dest_path),
+                   'src_stat': stat_fields(obj.src_path),
+                   'dest_stat': stat_fields(obj.dest_path)})
+
+
+def add_delete(obj: SyncObject, post_dict: Dict[str, str]) -> None:
+    '''record a file to delete'''
+
+    if not _RECORDING:
+        return
+
+    _STEPS.append({'step': STEP_DELETE,
+                   'src': obj.src_path,
+                   'dest': obj.dest_path,
+                   'post': post_dict.get(obj.dest_path)})
+
+
+def add_dir_script(obj: SyncObject, post_dict: Dict[str, str]) -> None:
+    '''record the .post script of an updated directory'''
+
+    if not _RECORDING or obj.dest_path not in post_dict:
+        return
+
+    _STEPS.append({'step': STEP_SCRIPT,
+                   'dest': obj.dest_path,
+                   'post': post_dict[obj.dest_path]})
+
+
+def fix_names(fix_action: int) -> List[str]:
+    '''Returns FIX_xxx action as list of names'''
+
+    names = []
+    base_action = fix_action & ~(SyncObject.FIX_MODE | SyncObject.FIX_TIME)
+    if base_action in FIX_NAMES:
+        names.append(FIX_NAMES[base_action])
+    if fix_action & SyncObject.FIX_MODE:
+        names.append('mode')
+    if fix_action & SyncObject.FIX_TIME:
+        names.append('time')
+    return names
+
+
+def stat_fields(path: str) -> Optional[List[int]]:
+    '''Returns the fields of the lstat() of path that are revalidated,
+    or None if the entry does not exist
+    The times are in ns; a change within the same second still counts
+    '''
+
+    try:
+        statbuf = os.lstat(path)
+    except OSError:
+        return None
+
+    return [statbuf.st_mode, statbuf.st_uid, statbuf.st_gid,
+            statbuf.st_size, statbuf.st_mtime_ns, statbuf.st_ctime_ns]
+
+
+def save(filename: str) -> bool:
+    '''write the recorded plan to file
+    Returns False on error
+    '''
+
+    plan = {'synctool_plan': PLAN_VERSION,
+            'node': param.NODENAME,
+            'created': int(time.time()),
+            'steps': _STEPS}
+    try:
+        with open(filename, 'w', encoding='utf-8') as fplan:
+            json.dump(plan, fplan, indent=1)
+            fplan.write('\n')
+    except OSError as err:
+        error('failed to write plan %s: %s' % (filename, err.strerror))
+        return False
+
+    return True
+
+
+def load(filename: str) -> Optional[List[Step]]:
+    '''Returns the steps of a plan file, or None on error
+    The paths in the steps are not checked here;
+    see synctool.overlay.check_plan()
+    '''
+
+    plan = _read(filename)
+    if plan is None:
+        return None
+
+    if plan.get('node') != param.NODENAME:
+        error('plan %s was made for node %s' % (filename, plan.get('node')))
+        return None
+
+    steps = plan.get('steps')
+    if not isinstance(steps, list):
+        error('invalid plan %s: no steps' % filename)
+        return None
+
+    for step in steps:
+        if (not isinstance(step, dict) or step.get('step') not in STEP_KEYS or
+                any(key not in step for key in STEP_KEYS[step['step']])):
+            error('invalid plan %s: bad step %r' % (filename, step))
+            return None
+
+    return steps
+
+
+def _read(filename: str) -> Optional[Dict[str, Any]]:
+    '''Returns the plan in file, or None on error'''
+
+    try:
+        with open(filename, 'r', encoding='utf-8') as fplan:
+            plan = json.load(fplan)
+    except OSError as err:
+        error('failed to read plan %s: %s' % (filename, err.strerror))
+        return None
+    except ValueError as err:
+        error('invalid plan %s: %s' % (filename, err))
+        return None
+
+    if not isinstance(plan, dict) or plan.get('synctool_plan') != PLAN_VERSION:
+        error('%s is not a synctool plan (version %d)' % (filename,
+                                                          PLAN_VERSION))
+        return None
+
+    return plan
+
+
+def make_object(step: Step) -> SyncObject:
+    '''Returns SyncObject for a fix or delete step, with fresh stats'''
+
+    obj = SyncObject(step['src'], step['dest'])
+    obj.src_stat = SyncStat(obj.src_path)
+    obj.dest_stat = SyncStat(obj.dest_path)
+
+    if (step['step'] == STEP_FIX and obj.src_stat.is_file() and
+            obj.dest_stat.is_file() and
+            stat_fields(obj.src_path) == step['src_stat'] and
+            stat_fields(obj.dest_path) == step['dest_stat']):
+        # nothing changed since the plan was made;
+        # the contents differ only if the plan says so
+        same = 'update' not in step['fix']
+        result: 'Future[Optional[Tuple[bool, str]]]' = Future()
+        result.set_result((same, ''))
+        obj.prefetched = result
+
+    return obj
+
+
+def scripts(step: Step) -> Tuple[Dict[str, str], Dict[str, str]]:
+    '''Returns pre_dict, post_dict for a step'''
+
+    pre_dict = {}
+    if step.get('pre'):
+        pre_dict[step['dest']] = step['pre']
+
+    post_dict = {}
+    if step.get('post'):
+        post_dict[step['dest']] = step['post']
+
+    return pre_dict, post_dict
+
+# EOB
@@ -0,0 +1,177 @@
+#
+#   synctool.prefetch.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''compare file contents ahead of the overlay walk, in threads
+
+When the overlay walk enters a directory, the regular files in it
+are handed to a pool of check_threads threads, a few at a time.
+The threads only compare contents (reading files and hashing releases
+the GIL); they print nothing, and they change nothing. The walk itself
+picks up the results in its usual order, and does all the printing
+and fixing like before.
+A .pre or .post script may change any file, so when a script runs,
+all results that are not picked up yet are thrown away
+'''
+
+import os
+import stat
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from synctool import param
+from synctool.compare import compare_contents
+import synctool.verify
+
+# results are for (src_path, dest_path)
+CompareResult = Optional[Tuple[bool, str]]
+
+# how many compares per thread may be started ahead
+WINDOW_PER_THREAD = 4
+
+_POOL: Optional[ThreadPoolExecutor] = None
+
+# directories that are being walked, innermost last
+_ACTIVE: List['DirPrefetch'] = []
+
+
+class DirPrefetch:
+    '''compares the files of a directory ahead of time'''
+
+    def __init__(self, pairs: List[Tuple[str, str]]) -> None:
+        '''initialize instance
+        pairs are (src_path, dest_path) of the files, in walk order
+        '''
+
+        self.pairs = pairs
+        self.index = {dest_path: idx for idx, (_, dest_path) in enumerate(pairs)}
+        self.futures: Dict[int, 'Future[CompareResult]'] = {}
+        # index of the next pair to submit
+        self.next_idx = 0
+        self.window = param.CHECK_THREADS * WINDOW_PER_THREAD
+        self._fill()
+
+    def _fill(self) -> None:
+        '''start compares, up to the window size'''
+
+        assert _POOL is not None                            # this helps mypy
+
+        while self.next_idx < len(self.pairs) and len(self.futures) < self.window:
+            src_path, dest_path = self.pairs[self.next_idx]
+            self.futures[self.next_idx] = _POOL.submit(_compare, src_path,
+                                                       dest_path)
+            self.next_idx += 1
+
+    def take(self, dest_path: str) -> Optional['Future[CompareResult]']:
+        '''Returns the compare for dest_path, if it was started'''
+
+        idx = self.index.get(dest_path)
+        if idx is None:
+            return None
+
+        # the walk is past any earlier files; they were skipped
+        for earlier in [i for i in self.futures if i < idx]:
+            self.futures.pop(earlier).cancel()
+
+        future = self.futures.pop(idx, None)
+        self.next_idx = max(self.next_idx, idx + 1)
+        self._fill()
+        return future
+
+    def drop(self) -> None:
+        '''throw away all compares that are not picked up'''
+
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+
+def enabled() -> bool:
+    '''Returns True if compares are done in threads'''
+
+    return param.CHECK_THREADS > 0
+
+
+def enter_dir(pairs: List[Tuple[str, str]]) -> DirPrefetch:
+    '''start comparing the files of a directory
+    Call leave_dir() when done
+    '''
+
+    global _POOL                                            # pylint: disable=global-statement
+
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(max_workers=param.CHECK_THREADS,
+                                   thread_name_prefix='synctool-check')
+
+    prefetch = DirPrefetch(pairs)
+    _ACTIVE.append(prefetch)
+    return prefetch
+
+
+def leave_dir(prefetch: DirPrefetch) -> None:
+    '''done with directory'''
+
+    prefetch.drop()
+    _ACTIVE.remove(prefetch)
+
+
+def leave_all() -> None:
+    '''done with all directories'''
+
+    while _ACTIVE:
+        leave_dir(_ACTIVE[-1])
+
+
+def invalidate() -> None:
+    '''throw away all results that are not picked up yet'''
+
+    for prefetch in _ACTIVE:
+        prefetch.drop()
+
+
+def shutdown() -> None:
+    '''stop the threads'''
+
+    global _POOL                                            # pylint: disable=global-statement
+
+    if _POOL is not None:
+        _POOL.shutdown(wait=True)
+        _POOL = None
+
+
+def _compare(src_path: str, dest_path: str) -> CompareResult:
+    '''compare contents, if the check is going to need it
+    Runs in a thread
+    Returns None if there is nothing to compare
+    '''
+
+    try:
+        src_statbuf = os.lstat(src_path)
+        dest_statbuf = os.lstat(dest_path)
+    except OSError:
+        return None
+
+    if not (stat.S_ISREG(src_statbuf.st_mode) and
+            stat.S_ISREG(dest_statbuf.st_mode)):
+        return None
+
+    if src_statbuf.st_size != dest_statbuf.st_size:
+        return None
+
+    if synctool.verify.same_metadata(src_statbuf.st_size,
+                                     int(src_statbuf.st_mtime),
+                                     dest_statbuf.st_size,
+                                     int(dest_statbuf.st_mtime)):
+        # trust_mtime applies
+        return None
+
+    return compare_contents(src_path, dest_path)
+
+# EOB
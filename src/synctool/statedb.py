@@ -0,0 +1,427 @@
+#
+#   synctool.statedb.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''skip_unchanged: skip subtrees that did not change since the last run
+
+After a run with --fix that went without errors, the state of each
+destination directory is saved: the fingerprint of its sources (see
+synctool.overlay.fingerprints()), and the inode, size, mtime and ctime
+of every destination in it that synctool manages. For directories,
+it is the inode, mode and owner instead; their timestamps change when
+other files come and go. The metadata is taken right after the walk
+checked (and fixed) the destination; a directory in which anything
+changed after that, is not saved.
+
+The next run, the overlay walk skips a destination directory if its
+sources have the same fingerprint, and the managed destinations in it
+and in all directories below it still have the same metadata. Such a
+subtree was up to date, and nothing was changed since.
+Every Nth run is a full run (full_run_interval), and so is a run with
+synctool-client --full, and a deep verify run (see synctool.verify).
+The state is kept in $SYNCTOOL/var/statedb
+'''
+
+import os
+import json
+import stat
+import time
+
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from synctool import param
+import synctool.lib
+from synctool.lib import verbose
+from synctool.syncstat import SyncStat
+import synctool.verify
+
+# version of the state file format
+STATE_VERSION = 1
+
+# an entry that changed this recently may change again without
+# a different ctime, on filesystems with coarse timestamps.
+# Its directory is not saved, and checked in full next time
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+# set by synctool-client --full
+FULL_RUN = False
+
+# destination dir -> (fingerprint of the sources,
+#                     dict of metadata of the managed destinations by name)
+Record = Tuple[str, Dict[str, List[int]]]
+
+# state of the last run
+_RECORDS: Dict[str, Record] = {}
+# number of runs since the last full run
+_RUNS = 0
+
+# fingerprint of the sources by destination dir, for this run
+_SOURCES: Dict[str, Optional[str]] = {}
+# True if this run may skip subtrees
+_SKIPPING = False
+_FULL = False
+# destination dirs that were checked, and whether they were unchanged
+_UNCHANGED: Dict[str, bool] = {}
+# destination dirs that were skipped
+_SKIPPED: Set[str] = set()
+# metadata of the destinations by name by dir, as they were checked;
+# None if it is not known to be good
+_CHECKED: Dict[str, Dict[str, Optional[List[int]]]] = {}
+# True after a complete walk
+_WALKED = False
+
+
+def state_file() -> str:
+    '''Returns path of the state file'''
+
+    return os.path.join(param.ROOTDIR, param.STATEDB_FILE)
+
+
+def enabled() -> bool:
+    '''Returns True if unchanged subtrees are skipped'''
+
+    return param.SKIP_UNCHANGED
+
+
+def settled_ns() -> int:
+    '''Returns time in ns; entries that changed after this
+    may change again unnoticed
+    '''
+
+    return time.time_ns() - RACY_NS
+
+
+def start(sources: Dict[str, Optional[str]]) -> None:
+    '''start an incremental walk
+    sources holds the fingerprints of the sources by destination dir
+    '''
+
+    global _SOURCES, _SKIPPING, _FULL, _WALKED              # pylint: disable=global-statement
+
+    _SOURCES = sources
+    _WALKED = False
+    _UNCHANGED.clear()
+    _SKIPPED.clear()
+    _CHECKED.clear()
+    _load()
+
+    if FULL_RUN:
+        verbose('full run; option --full')
+        _FULL = True
+    elif synctool.verify.DEEP_RUN:
+        verbose('full run; deep verify run')
+        _FULL = True
+    elif not _RECORDS:
+        verbose('full run; no saved state')
+        _FULL = True
+    elif 0 < param.FULL_RUN_INTERVAL <= _RUNS + 1:
+        verbose('full run; every %d runs' % param.FULL_RUN_INTERVAL)
+        _FULL = True
+    else:
+        _FULL = False
+
+    _SKIPPING = not _FULL
+
+
+def unchanged(dest_dir: str) -> bool:
+    '''Returns True if the subtree of dest_dir can be skipped:
+    its sources and managed destinations did not change since the last run
+    '''
+
+    if not _SKIPPING:
+        return False
+
+    if not _check(dest_dir):
+        return False
+
+    _SKIPPED.add(dest_dir)
+    return True
+
+
+def _check(dest_dir: str) -> bool:
+    '''Returns True if dest_dir and all below it are unchanged'''
+
+    okay = _UNCHANGED.get(dest_dir)
+    if okay is None:
+        okay = _UNCHANGED[dest_dir] = _check_dir(dest_dir)
+    return okay
+
+
+def _check_dir(dest_dir: str) -> bool:
+    '''Returns True if dest_dir and all below it are unchanged
+    This lstat()s the managed destinations in dest_dir, and checks
+    the directories among them in turn
+    '''
+
+    record = _RECORDS.get(dest_dir)
+    if record is None:
+        return False
+
+    fingerprint = _SOURCES.get(dest_dir)
+    if fingerprint is None or fingerprint != record[0]:
+        return False
+
+    for name, metadata in record[1].items():
+        path = os.path.join(dest_dir, name)
+        try:
+            statbuf = os.lstat(path)
+        except OSError:
+            return False
+
+        if _metadata(statbuf) != metadata:
+            return False
+
+        if stat.S_ISDIR(statbuf.st_mode) and not _check(path):
+            return False
+
+    return True
+
+
+def _metadata(statbuf: os.stat_result) -> List[int]:
+    '''Returns the metadata of a destination that is saved'''
+
+    if stat.S_ISDIR(statbuf.st_mode):
+        return [statbuf.st_ino, statbuf.st_mode, statbuf.st_uid,
+                statbuf.st_gid]
+
+    return [statbuf.st_ino, statbuf.st_size, statbuf.st_mtime_ns,
+            statbuf.st_ctime_ns]
+
+
+def skipped() -> bool:
+    '''Returns True if any subtree was skipped in this run'''
+
+    return bool(_SKIPPED)
+
+
+def checked(dest_path: str, dest_stat: Optional[SyncStat],
+            updated: bool) -> None:
+    '''the walk checked the destination, and updated it (or not)
+    dest_stat is what it was checked against, or None if the check
+    did not finish
+    '''
+
+    metadata = None
+    if dest_stat is not None:
+        try:
+            statbuf = os.lstat(dest_path)
+        except OSError:
+            pass
+        else:
+            if updated or _same(dest_stat, statbuf):
+                metadata = _metadata(statbuf)
+
+    dest_dir, name = os.path.split(dest_path)
+    names = _CHECKED.get(dest_dir)
+    if names is None:
+        names = _CHECKED[dest_dir] = {}
+    names[name] = metadata
+
+
+def _same(dest_stat: SyncStat, statbuf: os.stat_result) -> bool:
+    '''Returns True if the destination still is as it was checked'''
+
+    if not dest_stat.exists():
+        return False
+
+    if (dest_stat.mode != statbuf.st_mode or dest_stat.uid != statbuf.st_uid or
+            dest_stat.gid != statbuf.st_gid):
+        return False
+
+    if stat.S_ISDIR(statbuf.st_mode):
+        return True
+
+    return (dest_stat.size == statbuf.st_size and
+            dest_stat.mtime == int(statbuf.st_mtime))
+
+
+def walked() -> None:
+    '''the incremental walk is complete'''
+
+    global _WALKED                                          # pylint: disable=global-statement
+
+    _WALKED = True
+
+
+def _is_skipped(dest_dir: str) -> bool:
+    '''Returns True if dest_dir is in a subtree that was skipped'''
+
+    while dest_dir not in _SKIPPED:
+        parent = os.path.dirname(dest_dir)
+        if parent == dest_dir:
+            return False
+        dest_dir = parent
+    return True
+
+
+def save() -> None:
+    '''save the state after a complete walk
+    Only a run with --fix that went without errors is saved
+    '''
+
+    global _WALKED                                          # pylint: disable=global-statement
+
+    if not _WALKED:
+        return
+
+    _WALKED = False
+
+    if synctool.lib.DRY_RUN:
+        return
+
+    if synctool.lib.ERROR_COUNT > 0:
+        verbose('not saving state; there were errors')
+        return
+
+    # subtrees that were skipped are as they were
+    records = {dest_dir: record for dest_dir, record in _RECORDS.items()
+               if _is_skipped(dest_dir)}
+
+    settled = settled_ns()
+    for dest_dir, names in _CHECKED.items():
+        _record(dest_dir, names, records, settled)
+
+    state = {'synctool_statedb': STATE_VERSION,
+             'config': _config(),
+             'runs': 0 if _FULL else _RUNS + 1,
+             'dirs': records}
+
+    filename = state_file()
+    # write it atomically; a partial state file would be discarded
+    tmp_filename = '%s.%d' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as fstate:
+            # json.dumps() is much faster than json.dump() to a file
+            fstate.write(json.dumps(state, separators=(',', ':')))
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        # without the state, the next run is a full run
+        verbose('failed to write %s: %s' % (filename, err.strerror))
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        return
+
+    verbose('saved state of %d directories' % len(records))
+
+
+def _record(dest_dir: str, names: Dict[str, Optional[List[int]]],
+            records: Dict[str, Record], settled: int) -> None:
+    '''add the state of dest_dir to records, if it can be saved
+    names holds the metadata of the destinations, as they were checked
+    '''
+
+    fingerprint = _SOURCES.get(dest_dir)
+    if fingerprint is None:
+        return
+
+    entries = {}
+    for name, metadata in names.items():
+        if metadata is None:
+            return
+
+        path = os.path.join(dest_dir, name)
+        try:
+            statbuf = os.lstat(path)
+        except OSError:
+            # it is gone already
+            return
+
+        if _metadata(statbuf) != metadata:
+            # it changed after it was checked
+            return
+
+        if stat.S_ISDIR(statbuf.st_mode):
+            if path not in _CHECKED and path not in records:
+                # the walk went into it, but selected nothing there
+                subdir_fingerprint = _SOURCES.get(path)
+                if subdir_fingerprint is not None:
+                    records[path] = (subdir_fingerprint, {})
+
+        elif statbuf.st_ctime_ns >= settled:
+            return
+
+        entries[name] = metadata
+
+    records[dest_dir] = (fingerprint, entries)
+
+
+def _config() -> List[Any]:
+    '''Returns the settings that the state was saved with
+    They decide which entries the walk selects, and what it checks
+    '''
+
+    return [param.VERSION, param.OVERLAY_DIR, param.MY_GROUPS,
+            sorted(param.IGNORE_FILES), param.IGNORE_FILES_WITH_WILDCARDS,
+            param.IGNORE_DOTFILES, param.IGNORE_DOTDIRS,
+            param.REQUIRE_EXTENSION, param.SYNC_TIMES]
+
+
+def _load() -> None:
+    '''read the state file
+    A missing or invalid state file gives an empty state
+    '''
+
+    global _RUNS                                            # pylint: disable=global-statement
+
+    _RECORDS.clear()
+    _RUNS = 0
+
+    filename = state_file()
+    try:
+        with open(filename, 'r', encoding='utf-8') as fstate:
+            state = json.load(fstate)
+    except OSError:
+        return
+    except ValueError:
+        verbose('ignoring state file %s: invalid' % filename)
+        return
+
+    if (not isinstance(state, dict) or
+            state.get('synctool_statedb') != STATE_VERSION or
+            not isinstance(state.get('runs'), int) or
+            not isinstance(state.get('dirs'), dict)):
+        verbose('ignoring state file %s: invalid' % filename)
+        return
+
+    if state.get('config') != _config():
+        verbose('ignoring state file %s: settings changed' % filename)
+        return
+
+    records = {}
+    for dest_dir, record in state['dirs'].items():
+        if not _valid_record(record):
+            verbose('ignoring state file %s: invalid' % filename)
+            return
+
+        records[dest_dir] = (record[0], record[1])
+
+    _RECORDS.update(records)
+    _RUNS = state['runs']
+
+    verbose('loaded state of %d directories' % len(_RECORDS))
+
+
+def _valid_record(record: object) -> bool:
+    '''Returns True if record is a valid record of the state file'''
+
+    if (not isinstance(record, list) or len(record) != 2 or
+            not isinstance(record[0], str) or
+            not isinstance(record[1], dict)):
+        return False
+
+    for metadata in record[1].values():
+        if (not isinstance(metadata, list) or len(metadata) != 4 or
+                not all(isinstance(x, int) for x in metadata)):
+            return False
+
+    return True
+
+# EOB
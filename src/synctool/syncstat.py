@@ -14,9 +14,14 @@ import os
 import stat
 import errno
 
+from typing import Dict, Optional
+
 from synctool.lib import error
 import synctool.pwdgrp
 
+# snapshots taken before the last invalidate() are stale
+_GENERATION = 0
+
 
 class SyncStat:
     '''structure to hold the relevant fields of a stat() buf'''
@@ -27,8 +32,13 @@ class SyncStat:
     # But then again, should take less than the posix.stat_result Pyobject
     # Also note how I left device files (major, minor) out, they are so rare
     # that they get special treatment in object.py
+    # With __slots__, instances have no __dict__; there is one for
+    # every entry in the overlay tree, so this adds up
+
+    __slots__ = ('entry_exists', 'mode', 'uid', 'gid', 'size', 'atime',
+                 'mtime')
 
-    def __init__(self, path: str = '') -> None:
+    def __init__(self, path: str = '', entry: Optional['os.DirEntry[str]'] = None) -> None:
         '''initialize instance'''
 
         self.entry_exists = False
@@ -36,7 +46,7 @@ class SyncStat:
         self.uid = self.gid = -1
         self.size = -1
         self.atime = self.mtime = 0
-        self.stat(path)
+        self.stat(path, entry)
 
     def __repr__(self) -> str:
         '''return string representation'''
@@ -47,8 +57,11 @@ class SyncStat:
 
         return '[<SyncStat>: None]'
 
-    def stat(self, path: str) -> None:
-        '''get the stat() information for a pathname'''
+    def stat(self, path: str, entry: Optional['os.DirEntry[str]'] = None) -> None:
+        '''get the stat() information for a pathname
+        If a DirEntry (from os.scandir()) is given, its stat is used;
+        a DirEntry caches the stat, so it is done only once
+        '''
 
         if not path:
             self.entry_exists = False
@@ -59,7 +72,10 @@ class SyncStat:
             return
 
         try:
-            statbuf = os.lstat(path)
+            if entry is not None:
+                statbuf = entry.stat(follow_symlinks=False)
+            else:
+                statbuf = os.lstat(path)
         except OSError as err:
             # could be something stupid like "Permission denied" ...
             # although synctool should be run as root
@@ -152,4 +168,58 @@ class SyncStat:
 
         return synctool.pwdgrp.grp_name(self.gid)
 
+
+class DirSnapshot:
+    '''the entries of a directory, read once with os.scandir()
+    Entries that are not in the snapshot do not exist, so they
+    cost no lstat() at all. If the directory does not exist,
+    none of its entries do
+    '''
+
+    def __init__(self, path: str) -> None:
+        '''initialize instance'''
+
+        self.path = path
+        self.generation = _GENERATION
+        self.entries: Dict[str, 'os.DirEntry[str]'] = {}
+        # if the directory could not be read, stat() falls back to lstat()
+        self.complete = True
+
+        try:
+            with os.scandir(path) as it_entries:
+                for entry in it_entries:
+                    self.entries[entry.name] = entry
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                self.complete = False
+
+    def __repr__(self) -> str:
+        '''return string representation'''
+
+        return '[<DirSnapshot>: %s (%d)]' % (self.path, len(self.entries))
+
+    def stat(self, path: str) -> SyncStat:
+        '''Returns SyncStat for path, which is an entry in this directory'''
+
+        if not self.complete or self.generation != _GENERATION:
+            return SyncStat(path)
+
+        entry = self.entries.get(os.path.basename(path))
+        if entry is None:
+            return SyncStat()
+
+        # the DirEntry caches the stat
+        return SyncStat(path, entry)
+
+
+def invalidate() -> None:
+    '''make all snapshots stale; they fall back to lstat()
+    For when something else may have changed the destinations,
+    like a .pre or .post script
+    '''
+
+    global _GENERATION                                      # pylint: disable=global-statement
+
+    _GENERATION += 1
+
 # EOB
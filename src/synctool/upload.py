@@ -20,9 +20,10 @@ import urllib.request
 import urllib.parse
 import urllib.error
 
-from typing import List, Dict, Tuple, Optional
+from typing import List, Optional
 
 import synctool.config
+import synctool.destindex
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, error, warning
 from synctool.lib import terse, unix_out, prettypath
@@ -31,8 +32,6 @@ import synctool.overlay
 import synctool.param
 import synctool.pwdgrp
 
-from synctool.object import SyncObject
-
 
 class UploadFile:
     '''class that holds information on requested upload'''
@@ -323,37 +322,30 @@ def _makedir(path: str, remote_stats: List[RemoteStat]) -> bool:
     return True
 
 
-# UploadFile object, used in callback function for overlay.visit()
-GLOBAL_UPLOAD_FILE = UploadFile()
-
-
-def _upload_callback(obj: SyncObject, _pre_dict: Dict[str, str], _post_dict: Dict[str, str]) -> Tuple[bool, bool]:
-    '''find the overlay path for the destination in UPLOAD_FILE'''
+def _find_repos_path(upfile: UploadFile) -> None:
+    '''find the overlay path for the destination of upfile'''
 
-    # this callback modifies the global GLOBAL_UPLOAD_FILE object
+    only = synctool.destindex.sources(synctool.param.OVERLAY_DIR,
+                                      [upfile.filename])
+    for obj, _, _ in synctool.overlay.walk(synctool.param.OVERLAY_DIR,
+                                           only=only):
+        if obj.ov_type == synctool.overlay.OV_TEMPLATE_POST:
+            break
 
-    if obj.ov_type == synctool.overlay.OV_TEMPLATE_POST:
-        return False, False
+        if obj.dest_path == upfile.filename:
+            upfile.repos_path = obj.src_path
+            break
 
-    if obj.dest_path == GLOBAL_UPLOAD_FILE.filename:
-        GLOBAL_UPLOAD_FILE.repos_path = obj.src_path
-        return False, False
-
-    if synctool.lib.terse_match(GLOBAL_UPLOAD_FILE.filename, obj.dest_path):
-        # it's a terse path ; 'expand' it
-        GLOBAL_UPLOAD_FILE.filename = obj.dest_path
-        GLOBAL_UPLOAD_FILE.repos_path = obj.src_path
-        return False, False
-
-    return True, False
+        if synctool.lib.terse_match(upfile.filename, obj.dest_path):
+            # it's a terse path ; 'expand' it
+            upfile.filename = obj.dest_path
+            upfile.repos_path = obj.src_path
+            break
 
 
 def upload(upfile: UploadFile) -> None:
     '''copy a file from a node into the overlay/ tree'''
 
-    # Note: this global is only needed because of callback fn ...
-    global GLOBAL_UPLOAD_FILE                               # pylint: disable=global-statement
-
     if upfile.filename[0] != os.sep:
         error('the filename to upload must be an absolute path')
         sys.exit(-1)
@@ -388,10 +380,8 @@ def upload(upfile: UploadFile) -> None:
     synctool.param.MY_GROUPS = synctool.config.get_my_groups()
 
     # see if file is already in the repository
-    # Note: ugly global is needed because of callback function
-    GLOBAL_UPLOAD_FILE = upfile
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _upload_callback)
-    upfile = GLOBAL_UPLOAD_FILE
+    _find_repos_path(upfile)
+    synctool.destindex.save()
 
     synctool.param.NODENAME = orig_nodename
     synctool.param.MY_GROUPS = orig_my_groups
@@ -0,0 +1,104 @@
+#
+#   synctool.verify.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''trust_mtime: decide when file contents need to be compared
+
+With sync_times enabled, a file on the node gets the mtime of the file
+in the repository. With trust_mtime enabled as well, a file that has
+the same size and mtime is taken to be the same, without reading it.
+To still catch changes that kept size and mtime, every Nth run is a
+deep verify run that compares all contents (deep_verify_interval),
+and in every run, a random 1 in N files is compared (deep_verify_sample)
+'''
+
+import os
+import random
+
+from synctool import param
+import synctool.lib
+from synctool.lib import verbose
+from synctool.syncstat import SyncStat
+
+# True if this run compares the contents of all files
+DEEP_RUN = False
+
+# True if any file was taken to be the same, without reading it
+TRUSTED = False
+
+
+def init() -> None:
+    '''decide whether this is a deep verify run
+    Only runs with --fix are counted; a dry run shows what the next
+    run with --fix would do
+    '''
+
+    global DEEP_RUN                                         # pylint: disable=global-statement
+
+    if not (param.TRUST_MTIME and param.SYNC_TIMES):
+        return
+
+    if param.DEEP_VERIFY_INTERVAL <= 0:
+        return
+
+    filename = os.path.join(param.ROOTDIR, param.VERIFY_FILE)
+    try:
+        with open(filename, 'r', encoding='utf-8') as fverify:
+            count = int(fverify.readline())
+    except (OSError, ValueError):
+        count = 0
+
+    DEEP_RUN = count % param.DEEP_VERIFY_INTERVAL == 0
+    if DEEP_RUN:
+        verbose('deep verify run; comparing the contents of all files')
+
+    if synctool.lib.DRY_RUN:
+        return
+
+    try:
+        with open(filename, 'w', encoding='utf-8') as fverify:
+            fverify.write('%d\n' % (count + 1))
+    except OSError as err:
+        # without the count, every run is a deep verify run
+        verbose('failed to write %s: %s' % (filename, err.strerror))
+
+
+def trust(src_stat: SyncStat, dest_stat: SyncStat) -> bool:
+    '''Returns True if the files may be taken to be the same
+    because they have the same size and mtime
+    '''
+
+    global TRUSTED                                          # pylint: disable=global-statement
+
+    if not same_metadata(src_stat.size, src_stat.mtime,
+                         dest_stat.size, dest_stat.mtime):
+        return False
+
+    if (param.DEEP_VERIFY_SAMPLE > 0 and
+            random.randrange(param.DEEP_VERIFY_SAMPLE) == 0):
+        # this one is picked for comparing
+        return False
+
+    TRUSTED = True
+    return True
+
+
+def same_metadata(src_size: int, src_mtime: int,
+                  dest_size: int, dest_mtime: int) -> bool:
+    '''Returns True if trust_mtime applies to this run,
+    and the size and mtime are the same
+    This does not pick the deep_verify_sample files
+    '''
+
+    if not (param.TRUST_MTIME and param.SYNC_TIMES) or DEEP_RUN:
+        return False
+
+    return src_size == dest_size and src_mtime == dest_mtime
+
+# EOB
@@ -0,0 +1,75 @@
+#
+#   test_deferred.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''post_num_proc: the order of the deferred .post scripts'''
+
+import os
+
+from synctool import param
+import synctool.deferred
+import synctool.lib
+
+
+def _script(tmp_path, name, delay=0.0):
+    '''Returns path of a script that logs its name when it is done'''
+
+    path = tmp_path / name
+    path.write_text('#! /bin/sh\nsleep %s\necho %s >> %s\n' %
+                    (delay, name, tmp_path / 'log'))
+    path.chmod(0o755)
+    return str(path)
+
+
+def _log(tmp_path):
+    '''Returns names of the scripts in the order they finished'''
+
+    return (tmp_path / 'log').read_text().split()
+
+
+def test_order(tmp_path, monkeypatch):
+    '''the .post script of a directory runs after the ones below it;
+    the same script for the same directory runs once
+    '''
+
+    monkeypatch.setattr(param, 'POST_NUM_PROC', 4)
+    monkeypatch.setattr(synctool.lib, 'DRY_RUN', False)
+    monkeypatch.setattr(synctool.lib, 'QUIET', True)
+
+    top = str(tmp_path)
+    sub = os.path.join(top, 'sub')
+    os.mkdir(sub)
+
+    # the directory script is queued first, and is quick
+    synctool.deferred.add(_script(tmp_path, 'dir.post'), top, sub, True)
+    synctool.deferred.add(_script(tmp_path, 'file.post', 0.3), sub,
+                          os.path.join(sub, 'file'), False)
+    synctool.deferred.add(_script(tmp_path, 'subdir.post', 0.2), sub,
+                          os.path.join(sub, 'subdir'), True)
+    synctool.deferred.add(_script(tmp_path, 'other.post'), top,
+                          os.path.join(top, 'other'), False)
+    # queued again for another file in the same dir
+    synctool.deferred.add(str(tmp_path / 'file.post'), sub,
+                          os.path.join(sub, 'file2'), False)
+
+    # run() sets the umask of synctool; the test keeps its own
+    umask = os.umask(0o22)
+    try:
+        synctool.deferred.run()
+    finally:
+        os.umask(umask)
+
+    log = _log(tmp_path)
+    assert sorted(log) == ['dir.post', 'file.post', 'other.post', 'subdir.post']
+    assert log.index('dir.post') > log.index('file.post')
+    assert log.index('dir.post') > log.index('subdir.post')
+    # scripts that are not below each other run at the same time
+    assert log.index('other.post') < log.index('subdir.post')
+
+# EOB
@@ -0,0 +1,121 @@
+#
+#   test_object.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''installing files atomically'''
+
+import os
+import errno
+
+from synctool import param
+import synctool.lib
+import synctool.object
+from synctool.syncstat import SyncStat
+
+DATA = os.urandom(300 * 1024)
+
+
+def _setup(tmp_path, monkeypatch):
+    '''Returns source file and destination path'''
+
+    monkeypatch.setattr(synctool.lib, 'DRY_RUN', False)
+    monkeypatch.setattr(synctool.lib, 'QUIET', True)
+    monkeypatch.setattr(synctool.lib, 'ERROR_COUNT', 0)
+    monkeypatch.setattr(param, 'BACKUP_COPIES', False)
+
+    src = tmp_path / 'src'
+    src.write_bytes(DATA)
+    return str(src), str(tmp_path / 'dest')
+
+
+def _install(src, dest):
+    '''install src as dest'''
+
+    vnode = synctool.object.VNodeFile(dest, SyncStat(src), os.path.lexists(dest), src)
+    vnode.fix()
+
+
+def _no_kernel_copy(monkeypatch):
+    '''copy_file_range() and sendfile() are not supported'''
+
+    def not_supported(*_args):
+        '''raise ENOSYS'''
+
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    monkeypatch.setattr(os, 'copy_file_range', not_supported, raising=False)
+    monkeypatch.setattr(os, 'sendfile', not_supported, raising=False)
+
+
+def test_install(tmp_path, monkeypatch):
+    '''the file is installed, also if a directory is in the way'''
+
+    src, dest = _setup(tmp_path, monkeypatch)
+
+    _install(src, dest)
+    with open(dest, 'rb') as fdest:
+        assert fdest.read() == DATA
+
+    os.unlink(dest)
+    os.mkdir(dest)
+    _install(src, dest)
+    with open(dest, 'rb') as fdest:
+        assert fdest.read() == DATA
+
+    assert synctool.lib.ERROR_COUNT == 0
+
+
+def test_short_copy(tmp_path, monkeypatch):
+    '''a copy in the kernel that stops short is finished otherwise'''
+
+    src, dest = _setup(tmp_path, monkeypatch)
+    _no_kernel_copy(monkeypatch)
+
+    def short_copy(src_fd, dest_fd, _count, *_args):
+        '''copy only the first 1000 bytes'''
+
+        if os.lseek(src_fd, 0, os.SEEK_CUR) > 0:
+            return 0
+        return os.write(dest_fd, os.read(src_fd, 1000))
+
+    monkeypatch.setattr(os, 'copy_file_range', short_copy, raising=False)
+
+    _install(src, dest)
+    with open(dest, 'rb') as fdest:
+        assert fdest.read() == DATA
+    assert synctool.lib.ERROR_COUNT == 0
+
+
+def test_failed_copy(tmp_path, monkeypatch):
+    '''if the copy stays short, the destination is left as it was'''
+
+    src, dest = _setup(tmp_path, monkeypatch)
+    _no_kernel_copy(monkeypatch)
+
+    real_read = os.read
+
+    def short_read(fdesc, count):
+        '''the file seems to end halfway'''
+
+        pos = os.lseek(fdesc, 0, os.SEEK_CUR)
+        return real_read(fdesc, max(0, min(count, len(DATA) // 2 - pos)))
+
+    with open(dest, 'wb') as fdest:
+        fdest.write(b'old\n')
+
+    monkeypatch.setattr(os, 'read', short_read)
+    _install(src, dest)
+
+    with open(dest, 'rb') as fdest:
+        assert fdest.read() == b'old\n'
+    # no temp file is left behind
+    assert sorted(os.listdir(tmp_path)) == ['dest', 'src']
+    assert synctool.lib.ERROR_COUNT == 1
+
+# EOB
@@ -0,0 +1,122 @@
+#
+#   test_plan.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''plan files: loading, and the check of the paths in the steps'''
+
+import os
+import json
+
+from synctool import param
+import synctool.overlay
+import synctool.plan
+
+
+def _setup(tmp_path, monkeypatch):
+    '''make an overlay and delete dir for node n1 in groups web and all
+    Returns the overlay dir
+    '''
+
+    overlay = tmp_path / 'overlay'
+    for path in ('all/etc/ntp.conf._all', 'all/etc/ntp.conf.post',
+                 'all/etc/hosts._all', 'all/etc._n1/motd._all',
+                 'other/etc/ntp.conf._other'):
+        (overlay / path).parent.mkdir(parents=True, exist_ok=True)
+        (overlay / path).write_text('x\n')
+    (overlay / 'all' / 'link').symlink_to(tmp_path)
+    (tmp_path / 'evil.conf._all').write_text('x\n')
+    (tmp_path / 'delete' / 'all' / 'etc').mkdir(parents=True)
+    (tmp_path / 'delete' / 'all' / 'etc' / 'old.conf._all').write_text('')
+
+    monkeypatch.setattr(param, 'OVERLAY_DIR', str(overlay))
+    monkeypatch.setattr(param, 'DELETE_DIR', str(tmp_path / 'delete'))
+    monkeypatch.setattr(param, 'MY_GROUPS', ['n1', 'web', 'all'])
+    monkeypatch.setattr(param, 'NODENAME', 'n1')
+    return str(overlay)
+
+
+def _fix_step(src, dest, post=None):
+    '''Returns a fix step'''
+
+    return {'step': synctool.plan.STEP_FIX, 'src': src, 'dest': dest,
+            'fix': ['update'], 'pre': None, 'post': post,
+            'src_stat': None, 'dest_stat': None}
+
+
+def _check(step):
+    '''Returns True if the plan with step passes the check'''
+
+    return synctool.overlay.check_plan('plan', [step])
+
+
+def test_sources_in_the_overlay(tmp_path, monkeypatch):
+    '''sources in their place in the overlay are accepted'''
+
+    overlay = _setup(tmp_path, monkeypatch)
+
+    assert _check(_fix_step(overlay + '/all/etc/ntp.conf._all', '/etc/ntp.conf',
+                            post=overlay + '/all/etc/ntp.conf.post'))
+    # a directory with a group extension
+    assert _check(_fix_step(overlay + '/all/etc._n1/motd._all', '/etc/motd'))
+    assert _check({'step': synctool.plan.STEP_DELETE,
+                   'src': param.DELETE_DIR + '/all/etc/old.conf._all',
+                   'dest': '/etc/old.conf', 'post': None})
+
+
+def test_sources_elsewhere(tmp_path, monkeypatch):
+    '''sources and scripts that do not belong to the destination
+    are refused
+    '''
+
+    overlay = _setup(tmp_path, monkeypatch)
+
+    # not in the overlay
+    assert not _check(_fix_step(str(tmp_path / 'evil.conf._all'), '/evil.conf'))
+    assert not _check(_fix_step(overlay + '/all/../../evil.conf._all', '/evil.conf'))
+    assert not _check(_fix_step(overlay + '/all/link/evil.conf._all', '/link/evil.conf'))
+    # not one of my groups
+    assert not _check(_fix_step(overlay + '/other/etc/ntp.conf._other', '/etc/ntp.conf'))
+    # for another destination
+    assert not _check(_fix_step(overlay + '/all/etc/hosts._all', '/etc/ntp.conf'))
+    assert not _check(_fix_step(overlay + '/all/etc/ntp.conf._all', '/root/ntp.conf'))
+    # a script is not a source, and the other way around
+    assert not _check(_fix_step(overlay + '/all/etc/ntp.conf.post', '/etc/ntp.conf'))
+    assert not _check(_fix_step(overlay + '/all/etc/hosts._all', '/etc/hosts',
+                                post=overlay + '/all/etc/ntp.conf.post'))
+    # a delete step does not take sources from the overlay
+    assert not _check({'step': synctool.plan.STEP_DELETE,
+                       'src': overlay + '/all/etc/hosts._all',
+                       'dest': '/etc/hosts', 'post': None})
+
+
+def test_load(tmp_path, monkeypatch):
+    '''only a valid plan for this node loads'''
+
+    overlay = _setup(tmp_path, monkeypatch)
+    step = _fix_step(overlay + '/all/etc/hosts._all', '/etc/hosts')
+
+    filename = str(tmp_path / 'plan.json')
+    for plan, okay in (({'synctool_plan': synctool.plan.PLAN_VERSION,
+                         'node': 'n1', 'steps': [step]}, True),
+                       ({'synctool_plan': synctool.plan.PLAN_VERSION,
+                         'node': 'n2', 'steps': [step]}, False),
+                       ({'synctool_plan': synctool.plan.PLAN_VERSION + 1,
+                         'node': 'n1', 'steps': [step]}, False),
+                       ({'synctool_plan': synctool.plan.PLAN_VERSION,
+                         'node': 'n1', 'steps': [{'step': 'fix'}]}, False)):
+        with open(filename, 'w', encoding='utf-8') as fplan:
+            json.dump(plan, fplan)
+
+        steps = synctool.plan.load(filename)
+        assert (steps == [step]) == okay
+
+    os.unlink(filename)
+    assert synctool.plan.load(filename) is None
+
+# EOB
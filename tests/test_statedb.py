@@ -0,0 +1,137 @@
+#
+#   test_statedb.py    WJ126
+#
+#   synctool Copyright 2024 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''skip_unchanged: recording the state, and skipping what did not change'''
+
+import os
+import copy
+import json
+
+from synctool import param
+import synctool.lib
+import synctool.statedb
+from synctool.syncstat import SyncStat
+
+
+def _setup(tmp_path, monkeypatch):
+    '''Returns destination dir with a managed file'''
+
+    monkeypatch.setattr(param, 'ROOTDIR', str(tmp_path))
+    monkeypatch.setattr(param, 'FULL_RUN_INTERVAL', 0)
+    monkeypatch.setattr(synctool.lib, 'DRY_RUN', False)
+    monkeypatch.setattr(synctool.lib, 'ERROR_COUNT', 0)
+    # the test does not wait for the timestamps to settle
+    monkeypatch.setattr(synctool.statedb, 'RACY_NS', -3600 * 10**9)
+
+    (tmp_path / 'var').mkdir()
+    dest_dir = tmp_path / 'dst'
+    dest_dir.mkdir()
+    (dest_dir / 'file').write_text('data\n')
+    return str(dest_dir)
+
+
+def _run(dest_dir, fingerprint='fp', change=None):
+    '''walk dest_dir, and save the state
+    If change is given, it is called after the file was checked
+    Returns True if dest_dir was skipped
+    '''
+
+    synctool.statedb.start({dest_dir: fingerprint})
+    if synctool.statedb.unchanged(dest_dir):
+        return True
+
+    path = os.path.join(dest_dir, 'file')
+    synctool.statedb.checked(path, SyncStat(path), False)
+    if change is not None:
+        change(path)
+    synctool.statedb.walked()
+    synctool.statedb.save()
+    return False
+
+
+def _touch(path):
+    '''change the file'''
+
+    with open(path, 'a', encoding='utf-8') as fdest:
+        fdest.write('more\n')
+
+
+def test_skip_unchanged(tmp_path, monkeypatch):
+    '''a dir is skipped only if its sources and destinations did not change'''
+
+    dest_dir = _setup(tmp_path, monkeypatch)
+
+    assert not _run(dest_dir)
+    assert _run(dest_dir)
+    assert synctool.statedb.skipped()
+
+    # the sources changed
+    assert not _run(dest_dir, fingerprint='fp2')
+    assert _run(dest_dir, fingerprint='fp2')
+
+    # the destination changed
+    _touch(os.path.join(dest_dir, 'file'))
+    assert not _run(dest_dir, fingerprint='fp2')
+    assert _run(dest_dir, fingerprint='fp2')
+
+
+def test_changed_after_check(tmp_path, monkeypatch):
+    '''a dir with entries that changed after they were checked,
+    is not recorded
+    '''
+
+    dest_dir = _setup(tmp_path, monkeypatch)
+
+    assert not _run(dest_dir, change=_touch)
+    assert not _run(dest_dir)
+    assert _run(dest_dir)
+
+
+def test_not_recorded(tmp_path, monkeypatch):
+    '''nothing is recorded after errors, or without a fingerprint'''
+
+    dest_dir = _setup(tmp_path, monkeypatch)
+
+    monkeypatch.setattr(synctool.lib, 'ERROR_COUNT', 1)
+    assert not _run(dest_dir)
+    assert not _run(dest_dir)
+
+    monkeypatch.setattr(synctool.lib, 'ERROR_COUNT', 0)
+    assert not _run(dest_dir, fingerprint=None)
+    assert not _run(dest_dir, fingerprint=None)
+
+
+def test_invalid_state_file(tmp_path, monkeypatch):
+    '''an invalid state file gives a full run'''
+
+    dest_dir = _setup(tmp_path, monkeypatch)
+
+    assert not _run(dest_dir)
+    assert _run(dest_dir)
+
+    state_file = synctool.statedb.state_file()
+    with open(state_file, 'r', encoding='utf-8') as fstate:
+        state = json.load(fstate)
+
+    bad_fingerprint = copy.deepcopy(state)
+    bad_fingerprint['dirs'][dest_dir][0] = 1
+    bad_metadata = copy.deepcopy(state)
+    bad_metadata['dirs'][dest_dir][1]['file'][0] = 'x'
+    bad_record = copy.deepcopy(state)
+    bad_record['dirs'][dest_dir] = ['fp']
+
+    for invalid in ('{"dirs": ', json.dumps(bad_fingerprint),
+                    json.dumps(bad_metadata), json.dumps(bad_record)):
+        with open(state_file, 'w', encoding='utf-8') as fstate:
+            fstate.write(invalid)
+        assert not _run(dest_dir)
+        assert _run(dest_dir)
+
+# EOB